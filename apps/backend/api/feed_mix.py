@@ -5,8 +5,8 @@ from datetime import datetime
 
 from api.add_senders import add_senders
 from api.page_response import PageResponse, Sender
-from crawler.prismac import pg_client
-from crawler.recommendation.embedding import generate_feed_from_page
+from crawler.prismac import async_pg_client
+from crawler.recommendation.embedding import similar_to_pages
 from prisma import Prisma
 from prisma.models import Comment, Message, Page
 
@@ -31,7 +31,7 @@ async def _process_messages(messages: list[Message]):
     page_ids_to_fetch = set(
         [m.page_id for m in messages if m.page_id is not None])
 
-    pages = pg_client.get_pages_by_id(list(page_ids_to_fetch))
+    pages = await async_pg_client.get_pages_by_id(list(page_ids_to_fetch))
 
     pages = {p.id: p for p in pages}
 
@@ -107,10 +107,11 @@ async def get_similar_articles(client: Prisma, user_id: str) -> list[PageRespons
 
     similar: list[PageResponse] = []
 
-    liked_pages = pg_client.get_page_stubs_by_id(
+    liked_pages = await async_pg_client.get_page_stubs_by_id(
         [lp.page_id for lp in selected_liked_pages])
+    feeds = await similar_to_pages([lp.url for lp in liked_pages])
     for lp in liked_pages:
-        similar.extend(await generate_feed_from_page(lp.url))
+        similar.extend(feeds.get(lp.url, []))
 
     # Since some articles might be similar to multiple articles that the user liked, we need to deduplicate
     # If something shows up multiple times, it's score increases (matches person's interests more)
@@ -139,7 +140,7 @@ async def random_feed(client: Prisma) -> list[PageResponse]:
     # Format it as "YYYY-MM-DD"
     seed = current_datetime.strftime("%Y-%m-%d") + 'A'
 
-    random_pages = pg_client.query("""
+    random_pages = await async_pg_client.query("""
         WITH random_ids AS (SELECT id, MD5(CONCAT(%s::text, content_hash)) FROM "Page" ORDER BY md5 LIMIT 300)
         SELECT p.* From "Page" p INNER JOIN random_ids ON random_ids.id = p.id WHERE p.depth <= 1 ORDER BY COALESCE(page_rank, 0) DESC LIMIT %s
         """, [seed, limit])
@@ -153,7 +154,7 @@ async def random_feed(client: Prisma) -> list[PageResponse]:
 
 
 async def page_ids_to_page_response(client: Prisma, ids: list[int]) -> list[PageResponse]:
-    pages = pg_client.get_pages_by_id(ids)
+    pages = await async_pg_client.get_pages_by_id(ids)
     pages_filled = [PageResponse.from_prisma_page(p) for p in pages]
 
     await add_senders(client, pages_filled)
@@ -8,11 +8,15 @@ from uuid import UUID
 
 import pytest
 from api.page_response import PageResponse, Sender
+from crawler import dbaccess, http_client, parse_service, query_cache
 from crawler.link import Link, clean_url
-from crawler.prismac import PostgresClient, pg_client
-from crawler.recommendation.embedding import (NearestNeighboursQuery,
-                                              _query_similar,
+from crawler.prismac import PostgresClient, async_pg_client, pg_client
+from crawler.recommendation import ann_index, bm25_index, hybrid_search
+from crawler.recommendation.embedding import (DEFAULT_EMBEDDING_LEASE_SECONDS,
+                                              NearestNeighboursQuery,
+                                              query_similar,
                                               generate_feed_from_page,
+                                              similar_to_pages,
                                               store_embeddings_for_pages)
 from crawler.worker import crawl_interactive, crawl_only, get_window_avg
 from dotenv import load_dotenv
@@ -56,6 +60,21 @@ async def startup():
     print("Connecting to database...")
     await client.connect()
     pg_client.connect()
+    await async_pg_client.connect()
+    await http_client.startup()
+    parse_service.startup()
+    await ann_index.startup()
+    await bm25_index.startup()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await http_client.shutdown()
+    parse_service.shutdown()
+    await ann_index.shutdown()
+    await bm25_index.shutdown()
+    await dbaccess.close_async_pool()
+    dbaccess.close_pool()
 
 
 async def find_user(userid: str):
@@ -158,10 +177,11 @@ async def recommend(userId: UUID) -> list[PageResponse]:
 
     similar: list[PageResponse] = []
 
-    liked_pages = pg_client.get_page_stubs_by_id(
+    liked_pages = await async_pg_client.get_page_stubs_by_id(
         [lp.page_id for lp in selected_liked_pages])
+    feeds = await similar_to_pages([lp.url for lp in liked_pages])
     for lp in liked_pages:
-        similar.extend(await generate_feed_from_page(lp.url))
+        similar.extend(feeds.get(lp.url, []))
 
     # Since some articles might be similar to multiple articles that the user liked, we need to deduplicate
     # If something shows up multiple times, it's score increases (matches person's interests more)
@@ -193,7 +213,7 @@ async def get_liked_pages(userid: str) -> list[PageResponse]:
     lps.sort(key=lambda x: x.created_at, reverse=True)
     page_ids = [lp.page_id for lp in lps]
 
-    pages = pg_client.get_pages_by_id(page_ids)
+    pages = await async_pg_client.get_pages_by_id(page_ids)
     # sort by most recent
     pages.sort(key=lambda x: page_ids.index(x.id))
 
@@ -311,7 +331,7 @@ async def search(body: SearchQuery) -> list[PageResponse]:
     if body.url:
         url = body.url
 
-        contains_url = pg_client.query(
+        contains_url = await async_pg_client.query(
             'SELECT 1 FROM "Page" p INNER JOIN Embeddings e ON p.url = e.url WHERE p.url = %s', [url])
 
         if contains_url:
@@ -322,12 +342,20 @@ async def search(body: SearchQuery) -> list[PageResponse]:
             want_vec, _ = await crawl_interactive(Link.from_url(url))
             query = NearestNeighboursQuery(vector=want_vec, url=url)
 
-        similar = _query_similar(query)
+        similar = await query_similar(query)
 
     else:
-        want_vec = get_window_avg(body.query)
-        query = NearestNeighboursQuery(vector=want_vec, text_query=body.query)
-        similar = _query_similar(query)
+        results = query_cache.get_result_cache()
+        similar = results.get(body.query)
+        if similar is None:
+            want_vec = query_cache.get_vector_cache().get_or_compute(body.query, get_window_avg)
+            query = NearestNeighboursQuery(vector=want_vec, text_query=body.query)
+            similar, complete = await hybrid_search.hybrid_search(query)
+            # Don't keep the results of a branch that timed out around for the whole TTL
+            if complete:
+                results.put(body.query, similar)
+        # add_senders fills in the pages, so never hand out the cached objects themselves
+        similar = [p.copy(deep=True) for p in similar]
 
     await add_senders(client, similar)
 
@@ -339,6 +367,19 @@ def health_check():
     return {"status": "ok"}
 
 
+@app.get("/health/db")
+async def db_health_check():
+    pool = await dbaccess.get_async_pool()
+    async with pool.connection() as conn:
+        await conn.execute("SELECT 1")
+    return {"status": "ok", "pools": dbaccess.pool_stats()}
+
+
+@app.get("/health/cache")
+def cache_health_check():
+    return {"status": "ok", "caches": query_cache.cache_stats(), "hybrid_search": hybrid_search.stats}
+
+
 @app.get('/random-feed')
 async def random_feed(limit: int = 60) -> list[PageResponse]:
     """
@@ -355,7 +396,7 @@ async def random_feed(limit: int = 60) -> list[PageResponse]:
     # Format it as "YYYY-MM-DD"
     seed = current_datetime.strftime("%Y-%m-%d") + 'A'
 
-    random_pages = pg_client.query("""
+    random_pages = await async_pg_client.query("""
     WITH random_ids AS (SELECT id, MD5(CONCAT(%s::text, content_hash)) FROM "Page" ORDER BY md5 LIMIT 5000)
     SELECT p.* From "Page" p INNER JOIN random_ids ON random_ids.id = p.id WHERE p.depth <= 1 ORDER BY COALESCE(page_rank, 0) DESC LIMIT %s
     """, [seed, limit])
@@ -485,7 +526,9 @@ class CreatePageRequest(BaseModel):
 async def _create_page(body: CreatePageRequest) -> Page:
     link = Link(parent_url=f"user: {body.userid}", url=body.url, text="")
     vec, response = await crawl_interactive(link)
-    page_response = pg_client.store_raw_page(3, response)
+    # Leased to us while we embed it inline. If that fails, an embedding worker takes it over once the lease runs out
+    page_response = pg_client.store_raw_page(
+        3, response, embedding_lease_seconds=DEFAULT_EMBEDDING_LEASE_SECONDS)
 
     if page_response is not None:
         await store_embeddings_for_pages([page_response])
@@ -696,7 +739,7 @@ async def test_like():
 async def find_page(body: FindPageRequest) -> Union[FindPageResponse, ShouldAdd]:
     url = clean_url(body.url)
     user_id = body.userId
-    page = pg_client.get_page(url=url)
+    page = await async_pg_client.get_page(url=url)
 
     if page is None:
         return ShouldAdd(url=url)
@@ -937,7 +980,7 @@ def deduplicate(pages: list[NodePage]) -> list[NodePage]:
 
 @app.post("/pagenodes")
 async def get_outbound_nodes(body: UrlRequest):
-    root = pg_client.get_page(url=body.url)
+    root = await async_pg_client.get_page(url=body.url)
     if not root:
         raise HTTPException(400, "Page does not exist")
 
@@ -947,8 +990,8 @@ async def get_outbound_nodes(body: UrlRequest):
     if root is None:
         raise HTTPException(400, "Page does not exist")
 
-    outbound_pages = pg_client.get_pages_by_url(root.outbound_urls)
-    inbound_pages = pg_client.reverse_find_pages_by_url(body.url)
+    outbound_pages = await async_pg_client.get_pages_by_url(root.outbound_urls)
+    inbound_pages = await async_pg_client.reverse_find_pages_by_url(body.url)
 
     # outbound = deduplicate(root, [PageNode.from_page(p)
     #                        for p in outbound_pages])
@@ -0,0 +1,127 @@
+"""
+Similarity queries by vector through Postgres (`ORDER BY vec <=> ...`) against the in-process HNSW index: latency, and
+how many of the Postgres top 20 pages the index finds. The query vectors are the mean window vectors of random pages.
+
+Also the recall of the ivfflat indexes on Embeddings and "PageCentroid" against exact search (no index scan): the share
+of the true SIMILAR_NEIGHBOURS nearest rows a query finds with 1 probe, with DB_IVFFLAT_PROBES and with `--probes`.
+
+    python -m crawler.benchmarks.ann_benchmark --dir /tmp/ann [--queries 50] [--seed 5000] [--probes 20]
+
+The index in `--dir` is built (or updated) first. `--seed` inserts that many synthetic pages with random clustered
+embeddings and their centroids first (only do that on a scratch database).
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import numpy as np
+
+from crawler.dbaccess import DEFAULT_IVFFLAT_PROBES, _ivfflat_probes, get_pool
+from crawler.recommendation import ann_index
+from crawler.recommendation.embedding import (SIMILAR_NEIGHBOURS,
+                                              UPDATE_CENTROIDS,
+                                              NearestNeighboursQuery,
+                                              _query_similar_embeddings)
+
+CLUSTERS = 50
+WINDOWS_PER_PAGE = 3
+
+
+def seed_pages(n: int):
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(CLUSTERS, ann_index.DIM))
+    with get_pool().connection() as conn, conn.cursor() as cursor:
+        with cursor.copy('COPY "Page" (content_hash, url, title, content, outbound_urls, depth, page_rank) FROM STDIN') as copy:
+            for i in range(n):
+                copy.write_row((f"ann-bench-{i}", f"https://ann.example/{i}", f"Page {i}", "", [], 0, float(rng.uniform(0.5, 2))))
+        with cursor.copy('COPY Embeddings (url, "index", vec) FROM STDIN') as copy:
+            for i in range(n):
+                center = centers[i % CLUSTERS]
+                for idx in range(WINDOWS_PER_PAGE):
+                    vec = center + rng.normal(scale=0.8, size=ann_index.DIM)
+                    copy.write_row((f"https://ann.example/{i}", idx, str((vec / np.linalg.norm(vec)).tolist())))
+        page_ids = [row[0] for row in cursor.execute('SELECT id FROM "Page"').fetchall()]
+        cursor.execute(UPDATE_CENTROIDS, (page_ids,))
+        # The ivfflat lists are picked from the rows at index build time, so build them again over the seeded rows
+        cursor.execute('REINDEX TABLE Embeddings')
+        cursor.execute('REINDEX TABLE "PageCentroid"')
+        cursor.execute('ANALYZE Embeddings')
+        cursor.execute('ANALYZE "PageCentroid"')
+    print(f"Seeded {n} pages")
+
+
+def timed(fn, vectors: list[np.ndarray]) -> tuple[list[list[int]], list[float]]:
+    results, latencies = [], []
+    for vector in vectors:
+        start = time.perf_counter()
+        results.append([p.id for p in fn(NearestNeighboursQuery(vector=vector))])
+        latencies.append(time.perf_counter() - start)
+    return results, latencies
+
+
+def nearest_rows(cursor, table: str, vector: np.ndarray, probes: int = 0) -> set[str]:
+    """Urls (Embeddings) or page ids ("PageCentroid") of the nearest rows, exact search if `probes` is 0"""
+    if probes:
+        cursor.execute("SELECT set_config('ivfflat.probes', %s, true)", (str(probes),))
+    else:
+        cursor.execute("SELECT set_config('enable_indexscan', 'off', true)")
+    key = 'url || \':\' || "index"' if table == 'Embeddings' else 'page_id'
+    cursor.execute(f'SELECT {key} FROM {table} ORDER BY vec <=> %s::vector LIMIT %s',
+                   (str(vector.tolist()), SIMILAR_NEIGHBOURS))
+    rows = {str(row[0]) for row in cursor.fetchall()}
+    cursor.connection.rollback()
+    return rows
+
+
+def ivfflat_recall(vectors: list[np.ndarray], probes: list[int]):
+    with get_pool().connection() as conn, conn.cursor() as cursor:
+        for table in ('Embeddings', '"PageCentroid"'):
+            exact = [nearest_rows(cursor, table, v) for v in vectors]
+            for p in probes:
+                recall = [len(nearest_rows(cursor, table, v, p) & e) / len(e) for v, e in zip(vectors, exact) if e]
+                print(f"{table:>14}, {p:>3} probes: recall@{SIMILAR_NEIGHBOURS} {statistics.mean(recall):.3f}")
+
+
+def report(name: str, latencies: list[float]):
+    q = statistics.quantiles(latencies, n=100)
+    print(f"{name:>9}: p50 {q[49] * 1000:7.1f} ms, p99 {q[98] * 1000:7.1f} ms")
+
+
+async def main(args):
+    if args.seed:
+        seed_pages(args.seed)
+    if args.rebuild:
+        ann_index.build_index(args.dir)
+    else:
+        ann_index.update_index(args.dir)
+
+    with get_pool().connection() as conn:
+        urls = [row[0] for row in conn.execute('SELECT DISTINCT url FROM Embeddings').fetchall()]
+        urls = random.sample(urls, min(args.queries, len(urls)))
+        vectors = [np.array(conn.execute('SELECT AVG(vec)::text FROM Embeddings WHERE url = %s', (url,))
+                            .fetchone()[0].strip('[]').split(','), dtype=np.float32) for url in urls]
+
+    ivfflat_recall(vectors, sorted({1, int(_ivfflat_probes()), args.probes}))
+
+    postgres, postgres_latencies = timed(_query_similar_embeddings, vectors)
+    await ann_index.startup(args.dir)
+    index, index_latencies = timed(_query_similar_embeddings, vectors)
+    await ann_index.shutdown()
+
+    report('postgres', postgres_latencies)
+    report('hnsw', index_latencies)
+    recall = [len(set(a) & set(b)) / len(a) for a, b in zip(postgres, index) if a]
+    print(f"Top {len(postgres[0])} overlap with Postgres: {statistics.mean(recall):.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dir", required=True)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rebuild", action="store_true")
+    parser.add_argument("--probes", type=int, default=DEFAULT_IVFFLAT_PROBES * 2,
+                        help="ivfflat probes to compare with the configured ones")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,125 @@
+"""
+Request latency of the API read paths on the blocking `pg_client` against `async_pg_client`.
+
+    python -m crawler.benchmarks.api_load_benchmark [--rate 200] [--seconds 10] [--seed 2000] [--rtt_ms 0]
+
+Requests arrive on one event loop at a fixed rate, the way uvicorn hands them to a worker: a mix of `/page` and
+`/pagenodes` lookups and the `/random-feed` query, which scans every page. Latency is counted from when the request
+arrived, so time spent waiting for a blocked event loop shows up in it. `--seed` inserts that many synthetic pages
+first (only do that on a scratch database).
+
+Against a database on the same machine the queries are CPU bound and both clients do about the same. `--rtt_ms` adds a
+server-side sleep to each request to stand in for the network round trips to a remote database, which is where a
+blocked event loop costs the most.
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from crawler.dbaccess import close_async_pool, close_pool, get_pool
+from crawler.prismac import async_pg_client, pg_client
+
+RANDOM_FEED = """
+    WITH random_ids AS (SELECT id, MD5(CONCAT(%s::text, content_hash)) FROM "Page" ORDER BY md5 LIMIT 300)
+    SELECT p.* From "Page" p INNER JOIN random_ids ON random_ids.id = p.id WHERE p.depth <= 1 ORDER BY COALESCE(page_rank, 0) DESC LIMIT %s
+"""
+NETWORK_WAIT = "SELECT pg_sleep(%s)"
+
+
+def seed_pages(n: int):
+    with get_pool().connection() as conn, conn.cursor() as cursor:
+        with cursor.copy('COPY "Page" (content_hash, url, parent_url, title, content, outbound_urls, depth) FROM STDIN') as copy:
+            for i in range(n):
+                outbound = [f"https://bench.example/{random.randrange(n)}" for _ in range(10)]
+                copy.write_row((f"bench-{i}", f"https://bench.example/{i}", None, f"Page {i}",
+                                "lorem ipsum " * 200, outbound, i % 3))
+    print(f"Seeded {n} pages")
+
+
+def sync_handlers(rtt: float):
+    async def page(url):
+        pg_client.query(NETWORK_WAIT, [rtt])
+        return pg_client.get_page(url=url)
+
+    async def pagenodes(url):
+        pg_client.query(NETWORK_WAIT, [rtt])
+        root = pg_client.get_page(url=url)
+        pg_client.get_pages_by_url(root.outbound_urls)
+        pg_client.reverse_find_pages_by_url(url)
+
+    async def random_feed(_):
+        pg_client.query(NETWORK_WAIT, [rtt])
+        pg_client.query(RANDOM_FEED, [str(random.random()), 60])
+
+    return [page, pagenodes, random_feed]
+
+
+def async_handlers(rtt: float):
+    async def page(url):
+        await async_pg_client.query(NETWORK_WAIT, [rtt])
+        return await async_pg_client.get_page(url=url)
+
+    async def pagenodes(url):
+        await async_pg_client.query(NETWORK_WAIT, [rtt])
+        root = await async_pg_client.get_page(url=url)
+        await async_pg_client.get_pages_by_url(root.outbound_urls)
+        await async_pg_client.reverse_find_pages_by_url(url)
+
+    async def random_feed(_):
+        await async_pg_client.query(NETWORK_WAIT, [rtt])
+        await async_pg_client.query(RANDOM_FEED, [str(random.random()), 60])
+
+    return [page, pagenodes, random_feed]
+
+
+async def run(name: str, handlers, urls: list[str], rate: float, seconds: float):
+    # 45% /page, 45% /pagenodes, 10% /random-feed
+    weights = [45, 45, 10]
+    latencies: list[float] = []
+
+    async def request(handler, url, arrived):
+        await handler(url)
+        latencies.append(time.perf_counter() - arrived)
+
+    pending = []
+    start = time.perf_counter()
+    for i in range(int(rate * seconds)):
+        arrival = start + i / rate
+        delay = arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        handler = random.choices(handlers, weights)[0]
+        pending.append(asyncio.create_task(request(handler, random.choice(urls), arrival)))
+    await asyncio.gather(*pending)
+
+    latencies.sort()
+    q = statistics.quantiles(latencies, n=100)
+    print(f"{name:>6}: {len(latencies)} requests, p50 {q[49] * 1000:7.1f} ms, p95 {q[94] * 1000:7.1f} ms, "
+          f"p99 {q[98] * 1000:7.1f} ms")
+    return q[98]
+
+
+async def main(args):
+    pg_client.connect()
+    await async_pg_client.connect()
+    if args.seed:
+        seed_pages(args.seed)
+    urls = [p['url'] for p in pg_client.query('SELECT url FROM "Page" ORDER BY random() LIMIT 1000')]
+
+    blocking = await run('sync', sync_handlers(args.rtt_ms / 1000), urls, args.rate, args.seconds)
+    non_blocking = await run('async', async_handlers(args.rtt_ms / 1000), urls, args.rate, args.seconds)
+    print(f"p99 improvement: {blocking / non_blocking:.1f}x")
+
+    await close_async_pool()
+    close_pool()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=200, help="requests per second")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rtt_ms", type=float, default=0, help="simulated network wait per request")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,53 @@
+"""
+Windows per second of the `Embedder` backends on the parse fixtures: PyTorch, ONNX Runtime, and ONNX Runtime with int8
+weights, with the cosine similarity of each ONNX variant to the PyTorch vectors.
+
+    python -m crawler.benchmarks.embedding_benchmark [--rounds 3] [--batch_size 64] [--threads N]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from crawler.recommendation.embedding_backends import OnnxBackend, TorchBackend
+from crawler.tests.test_simhash import fixture_text
+
+FIXTURES = ['blog_post.html', 'long_essay.html', 'lethain_post.html', 'latin1_page.html']
+# Same windowing as `Embedder.embed`
+STRIDE = 360
+SIZE = 380
+
+
+def fixture_windows() -> list[str]:
+    windows = []
+    for name in FIXTURES:
+        words = fixture_text(name).split()
+        windows.extend(' '.join(words[i:i + SIZE]) for i in range(0, len(words), STRIDE))
+    return windows
+
+
+def bench(name: str, backend, windows: list[str], batch_size: int, rounds: int) -> np.ndarray:
+    vectors = backend.encode(windows, batch_size)  # warm up
+    start = time.perf_counter()
+    for _ in range(rounds):
+        backend.encode(windows, batch_size)
+    elapsed = time.perf_counter() - start
+    print(f"{name:>10}: {rounds * len(windows) / elapsed:8.1f} windows/s")
+    return vectors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    windows = fixture_windows()
+    print(f"{len(windows)} windows")
+    reference = bench('torch', TorchBackend(), windows, args.batch_size, args.rounds)
+    for quantize in [False, True]:
+        name = 'onnx int8' if quantize else 'onnx fp32'
+        vectors = bench(name, OnnxBackend(quantize=quantize, threads=args.threads), windows, args.batch_size, args.rounds)
+        similarity = np.sum(vectors * reference, axis=1)
+        print(f"{'':>10}  cosine to torch: min {similarity.min():.4f}, mean {similarity.mean():.4f}")
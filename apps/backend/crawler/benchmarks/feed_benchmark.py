@@ -0,0 +1,69 @@
+"""
+Building the similar part of a feed one liked page at a time (`generate_feed_from_page` in a loop) against one batched
+search for all of them (`similar_to_pages`).
+
+    python -m crawler.benchmarks.feed_benchmark [--liked 20] [--feeds 20] [--seed 5000]
+
+Both go to Postgres ("PageCentroid"), by-url queries don't use the in-process index. `--seed` inserts that many
+synthetic pages with embeddings and centroids first (only do that on a scratch database).
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+from crawler.benchmarks.ann_benchmark import seed_pages
+from crawler.dbaccess import close_async_pool, get_pool
+from crawler.recommendation.embedding import (generate_feed_from_page,
+                                              similar_to_pages)
+
+
+async def one_by_one(urls: list[str]) -> dict[str, list[int]]:
+    return {url: [p.id for p in await generate_feed_from_page(url)] for url in urls}
+
+
+async def batched(urls: list[str]) -> dict[str, list[int]]:
+    feeds = await similar_to_pages(urls)
+    return {url: [p.id for p in feeds.get(url, [])] for url in urls}
+
+
+async def timed(fn, feeds: list[list[str]]) -> tuple[list[dict[str, list[int]]], list[float]]:
+    results, latencies = [], []
+    for urls in feeds:
+        start = time.perf_counter()
+        results.append(await fn(urls))
+        latencies.append(time.perf_counter() - start)
+    return results, latencies
+
+
+def report(name: str, latencies: list[float]):
+    q = statistics.quantiles(latencies, n=100)
+    print(f"{name:>10}: p50 {q[49] * 1000:7.1f} ms, p99 {q[98] * 1000:7.1f} ms")
+
+
+async def main(args):
+    if args.seed:
+        seed_pages(args.seed)
+
+    with get_pool().connection() as conn:
+        urls = [row[0] for row in conn.execute(
+            'SELECT url FROM "Page" JOIN "PageCentroid" ON page_id = id').fetchall()]
+    feeds = [random.sample(urls, min(args.liked, len(urls))) for _ in range(args.feeds)]
+
+    looped, looped_latencies = await timed(one_by_one, feeds)
+    batch, batch_latencies = await timed(batched, feeds)
+    await close_async_pool()
+
+    report('one by one', looped_latencies)
+    report('batched', batch_latencies)
+    same = [len(set(a[url]) & set(b[url])) / len(a[url]) for a, b in zip(looped, batch) for url in a if a[url]]
+    print(f"Overlap with one by one: {statistics.mean(same):.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--liked", type=int, default=20, help="liked pages per feed")
+    parser.add_argument("--feeds", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,55 @@
+"""
+Pages per second of the regex quality filter (`filters.text_stats`) against NLTK tokenization, on the parse fixtures.
+
+    python -m crawler.benchmarks.filter_benchmark [--rounds 50]
+
+Without the NLTK punkt data only the per-line Treebank tokenization is timed for NLTK, which is most of its cost.
+"""
+import argparse
+import time
+
+import nltk
+from nltk.tokenize import LineTokenizer, NLTKWordTokenizer
+
+from crawler import filters
+from crawler.link import Link
+from crawler.parse import parse_html
+from crawler.tests.test_parse import read_fixture
+
+FIXTURES = ['blog_post.html', 'long_essay.html', 'lethain_post.html', 'short_note.html', 'latin1_page.html']
+
+
+def treebank_by_line(text: str):
+    tokenizer = NLTKWordTokenizer()
+    return [tokenizer.tokenize(line) for line in LineTokenizer(blanklines='discard').tokenize(text)]
+
+
+def bench(name: str, fn, texts: list[str], rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            fn(text)
+    elapsed = time.perf_counter() - start
+    rate = rounds * len(texts) / elapsed
+    print(f"{name:>24}: {rate:10.0f} pages/s")
+    return rate
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    texts = []
+    for name in FIXTURES:
+        result, _ = parse_html(read_fixture(name), Link.from_url(f'https://example.com/{name}'), False)
+        if result is not None:
+            texts.append(result.content)
+
+    fast = bench('text_stats', filters.text_stats, texts, args.rounds)
+    try:
+        nltk.data.find('tokenizers/punkt_tab')
+        slow = bench('nltk', lambda t: (filters.tokenize_by_line(t), nltk.sent_tokenize(t)), texts, args.rounds)
+    except LookupError:
+        slow = bench('treebank by line', treebank_by_line, texts, args.rounds)
+    print(f"Speedup: {fast / slow:.1f}x")
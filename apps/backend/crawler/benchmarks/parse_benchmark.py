@@ -0,0 +1,95 @@
+"""
+Pages/sec of `parse_html` on the saved pages in crawler/tests/fixtures/pages, against the previous implementation that
+re-parsed the HTML for every step (ugc filter, trafilatura, og:title, link extraction).
+
+    python -m crawler.benchmarks.parse_benchmark [--rounds 20] [--pages DIR]
+"""
+import argparse
+import json
+import os
+import time
+
+import trafilatura
+from bs4 import BeautifulSoup
+from lxml import etree
+
+from crawler.link import Link
+from crawler.parse import (WHITELIST_DOMAINS, extract_links_from_markdown,
+                           parse_html)
+
+FIXTURE_DIR = os.path.join(os.path.dirname(
+    __file__), '..', 'tests', 'fixtures', 'pages')
+# Fixtures that have to be parsed as a specific site, e.g. to take the whitelisted link extraction path
+FIXTURE_URLS = {
+    'lethain_post.html': 'https://lethain.com/staff-archetypes/',
+}
+
+
+def fixture_link(name: str) -> Link:
+    return Link.from_url(FIXTURE_URLS.get(name, f'https://example.com/{name}'))
+
+
+def legacy_parse_html(html: bytes, link: Link):
+    """The old parse path, kept here only to compare against"""
+    tree = etree.HTML(html)
+    for a in tree.xpath("//a[@rel='ugc' or @rel='sponsored' or @rel='nofollow']"):
+        a.attrib.pop('href', None)
+    html = etree.tostring(tree, encoding='unicode')
+
+    content = trafilatura.extract(html, url=link.url, include_links=True, include_tables=False, include_comments=False, include_images=False, output_format='json',
+                                  with_metadata=True, favor_precision=True)
+    if content is None:
+        return None
+    content = json.loads(content)
+
+    if link.raw_domain() in WHITELIST_DOMAINS:
+        soup = BeautifulSoup(html, 'lxml')
+        links = [link.create_child_link(a.text, a.get('href'))
+                 for a in soup.find_all('a')]
+    else:
+        links = extract_links_from_markdown(content["text"], link)
+
+    soup = BeautifulSoup(html, 'lxml')
+    title = soup.find("meta", property="og:title")
+    title = title.get("content") if title else soup.find('title')
+    return content, links, title
+
+
+def bench(name: str, parse, pages: list[tuple[bytes, Link]], rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for html, link in pages:
+            parse(html, link)
+    elapsed = time.perf_counter() - start
+    pages_per_sec = rounds * len(pages) / elapsed
+    print(f"{name:>8}: {pages_per_sec:8.1f} pages/sec ({elapsed:.2f}s)")
+    return pages_per_sec
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--pages", default=FIXTURE_DIR,
+                        help="Directory of saved .html pages")
+    args = parser.parse_args()
+
+    pages = []
+    for name in sorted(os.listdir(args.pages)):
+        if name.endswith('.html'):
+            with open(os.path.join(args.pages, name), 'rb') as f:
+                pages.append((f.read(), fixture_link(name)))
+    print(f"{len(pages)} pages, {args.rounds} rounds")
+
+    # Warm up imports and trafilatura's caches
+    for html, link in pages:
+        legacy_parse_html(html, link)
+        parse_html(html, link, False)
+
+    before = bench("legacy", legacy_parse_html, pages, args.rounds)
+    after = bench("current", lambda html, link: parse_html(
+        html, link, False), pages, args.rounds)
+    print(f"Speedup: {after / before:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
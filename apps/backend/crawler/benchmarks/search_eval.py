@@ -0,0 +1,100 @@
+"""
+Offline evaluation of /search text retrieval: recall and latency of full-text search (ts_rank in Postgres, and the BM25
+index when BM25_INDEX_DIR has one), the vector branch, and their RRF fusion in `hybrid_search`.
+
+    python -m crawler.benchmarks.search_eval [--queries queries.jsonl] [--sample 100] [--k 10]
+
+`--queries` is a JSON lines file of `{"query": "...", "relevant": ["https://...", ...]}`. Without it, `--sample` pages
+are picked at random and each page's title is a query whose only relevant page is the page itself (known-item search).
+Recall@k is the share of a query's relevant pages in the top k, averaged over the queries.
+
+The branches are timed on their own without a deadline, and the count of queries over FTS_TIMEOUT_SECONDS /
+VECTOR_TIMEOUT_SECONDS shows how often `hybrid_search` would leave that branch out. The hybrid row runs with the
+deadlines, like /search.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from crawler.dbaccess import close_async_pool, get_pool
+from crawler.recommendation import ann_index, bm25_index, hybrid_search
+from crawler.recommendation.embedding import NearestNeighboursQuery
+from crawler.worker import get_window_avg
+
+
+def load_queries(path: str) -> list[tuple[str, set[str]]]:
+    with open(path) as f:
+        return [(q['query'], set(q['relevant'])) for q in map(json.loads, f) if q['relevant']]
+
+
+def sample_queries(n: int) -> list[tuple[str, set[str]]]:
+    with get_pool().connection() as conn:
+        rows = conn.execute('''SELECT title, url FROM "Page" p JOIN "PageCentroid" c ON c.page_id = p.id
+                               WHERE length(title) > 10 ORDER BY random() LIMIT %s''', (n,)).fetchall()
+    return [(title, {url}) for title, url in rows]
+
+
+async def evaluate(name: str, search, queries: list[tuple[str, NearestNeighboursQuery, set[str]]], k: int,
+                   deadline: float = 0):
+    recalls, latencies = [], []
+    for text, query, relevant in queries:
+        start = time.perf_counter()
+        results = await search(text, query)
+        latencies.append(time.perf_counter() - start)
+        recalls.append(len({p.url for p in results[:k]} & relevant) / len(relevant))
+
+    q = statistics.quantiles(latencies, n=100)
+    line = (f"{name:>7}: recall@{k} {statistics.mean(recalls):.3f}, p50 {q[49] * 1000:7.1f} ms, "
+            f"p99 {q[98] * 1000:7.1f} ms")
+    if deadline:
+        line += f", {sum(t > deadline for t in latencies)} over {deadline * 1000:.0f} ms"
+    print(line)
+
+
+async def ts_rank(text: str, _):
+    # The pool's statement_timeout instead of the branch deadline, to see how long it takes
+    return await hybrid_search.postgres_fts_branch(text, timeout=60)
+
+
+async def bm25(text: str, _):
+    return await hybrid_search.bm25_branch(bm25_index.get_index(), text)
+
+
+async def vector(_, query: NearestNeighboursQuery):
+    return await hybrid_search.vector_branch(query)
+
+
+async def hybrid(_, query: NearestNeighboursQuery):
+    results, _ = await hybrid_search.hybrid_search(query)
+    return results
+
+
+async def main(args):
+    await ann_index.startup()
+    await bm25_index.startup()
+    labelled = load_queries(args.queries) if args.queries else sample_queries(args.sample)
+    print(f"{len(labelled)} queries")
+    # Embedding the query is the same for every row, and cached by /search, so it's left out of the timings
+    queries = [(text, NearestNeighboursQuery(vector=get_window_avg(text), text_query=text), relevant)
+               for text, relevant in labelled]
+
+    await evaluate('ts_rank', ts_rank, queries, args.k, hybrid_search.DEFAULT_FTS_TIMEOUT_SECONDS)
+    if bm25_index.get_index() is not None:
+        await evaluate('bm25', bm25, queries, args.k, hybrid_search.DEFAULT_FTS_TIMEOUT_SECONDS)
+    await evaluate('vector', vector, queries, args.k, hybrid_search.DEFAULT_VECTOR_TIMEOUT_SECONDS)
+    await evaluate('hybrid', hybrid, queries, args.k)
+    print(f"Branches left out of hybrid: {hybrid_search.stats}")
+
+    await ann_index.shutdown()
+    await bm25_index.shutdown()
+    await close_async_pool()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queries", help="JSON lines of {query, relevant}")
+    parser.add_argument("--sample", type=int, default=100, help="known-item queries from page titles")
+    parser.add_argument("--k", type=int, default=10)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,64 @@
+"""
+Checks per second of `is_suppressed` against the old linear scan over SUPPRESSED_DOMAINS, on synthetic urls. Also
+verifies both give the same answer for every url.
+
+    python -m crawler.benchmarks.suppressed_benchmark [--urls 1000000]
+"""
+import argparse
+import random
+import time
+
+from crawler.link import SUPPRESSED_DOMAINS, is_suppressed
+
+HOSTS = ['example.com', 'blog.example.org', 'www.paulgraham.com', 'danluu.com', 'news.ycombinator.com',
+         'substack.com', 'medium.com', 'github.com', 'lethain.com', 'hypertext.joodaloop.com']
+WORDS = ['posts', 'essays', '2023', 'notes', 'on-writing', 'search', 'index.html', 'tags', 'about', 'p', 'archive']
+
+
+def synthetic_urls(count: int, suppressed_ratio: float = 0.1) -> list[str]:
+    rng = random.Random(0)
+    suppressed = sorted(SUPPRESSED_DOMAINS)
+    urls = []
+    for _ in range(count):
+        path = '/'.join(rng.choice(WORDS) for _ in range(rng.randint(1, 5)))
+        if rng.random() < suppressed_ratio:
+            host = rng.choice(suppressed).removeprefix(
+                'https://').removeprefix('http://').rstrip('/')
+        else:
+            host = rng.choice(HOSTS)
+        urls.append(f'https://{host}/{path}')
+    return urls
+
+
+def linear_scan(url: str) -> bool:
+    for suppressed in SUPPRESSED_DOMAINS:
+        if suppressed in url:
+            return True
+    return False
+
+
+def bench(name: str, check, urls: list[str]) -> tuple[float, list[bool]]:
+    start = time.perf_counter()
+    results = [check(url) for url in urls]
+    elapsed = time.perf_counter() - start
+    print(f"{name:>8}: {len(urls) / elapsed:12.0f} urls/sec ({elapsed:.2f}s)")
+    return elapsed, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--urls", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    urls = synthetic_urls(args.urls)
+    print(f"{len(urls)} urls, {len(SUPPRESSED_DOMAINS)} suppressed domains")
+
+    before, expected = bench("linear", linear_scan, urls)
+    after, actual = bench("matcher", is_suppressed, urls)
+
+    mismatches = sum(a != b for a, b in zip(expected, actual))
+    print(f"Speedup: {before / after:.1f}x, {sum(actual)} suppressed, {mismatches} mismatches")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import math
+from typing import Iterable
+
+import mmh3
+
+
+class BloomFilter:
+    """
+    Fixed size Bloom filter over strings. `add` and `__contains__` never miss a key that was added, and wrongly report
+    an unseen key as present with probability `error_rate` once `capacity` keys are in.
+    """
+    capacity: int
+    error_rate: float
+    num_bits: int
+    num_hashes: int
+    count: int
+    _bits: bytearray
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, math.ceil(-capacity *
+                            math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key: str) -> list[int]:
+        # Double hashing: the two halves of one 128-bit murmur hash stand in for k independent hashes
+        h1, h2 = mmh3.hash64(key, signed=False)
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key: str) -> bool:
+        """Add `key`, returning `False` if it was (probably) already present"""
+        added = False
+        for p in self._positions(key):
+            byte, bit = p >> 3, 1 << (p & 7)
+            if not self._bits[byte] & bit:
+                self._bits[byte] |= bit
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+
+class ScalableBloomFilter:
+    """
+    Bloom filter that grows: once the current filter holds `capacity` keys a new one twice the size is started, with a
+    tighter error rate so the overall false positive rate stays below `error_rate`.
+    """
+    error_rate: float
+    _filters: list[BloomFilter]
+
+    GROWTH = 2
+    TIGHTENING = 0.5
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.error_rate = error_rate
+        self._filters = [BloomFilter(capacity, error_rate * self.TIGHTENING)]
+
+    def __len__(self):
+        return sum(f.count for f in self._filters)
+
+    def __contains__(self, key: str) -> bool:
+        return any(key in f for f in self._filters)
+
+    def add(self, key: str) -> bool:
+        """Add `key`, returning `False` if it was (probably) already present"""
+        if key in self:
+            return False
+
+        current = self._filters[-1]
+        if current.count >= current.capacity:
+            current = BloomFilter(current.capacity * self.GROWTH,
+                                  current.error_rate * self.TIGHTENING)
+            self._filters.append(current)
+        return current.add(key)
+
+    def update(self, keys: Iterable[str]) -> int:
+        return sum(self.add(key) for key in keys)
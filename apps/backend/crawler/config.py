@@ -1,10 +1,25 @@
 import argparse
+import os
 
 DEFAULT_MAX_LINKS_TO_CRAWL = 200000000
 DEFAULT_WORKERS = 8
 DEFAULT_DEBUG_WORKERS = 1
 DEFAULT_MAX_QUEUE_SIZE = 500  # maximum number of tasks to keep in the queue at once
 DEFAULT_MAX_CRAWL_DEPTH = 2
+DEFAULT_TASK_BATCH_SIZE = 16  # number of tasks a worker leases from the database at once
+DEFAULT_TASK_LOW_WATER_MARK = 4  # refill the worker's task buffer once it holds this many tasks or fewer
+DEFAULT_TASK_LEASE_SECONDS = 600  # tasks not finished within this time are handed out to another worker
+DEFAULT_FETCH_CONCURRENCY = 8  # in-flight HTTP requests per worker
+DEFAULT_PARSE_PROCESSES = os.cpu_count() or 1  # size of the process pool that parses and filters pages
+DEFAULT_PARSE_TIMEOUT = 30  # seconds a single page may take to parse before it is given up on
+DEFAULT_WRITE_BATCH_SIZE = 32  # maximum number of crawled pages written to the database per batch
+DEFAULT_WRITE_FLUSH_ROWS = 512  # buffered rows (pages, status changes, new tasks) that trigger a write to the database
+DEFAULT_WRITE_FLUSH_SECONDS = 5.0  # buffered rows are written at least this often
+DEFAULT_HOST_RATE = 1.0  # requests per second we send to any single host
+DEFAULT_MAX_DEFERRED_TASKS = 200  # leased tasks a worker may park while their host is throttled
+DEFAULT_MAX_BODY_BYTES = 5 * 1024 * 1024  # stop downloading pages larger than this
+DEFAULT_SEEN_URLS_CAPACITY = 10_000_000  # urls the seen-url Bloom filter is sized for before it grows
+DEFAULT_SEEN_URLS_ERROR_RATE = 0.001  # fraction of new urls wrongly dropped as already seen
 
 
 class Config():
@@ -13,8 +28,36 @@ class Config():
     num_workers: int
     max_queue_size: int
     max_crawl_depth: int
+    task_batch_size: int
+    task_low_water_mark: int
+    task_lease_seconds: int
+    fetch_concurrency: int
+    parse_processes: int
+    parse_timeout: float
+    write_batch_size: int
+    write_flush_rows: int
+    write_flush_seconds: float
+    host_rate: float
+    max_deferred_tasks: int
+    max_body_bytes: int
+    seen_urls_capacity: int
+    seen_urls_error_rate: float
 
     def __init__(self, empty=False):
+        self.task_batch_size = DEFAULT_TASK_BATCH_SIZE
+        self.task_low_water_mark = DEFAULT_TASK_LOW_WATER_MARK
+        self.task_lease_seconds = DEFAULT_TASK_LEASE_SECONDS
+        self.fetch_concurrency = DEFAULT_FETCH_CONCURRENCY
+        self.parse_processes = DEFAULT_PARSE_PROCESSES
+        self.parse_timeout = DEFAULT_PARSE_TIMEOUT
+        self.write_batch_size = DEFAULT_WRITE_BATCH_SIZE
+        self.write_flush_rows = DEFAULT_WRITE_FLUSH_ROWS
+        self.write_flush_seconds = DEFAULT_WRITE_FLUSH_SECONDS
+        self.host_rate = DEFAULT_HOST_RATE
+        self.max_deferred_tasks = DEFAULT_MAX_DEFERRED_TASKS
+        self.max_body_bytes = DEFAULT_MAX_BODY_BYTES
+        self.seen_urls_capacity = DEFAULT_SEEN_URLS_CAPACITY
+        self.seen_urls_error_rate = DEFAULT_SEEN_URLS_ERROR_RATE
         if empty:
             return
         parser = argparse.ArgumentParser(prog="python3 -m crawler.main")
@@ -24,6 +67,24 @@ class Config():
                             help="Runs the crawler with a single worker, slowly", default=False)
         parser.add_argument("--workers", type=int, help="The number of workers to use",
                             default=DEFAULT_WORKERS)
+        parser.add_argument("--task_batch_size", type=int, help="The number of tasks each worker leases at once",
+                            default=DEFAULT_TASK_BATCH_SIZE)
+        parser.add_argument("--fetch_concurrency", type=int, help="The number of in-flight requests per worker",
+                            default=DEFAULT_FETCH_CONCURRENCY)
+        parser.add_argument("--parse_processes", type=int, help="The number of processes used to parse pages",
+                            default=DEFAULT_PARSE_PROCESSES)
+        parser.add_argument("--parse_timeout", type=float, help="Seconds a single page may take to parse",
+                            default=DEFAULT_PARSE_TIMEOUT)
+        parser.add_argument("--write_batch_size", type=int, help="The maximum number of pages written to the database at once",
+                            default=DEFAULT_WRITE_BATCH_SIZE)
+        parser.add_argument("--write_flush_rows", type=int, help="The number of buffered rows that triggers a write to the database",
+                            default=DEFAULT_WRITE_FLUSH_ROWS)
+        parser.add_argument("--write_flush_seconds", type=float, help="The maximum number of seconds rows stay buffered before they are written",
+                            default=DEFAULT_WRITE_FLUSH_SECONDS)
+        parser.add_argument("--host_rate", type=float, help="The maximum number of requests per second sent to a single host",
+                            default=DEFAULT_HOST_RATE)
+        parser.add_argument("--max_body_bytes", type=int, help="Stop downloading a page once it is larger than this",
+                            default=DEFAULT_MAX_BODY_BYTES)
 
         max_links = parser.parse_args().max_links
         should_debug = parser.parse_args().debug
@@ -32,6 +93,15 @@ class Config():
         self.max_links = max_links
         self.max_queue_size = DEFAULT_MAX_QUEUE_SIZE
         self.max_crawl_depth = DEFAULT_MAX_CRAWL_DEPTH
+        self.task_batch_size = parser.parse_args().task_batch_size
+        self.fetch_concurrency = parser.parse_args().fetch_concurrency
+        self.parse_processes = parser.parse_args().parse_processes
+        self.parse_timeout = parser.parse_args().parse_timeout
+        self.write_batch_size = parser.parse_args().write_batch_size
+        self.write_flush_rows = parser.parse_args().write_flush_rows
+        self.write_flush_seconds = parser.parse_args().write_flush_seconds
+        self.host_rate = parser.parse_args().host_rate
+        self.max_body_bytes = parser.parse_args().max_body_bytes
 
         num_workers = DEFAULT_DEBUG_WORKERS if self.should_debug else parser.parse_args().workers
         self.num_workers = num_workers
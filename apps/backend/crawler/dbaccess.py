@@ -1,37 +1,164 @@
+"""
+Postgres connection pools.
+
+`get_pool()` is the process-wide `ConnectionPool` for synchronous code (crawler workers, `PostgresClient`, the
+embedding queries) and `get_async_pool()` its `AsyncConnectionPool` counterpart for the API. Check a connection out
+for each task or request with `with get_pool().connection() as conn:`. The block commits when it exits cleanly, rolls
+back if it raises, and gives the connection back to the pool. Every connection gets a `statement_timeout`, so one bad
+query from the API or the crawler can't hold a connection forever, and `ivfflat.probes` (DB_IVFFLAT_PROBES) for the
+vector indexes.
+
+Call `open_async_pool()` once the event loop is running and `close_async_pool()` before it stops, like `http_client`.
+
+Offline jobs run statements that take longer than that. `db` is kept for one-off scripts that want a single long-lived
+connection: it is a connection of its own, without a `statement_timeout`. Scripts that go through the pools instead
+(`PostgresClient`, the index builds) call `disable_statement_timeout()` first.
+"""
 import os
+from typing import Optional
+
 import psycopg
 from dotenv import load_dotenv
-from psycopg import Connection
+from psycopg import AsyncConnection, Connection
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
 
 load_dotenv()
 
+DEFAULT_POOL_MIN_SIZE = 2
+DEFAULT_POOL_MAX_SIZE = 10
+DEFAULT_POOL_TIMEOUT = 30  # seconds to wait for a free connection before giving up
+DEFAULT_STATEMENT_TIMEOUT_MS = 60_000
+# Lists of the ivfflat indexes (Embeddings, PageCentroid: lists = 100) a vector query scans. pgvector's default of 1 misses
+# a good share of the true nearest neighbours, sqrt(lists) is its recommendation
+DEFAULT_IVFFLAT_PROBES = 10
+
+_pool: Optional[ConnectionPool] = None
+_async_pool: Optional[AsyncConnectionPool] = None
+_statement_timeout_disabled = False
+
+
+def _pool_kwargs() -> dict:
+    return dict(
+        conninfo=os.environ['DATABASE_URL_PG'],
+        min_size=int(os.environ.get('DB_POOL_MIN_SIZE', DEFAULT_POOL_MIN_SIZE)),
+        max_size=int(os.environ.get('DB_POOL_MAX_SIZE', DEFAULT_POOL_MAX_SIZE)),
+        timeout=DEFAULT_POOL_TIMEOUT,
+    )
+
+
+def _statement_timeout() -> str:
+    if _statement_timeout_disabled:
+        return '0'
+    return str(int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', DEFAULT_STATEMENT_TIMEOUT_MS)))
+
+
+def disable_statement_timeout():
+    """For offline jobs: the pools' connections get no `statement_timeout`. Call before the first query"""
+    global _statement_timeout_disabled
+    assert _pool is None and _async_pool is None, "Call disable_statement_timeout() before opening a pool"
+    _statement_timeout_disabled = True
+
+
+def _ivfflat_probes() -> str:
+    return str(int(os.environ.get('DB_IVFFLAT_PROBES', DEFAULT_IVFFLAT_PROBES)))
+
+
+def _configure(conn: Connection):
+    # SET can't take a bound parameter, set_config can. Commit so the connection goes back to the pool idle
+    conn.execute("SELECT set_config('statement_timeout', %s, false)", (_statement_timeout(),))
+    conn.execute("SELECT set_config('ivfflat.probes', %s, false)", (_ivfflat_probes(),))
+    conn.commit()
+
+
+async def _configure_async(conn: AsyncConnection):
+    await conn.execute("SELECT set_config('statement_timeout', %s, false)", (_statement_timeout(),))
+    await conn.execute("SELECT set_config('ivfflat.probes', %s, false)", (_ivfflat_probes(),))
+    await conn.commit()
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        _pool = ConnectionPool(**_pool_kwargs(), configure=_configure,
+                               name="sync", open=True)
+    return _pool
+
+
+def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+
+
+async def open_async_pool() -> AsyncConnectionPool:
+    global _async_pool
+    if _async_pool is None:
+        _async_pool = AsyncConnectionPool(**_pool_kwargs(), configure=_configure_async,
+                                          name="async", open=False)
+        await _async_pool.open()
+    return _async_pool
+
+
+async def close_async_pool():
+    global _async_pool
+    if _async_pool is not None:
+        await _async_pool.close()
+        _async_pool = None
+
+
+async def get_async_pool() -> AsyncConnectionPool:
+    """Returns the async pool, opening it with the default size if `open_async_pool()` has not been called"""
+    return await open_async_pool()
+
+
+def pool_stats() -> dict[str, dict[str, int]]:
+    """Counters of both pools (connections in use, waiting requests, timeouts...), see `ConnectionPool.get_stats`"""
+    stats = {}
+    for pool in (_pool, _async_pool):
+        if pool is not None:
+            stats[pool.name] = pool.get_stats()
+    return stats
+
 
 class DB:
-    db: Connection
+    """
+    A single connection of its own for as long as the script runs. It has no `statement_timeout` unless given one, in
+    milliseconds
+    """
+    db: Optional[Connection]
+    statement_timeout: Optional[int]
 
-    def __init__(self):
+    def __init__(self, statement_timeout: Optional[int] = None):
         self.db = None
+        self.statement_timeout = statement_timeout
 
     def connect(self):
-        self.db = psycopg.connect(os.environ['DATABASE_URL_PG'])
-
-    def transaction(self, *args, **kwargs):
         if self.db is None:
-            self.connect()
+            self.db = psycopg.connect(os.environ['DATABASE_URL_PG'])
+            if self.statement_timeout is not None:
+                self.db.execute("SELECT set_config('statement_timeout', %s, false)", (str(self.statement_timeout),))
+            self.db.execute("SELECT set_config('ivfflat.probes', %s, false)", (_ivfflat_probes(),))
+            self.db.commit()
 
+    def transaction(self, *args, **kwargs):
+        self.connect()
         return self.db.transaction(*args, **kwargs)
 
     def cursor(self, *args, **kwargs):
-        if self.db is None:
-            self.connect()
-
+        self.connect()
         return self.db.cursor(*args, **kwargs)
 
     def commit(self):
         self.db.commit()
 
+    def rollback(self):
+        self.db.rollback()
+
     def close(self):
-        self.db.close()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
 
 
 db = DB()
@@ -1,15 +1,87 @@
 import re
-from typing import Tuple, List
+from typing import NamedTuple, Tuple, List
 
 from nltk import sent_tokenize, word_tokenize, LineTokenizer
 from crawler.constants.whitelist import WHITELIST_DOMAINS
 
+from crawler.link import Link
 from crawler.parse import CrawlResult
 
+MIN_WORDS = 300
+MIN_SENTENCES = 12
+MIN_LINE_WORDS = 8
+
+# Approximates NLTK's Treebank word tokenizer (which `word_tokenize` uses after splitting sentences) in one regex
+_TOKEN = re.compile(r"""
+    (?:[A-Za-z]\.){2,}(?=\s|$)      # acronyms keep their periods: U.S.
+  | [A-Za-z]+(?=n't\b)              # "do" of "don't"
+  | n't\b
+  | '(?:s|m|d|ll|re|ve)\b           # clitics are split off
+  | \w+(?:[-.,/:&]\w+)*             # words, numbers, hyphenated words
+  | \.\.\.|--
+  | [^\w\s]                         # any other punctuation is a token on its own
+""", re.X | re.I)
+
+# Candidate sentence ends: the word before, the terminator, and the first character of the next sentence
+_SENTENCE_END = re.compile(r"""(?<!\S)(\S*?)([.!?]+)["'\u201d\u2019)\]]*(?=\s+(\S))""")
+_ABBREVIATIONS = frozenset({'mr', 'mrs', 'ms', 'dr', 'prof', 'st', 'vs', 'etc', 'e.g', 'i.e', 'inc', 'jr', 'sr',
+                            'no', 'fig', 'u.s', 'approx', 'cf', 'al', 'jan', 'feb', 'aug', 'sept', 'oct', 'nov', 'dec'})
+
+_COMMENT_URL = re.compile(r'.*\/comments?(\/|\Z)')
+
+
+class TextStats(NamedTuple):
+    line_lengths: List[int]  # Tokens on each non-blank line
+    num_words: int  # Tokens on lines with at least MIN_LINE_WORDS tokens
+    total_word_length: int  # Characters in those tokens
+    num_sentences: int
+
+
+def is_comment_url(url: str) -> bool:
+    return bool(_COMMENT_URL.match(url))
+
 
 def is_comment_page(crawl: CrawlResult) -> bool:
-    regex = r'.*\/comments?(\/|\Z)'
-    return bool(re.match(regex, crawl.link.url))
+    return is_comment_url(crawl.link.url)
+
+
+def count_sentences(text: str) -> int:
+    """Approximates the number of sentences NLTK's punkt tokenizer finds"""
+    if not text.strip():
+        return 0
+
+    sentences = 1
+    for match in _SENTENCE_END.finditer(text):
+        previous, terminator, following = match.groups()
+        if '.' not in terminator:
+            sentences += 1
+            continue
+
+        previous = previous.lower().strip('(["\'').rstrip('.')
+        if previous in _ABBREVIATIONS or (len(previous) == 1 and previous.isalpha()):
+            continue
+        # Punkt does not break before a lowercase word
+        if following[0].islower():
+            continue
+        sentences += 1
+    return sentences
+
+
+def text_stats(text: str) -> TextStats:
+    """The statistics `should_keep` needs, computed with compiled regexes instead of NLTK"""
+    line_lengths = []
+    num_words = 0
+    total_word_length = 0
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        tokens = _TOKEN.findall(line)
+        line_lengths.append(len(tokens))
+        if len(tokens) >= MIN_LINE_WORDS:
+            num_words += len(tokens)
+            total_word_length += sum(map(len, tokens))
+
+    return TextStats(line_lengths, num_words, total_word_length, count_sentences(text))
 
 
 def tokenize_by_line(text: str) -> Tuple[List[str], List[int]]:
@@ -48,6 +120,18 @@ def filter_by_line_length(lengths: List[int]) -> bool:
     return not (sum(int(length >= THRESHOLD) for length in lengths) / len(lengths) >= PERCENT_GREATER)
 
 
+def passes_thresholds(stats: TextStats) -> bool:
+    if filter_by_line_length(stats.line_lengths):
+        return False
+    if stats.num_words == 0 or stats.num_sentences == 0:
+        return False
+
+    avg_sent_len = stats.num_words / stats.num_sentences
+    avg_word_len = stats.total_word_length / stats.num_words
+
+    return stats.num_sentences >= MIN_SENTENCES and stats.num_words >= MIN_WORDS and avg_word_len > 3 and avg_sent_len >= 8 and avg_sent_len <= 100
+
+
 def should_keep(crawl: CrawlResult) -> bool:
     """Decide whether or not to keep a page after crawling it based on its content"""
     if crawl.link.raw_domain() in WHITELIST_DOMAINS:
@@ -56,16 +140,41 @@ def should_keep(crawl: CrawlResult) -> bool:
     if is_comment_page(crawl):
         return False
 
-    words, line_lengths = tokenize_by_line(crawl.content)
+    return passes_thresholds(text_stats(crawl.content))
+
 
-    if filter_by_line_length(line_lengths):
+def should_keep_nltk(crawl: CrawlResult) -> bool:
+    """The original NLTK implementation of `should_keep`, kept to check the fast path against"""
+    if crawl.link.raw_domain() in WHITELIST_DOMAINS:
+        return True
+
+    if is_comment_page(crawl):
         return False
 
+    words, line_lengths = tokenize_by_line(crawl.content)
     sentences = sent_tokenize(crawl.content)
-    avg_sent_len = len(words) / len(sentences)
-    avg_word_len = sum(len(word) for word in words) / len(words)
 
-    return len(sentences) >= 12 and len(words) >= 300 and avg_word_len > 3 and avg_sent_len >= 8 and avg_sent_len <= 100
+    return passes_thresholds(TextStats(line_lengths, len(words), sum(len(word) for word in words), len(sentences)))
+
+
+def might_keep(text: str, link: Link) -> bool:
+    """
+    Cheap check before extraction, on `parse.extractable_text` of the page: everything extraction could keep, with the
+    link targets it may add. Counted with the same tokenizer as `text_stats`, so a page that doesn't have MIN_WORDS
+    tokens even there would be filtered out afterwards anyway
+    """
+    if link.raw_domain() in WHITELIST_DOMAINS:
+        return True
+
+    if is_comment_url(link.url):
+        return False
+
+    count = 0
+    for _ in _TOKEN.finditer(text):
+        count += 1
+        if count >= MIN_WORDS:
+            return True
+    return False
 
 
 def test_2():
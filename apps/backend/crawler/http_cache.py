@@ -0,0 +1,221 @@
+"""
+On-disk HTTP cache for the crawler. For every page that came with validators (ETag / Last-Modified) we keep the
+validators, the zlib-compressed body and the parsed `CrawlResult`, keyed by URL. The next fetch of that URL is sent as a
+conditional request, and a 304 hands back the cached `CrawlResult` so the page is not downloaded or parsed again.
+
+The cache is bounded by total size on disk and evicts the least recently used entries first. Several crawler processes
+may share the directory: each one keeps an index of the entries it knows of, and rescans the directory every
+RESCAN_INTERVAL seconds so the size limit and the LRU order (file mtimes) cover the entries of all of them. Between
+rescans the directory can go over the limit by what the other processes wrote in the meantime.
+
+Compression and file I/O of `get` and `put` run in the default executor, off the event loop.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+from dotenv import load_dotenv
+
+from .parse import CrawlResult
+
+load_dotenv()
+
+DEFAULT_CACHE_DIR = os.environ.get('HTTP_CACHE_DIR', '.http_cache')
+DEFAULT_MAX_BYTES = int(os.environ.get('HTTP_CACHE_MAX_BYTES', 2 ** 30))
+COMPRESSION_LEVEL = 6
+# How often (in seconds) the index is rebuilt from the directory, to pick up what other processes stored and evicted
+RESCAN_INTERVAL = 60
+# Reading an entry that was evicted by another process or is corrupt (a `CrawlResult` that doesn't validate is a
+# ValueError too): treated as a miss
+MISS_ERRORS = (OSError, ValueError, KeyError, zlib.error)
+
+
+class CacheEntry(NamedTuple):
+    url: str
+    etag: Optional[str]
+    last_modified: Optional[str]
+    body: bytes
+    result: Optional[CrawlResult]  # Not loaded when only the validators were asked for
+
+
+def validators_from_headers(headers) -> dict[str, str]:
+    """Pick the validators we need to revalidate a response later"""
+    validators = {}
+    if headers.get('ETag'):
+        validators['etag'] = headers['ETag']
+    if headers.get('Last-Modified'):
+        validators['last_modified'] = headers['Last-Modified']
+    return validators
+
+
+class HttpCache:
+    directory: str
+    max_bytes: int
+    total_bytes: int
+    # Cache key -> size on disk, least recently used first
+    _index: OrderedDict[str, int]
+    _last_scan: float
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        self._apply_scan(self._scan())
+        # The size limit may have been lowered since the last run
+        self._remove_files(self._evict())
+
+    def _scan(self) -> list[tuple[float, str, int]]:
+        """(mtime, key, size) of every entry in the directory, by any process, least recently used first"""
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.cache'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue  # Evicted while we were scanning
+                files.append((stat.st_mtime, entry.name[:-len('.cache')], stat.st_size))
+        files.sort()
+        return files
+
+    def _apply_scan(self, files: list[tuple[float, str, int]]):
+        self._index = OrderedDict((key, size) for _, key, size in files)
+        self.total_bytes = sum(self._index.values())
+        self._last_scan = time.monotonic()
+
+    @staticmethod
+    def _key(url: str) -> str:
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.cache')
+
+    def conditional_headers(self, url: str) -> dict[str, str]:
+        """Request headers that make the next fetch of `url` conditional on our cached copy"""
+        try:
+            meta = self._read(url, with_body=False)
+        except MISS_ERRORS:
+            self._forget(self._key(url))
+            return {}
+        if meta is None:
+            return {}
+
+        headers = {}
+        if meta.etag:
+            headers['If-None-Match'] = meta.etag
+        if meta.last_modified:
+            headers['If-Modified-Since'] = meta.last_modified
+        return headers
+
+    async def get(self, url: str) -> Optional[CacheEntry]:
+        try:
+            entry = await asyncio.get_running_loop().run_in_executor(None, self._read, url, True)
+        except MISS_ERRORS:
+            self._forget(self._key(url))
+            return None
+        if entry is not None:
+            self._touch(self._key(url))
+        return entry
+
+    async def put(self, url: str, body: bytes, result: CrawlResult, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        """
+        Store a fresh response with its parsed result. Responses without validators are not stored since they can't be
+        revalidated
+        """
+        if not etag and not last_modified:
+            return
+
+        loop = asyncio.get_running_loop()
+        key = self._key(url)
+        size = await loop.run_in_executor(None, self._write, key, url, body, result, etag, last_modified)
+        if time.monotonic() - self._last_scan >= RESCAN_INTERVAL:
+            self._apply_scan(await loop.run_in_executor(None, self._scan))
+        else:
+            self.total_bytes += size - self._index.pop(key, 0)
+            self._index[key] = size
+
+        evicted = self._evict()
+        if evicted:
+            await loop.run_in_executor(None, self._remove_files, evicted)
+
+    def _write(self, key: str, url: str, body: bytes, result: CrawlResult, etag: Optional[str], last_modified: Optional[str]) -> int:
+        """Compress and write an entry, returns its size on disk"""
+        compressed_body = zlib.compress(body, COMPRESSION_LEVEL)
+        compressed_result = zlib.compress(
+            result.json().encode('utf-8'), COMPRESSION_LEVEL)
+        meta = json.dumps({
+            'url': url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'stored_at': time.time(),
+            'body_length': len(compressed_body),
+        }).encode('utf-8')
+
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(meta + b'\n')
+            f.write(compressed_body)
+            f.write(compressed_result)
+        os.replace(tmp_path, path)
+        return len(meta) + 1 + len(compressed_body) + len(compressed_result)
+
+    def _read(self, url: str, with_body: bool) -> Optional[CacheEntry]:
+        """Raises one of MISS_ERRORS if the entry is gone or corrupt. Doesn't touch the index, it may run on a thread"""
+        # Not only the indexed keys: the entry may have been stored by another process since our last rescan
+        with open(self._path(self._key(url)), 'rb') as f:
+            meta = json.loads(f.readline())
+            if meta['url'] != url:
+                return None
+            if not with_body:
+                return CacheEntry(url, meta['etag'], meta['last_modified'], b'', None)
+
+            body = zlib.decompress(f.read(meta['body_length']))
+            result = CrawlResult.parse_raw(zlib.decompress(f.read()))
+        return CacheEntry(url, meta['etag'], meta['last_modified'], body, result)
+
+    def _touch(self, key: str):
+        if key in self._index:
+            self._index.move_to_end(key)
+        try:
+            os.utime(self._path(key))
+        except OSError:
+            pass
+
+    def _forget(self, key: str):
+        self.total_bytes -= self._index.pop(key, 0)
+
+    def _evict(self) -> list[str]:
+        """Drop least recently used entries from the index until it fits, returns their keys to remove from disk"""
+        evicted = []
+        while self.total_bytes > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self.total_bytes -= size
+            evicted.append(key)
+        return evicted
+
+    def _remove_files(self, keys: list[str]):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass  # Already evicted by another process
+
+
+_cache: Optional[HttpCache] = None
+
+
+def get_cache() -> HttpCache:
+    """The process-wide cache, created on first use"""
+    global _cache
+    if _cache is None:
+        _cache = HttpCache()
+    return _cache
@@ -0,0 +1,117 @@
+"""
+Process-wide HTTP client. Every request in the process (crawler workers, the API's interactive crawls) goes through
+one `ClientSession` and one tuned `TCPConnector`, so DNS lookups, TCP connections and TLS sessions are reused.
+
+Call `startup()` once the event loop is running and `shutdown()` before it stops.
+"""
+import importlib.util
+from typing import Optional
+
+from aiohttp import ClientResponse, ClientSession, ClientTimeout, TCPConnector
+
+from .config import DEFAULT_MAX_BODY_BYTES
+
+DEFAULT_CONNECTION_LIMIT = 100
+DEFAULT_CONNECTIONS_PER_HOST = 8
+DNS_CACHE_TTL = 5 * 60  # seconds
+KEEPALIVE_TIMEOUT = 30  # seconds an idle connection is kept open for reuse
+DEFAULT_TIMEOUT = ClientTimeout(total=20)
+
+# or else we get blocked by cloudflare sites
+CHROME_USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/116.0.0.0 Safari/537.36'
+
+_session: Optional[ClientSession] = None
+
+
+def _accept_encoding() -> str:
+    # aiohttp decodes brotli only if one of these packages is installed (`poetry install -E brotli`)
+    if importlib.util.find_spec('brotli') or importlib.util.find_spec('brotlicffi'):
+        return 'gzip, deflate, br'
+    return 'gzip, deflate'
+
+
+async def startup(limit: int = DEFAULT_CONNECTION_LIMIT, limit_per_host: int = DEFAULT_CONNECTIONS_PER_HOST):
+    global _session
+    if _session is not None and not _session.closed:
+        return
+
+    connector = TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        use_dns_cache=True,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+        enable_cleanup_closed=True,
+    )
+    _session = ClientSession(
+        connector=connector,
+        timeout=DEFAULT_TIMEOUT,
+        headers={
+            'User-Agent': CHROME_USER_AGENT,
+            'Accept-Encoding': _accept_encoding(),
+        },
+    )
+
+
+async def shutdown():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def get_session() -> ClientSession:
+    """Returns the shared session, creating it with the default limits if `startup()` has not been called"""
+    if _session is None or _session.closed:
+        await startup()
+    return _session
+
+
+# Anything else (PDFs, images, video, archives...) is skipped before the body is downloaded
+HTML_CONTENT_TYPES = {'text/html', 'application/xhtml+xml', 'text/plain'}
+# Magic numbers of binary formats that are sometimes served without a useful Content-Type
+BINARY_SIGNATURES = (b'%PDF', b'\x89PNG', b'\xff\xd8\xff', b'GIF8', b'PK\x03\x04', b'\x1f\x8b', b'RIFF', b'OggS')
+CHUNK_SIZE = 64 * 1024
+
+
+def is_html_content_type(content_type: Optional[str]) -> bool:
+    """Whether a Content-Type header is worth downloading. A missing header is allowed and sniffed instead"""
+    if not content_type:
+        return True
+    mime_type = content_type.split(';', 1)[0].strip().lower()
+    return mime_type in HTML_CONTENT_TYPES or mime_type == 'application/octet-stream'
+
+
+def looks_binary(chunk: bytes) -> bool:
+    return chunk.startswith(BINARY_SIGNATURES) or b'\x00' in chunk[:1024]
+
+
+async def read_capped(response: ClientResponse, max_bytes: int) -> Optional[bytes]:
+    """
+    Stream the body of `response`, giving up as soon as we know it is not a page we can parse: a binary Content-Type, a
+    Content-Length over `max_bytes`, binary-looking first bytes, or more than `max_bytes` actually received.
+    """
+    if not is_html_content_type(response.headers.get('Content-Type')):
+        print("Encountered unsupported content type, skipping",
+              response.headers.get('Content-Type'), response.url)
+        return None
+
+    if response.content_length is not None and response.content_length > max_bytes:
+        print("Encountered body too large, skipping",
+              response.content_length, response.url)
+        return None
+
+    chunks = []
+    received = 0
+    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+        if received == 0 and looks_binary(chunk):
+            print("Encountered binary body, skipping", response.url)
+            return None
+
+        received += len(chunk)
+        if received > max_bytes:
+            print(f"Encountered body over {max_bytes} bytes, skipping", response.url)
+            return None
+        chunks.append(chunk)
+
+    return b''.join(chunks)
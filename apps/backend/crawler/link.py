@@ -1,10 +1,13 @@
+import functools
 import re
 from typing import Optional
-from urllib.parse import urlparse, urlunparse
+from urllib.parse import SplitResult, urlparse, urlsplit, urlunparse
 
 import validators
 from pydantic import BaseModel, validator
 
+from .matcher import SubstringMatcher
+
 SUPPRESSED_DOMAINS = {"wikipedia.org", "amazon.",  "twitter.com", "facebook.com", "reddit.com",
                       "instagram.com", 'google.com/patent', 'wikimedia.org', 'https://t.co', 'amzn.to',
                       'codeforces.com', 'tandfonline.com', 'wiley.com', 'oup.com', 'sagepub.com', 'sexbuzz.com',
@@ -188,8 +191,24 @@ SUPPRESSED_DOMAINS = {"wikipedia.org", "amazon.",  "twitter.com", "facebook.com"
                       'actexpo.com',
                       'bmj.com'}
 
+# Compiled once. Anything that checks a url against SUPPRESSED_DOMAINS should go through `is_suppressed`
+SUPPRESSED_MATCHER = SubstringMatcher(SUPPRESSED_DOMAINS)
+
+
+def is_suppressed(url: str) -> bool:
+    """Whether `url` contains any of the SUPPRESSED_DOMAINS"""
+    return SUPPRESSED_MATCHER.matches(url)
+
 UNSUPPORTED_EXTENSIONS = {'.pdf', '.doc', '.docx', '.ppt', '.pptx',
                           '.xls', '.xlsx', '.zip', '.rar', '.7z', '.gz', '.png', '.jpg', '.jpeg', }
+_UNSUPPORTED_EXTENSIONS = tuple(UNSUPPORTED_EXTENSIONS)
+
+# Query parameters that only identify where a click came from. Dropped so the same page isn't crawled once per campaign
+TRACKING_PARAMS = {'fbclid', 'gclid', 'dclid', 'gbraid', 'wbraid', 'msclkid', 'yclid', 'twclid', 'igshid', 'mc_cid',
+                   'mc_eid', '_hsenc', '_hsmi', 'mkt_tok', 'ref_src', 'ref_url', 's_kwcid', 'vero_id', 'oly_anon_id',
+                   'oly_enc_id', 'rb_clickid', '_ga', '_gl', 'spm'}
+TRACKING_PARAM_PREFIXES = ('utm_', 'pk_', 'mtm_')
+DEFAULT_PORTS = {'http': '80', 'https': '443'}
 
 emoj = re.compile("["
                   u"\U0001F600-\U0001F64F"  # emoticons
@@ -229,12 +248,59 @@ def is_valid_url(url: str) -> bool:
     return True
 
 
+@functools.lru_cache(maxsize=2 ** 16)
+def _is_valid_url_cached(url: str) -> bool:
+    # Navigation links repeat on every page of a site
+    return is_valid_url(url)
+
+
+def normalize_url(url: str) -> str:
+    """Same result as `clean_url`, but urls without anything to clean (the vast majority) are not parsed"""
+    if '#' in url or ';' in url or '?' in url:
+        return clean_url(url)
+    # Valid urls start with the scheme and //
+    parts = url.split('/', 3)
+    if len(parts) < 3:
+        return clean_url(url)
+    host = parts[2]
+    if ':' in host or '@' in host or host != host.lower():
+        return clean_url(url)
+    return url
+
+
+def _is_tracking_param(name: str) -> bool:
+    name = name.lower()
+    return name in TRACKING_PARAMS or name.startswith(TRACKING_PARAM_PREFIXES)
+
+
+def strip_tracking_params(query: str) -> str:
+    """Drop analytics parameters from a query string, leaving the other parameters exactly as they were"""
+    if not query:
+        return query
+    params = query.split('&')
+    kept = [p for p in params if p and not _is_tracking_param(p.split('=', 1)[0])]
+    if len(kept) == len(params):
+        return query
+    return '&'.join(kept)
+
+
 def clean_url(url: str):
-    """Removes hashtags from a URL"""
+    """
+    Canonical form of a url we crawl: no fragment, no tracking parameters, a lowercase host and no default port.
+    Variants that only differ in scheme, `www.` or a trailing slash are caught by `canonical_key` instead, since we
+    can't know which of them the server actually answers on.
+    """
     parsed_url = urlparse(url)
 
-    # Remove hashtags and query parameters
-    cleaned_url_parts = parsed_url._replace(fragment='')
+    userinfo, at, host = parsed_url.netloc.rpartition('@')
+    host = host.lower()
+    name, colon, port = host.rpartition(':')
+    if colon and DEFAULT_PORTS.get(parsed_url.scheme) == port:
+        host = name
+
+    # Remove hashtags and tracking parameters
+    cleaned_url_parts = parsed_url._replace(
+        netloc=userinfo + at + host, query=strip_tracking_params(parsed_url.query), fragment='')
 
     # Reconstruct the cleaned URL
     cleaned_url = urlunparse(cleaned_url_parts)
@@ -242,6 +308,23 @@ def clean_url(url: str):
     return cleaned_url
 
 
+def canonical_key(url: str) -> str:
+    """
+    Identity of a page for deduplication: the cleaned url without the scheme, `www.` and trailing slashes, with the
+    remaining query parameters sorted. `http://www.a.com/post/?utm_source=x` and `https://a.com/post` share a key.
+    """
+    parts = urlsplit(normalize_url(url))
+
+    host = parts.netloc
+    if host.startswith("www."):
+        host = host[4:]
+
+    key = host + parts.path.rstrip('/')
+    if parts.query:
+        key += '?' + '&'.join(sorted(parts.query.split('&')))
+    return key
+
+
 def get_domain(url: str):
     parsed_url = urlparse(url)
 
@@ -251,6 +334,65 @@ def get_domain(url: str):
     return new_url
 
 
+@functools.lru_cache(maxsize=2 ** 14)
+def _split_url(url: str) -> SplitResult:
+    return urlsplit(url)
+
+
+def _domain(parts: SplitResult) -> str:
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def _raw_domain(parts: SplitResult) -> str:
+    # Remove www from the domain if it exists
+    if parts.netloc.startswith("www."):
+        return parts.netloc[4:]
+    return parts.netloc
+
+
+def resolve_child_url(parent_url: str, parent_domain: str, url: Optional[str]) -> Optional[str]:
+    """
+    Resolve an href found on `parent_url` into the cleaned url of a link we may crawl, or `None` if it is unsupported,
+    invalid or suppressed. Each url is validated once, where building a `Link` used to validate it twice.
+    """
+    if url is None:
+        return None
+    # Disallow links that are too long. This breaks the PostgreSQL index on the url column
+    if len(url) > 2000:
+        print(f"Link too long: {url}")
+        return None
+    # TODO: Add support for .pdf files
+    if url.endswith(_UNSUPPORTED_EXTENSIONS):
+        return None
+
+    if _is_valid_url_cached(url):
+        pass
+    elif url.startswith("#"):
+        # Ignore anchor links
+        return None
+    elif url.startswith("mailto:"):
+        # Ignore email links
+        return None
+    elif url.endswith(".onion"):
+        return None
+    else:
+        if url.startswith("//"):
+            url = "http:" + url
+        elif url.startswith('/'):
+            url = parent_domain + url
+        else:
+            url = parent_url + '/' + url
+        if not _is_valid_url_cached(url):
+            return None
+
+    url = normalize_url(url)
+
+    # Check if the url is one of the suppressed domains
+    if is_suppressed(url):
+        return None
+    return url
+
+
 class Link(BaseModel):
     raw: bool = False
     text: str
@@ -282,81 +424,102 @@ class Link(BaseModel):
         return v
 
     def domain(self) -> str:
-        # Parse the URL
-        parsed_url = urlparse(self.url)
-
-        # Create a new URL without the path
-        new_url = urlunparse(
-            (parsed_url.scheme, parsed_url.netloc, '', '', '', ''))
-        return new_url
+        return _domain(_split_url(self.url))
 
     def raw_domain(self) -> str:
         """Returns the domain without the scheme and www prefix"""
-        parsed_url = urlparse(self.url)
+        return _raw_domain(_split_url(self.url))
 
-        # Remove www from the domain if it exists
-        if parsed_url.netloc.startswith("www."):
-            return parsed_url.netloc[4:]
+    def create_child_link(self, text: Optional[str], url: Optional[str]) -> Optional['Link']:
+        url = resolve_child_url(self.url, self.domain(), url)
+        if url is None:
+            return None
+        # `resolve_child_url` already validated and cleaned the url
+        return Link.construct(text=str(text or ""), url=url, parent_url=self.url, depth=self.depth + 1, raw=False)
 
-        return parsed_url.netloc
+    def __hash__(self):
+        return (self.text,
+                self.url,
+                self.parent_url,
+                self.depth).__hash__()
 
-    def _create_child_link_inner(self, text: str, url: str):
-        # TODO: Add support for .pdf files
-        if any(url.endswith(ext) for ext in UNSUPPORTED_EXTENSIONS):
-            return None
 
-        if is_valid_url(url):
-            return Link(text=text, url=url, parent_url=self.url, depth=self.depth + 1)
-        elif url.startswith("#"):
-            # Ignore anchor links
-            return None
-        elif url.startswith("mailto:"):
-            # Ignore email links
-            return None
-        elif url.endswith(".onion"):
-            return None
-        elif url.startswith("//"):
-            url = "http:" + url
-            return Link(text=text, url=url, parent_url=self.url, depth=self.depth + 1)
-        elif url.startswith('/'):
-            url = self.domain() + url
-            return Link(text=text, url=url, parent_url=self.url, depth=self.depth + 1)
-        else:
-            url = self.url + '/' + url
-            return Link(text=text, url=url, parent_url=self.url, depth=self.depth + 1)
+class LinkRef:
+    """
+    Lightweight link for the bulk path: the outbound links of a page, from extraction until they are stored as tasks.
+    Its url is always already validated and cleaned, so unlike `Link` nothing is checked on construction, and the parsed
+    url is cached. Use `Link` at API boundaries and `to_link()` to convert.
+    """
+    __slots__ = ('text', 'url', 'parent_url', 'depth', '_parts')
 
-    def create_child_link(self, text: Optional[str], url: Optional[str]) -> Optional['Link']:
+    text: str
+    url: str
+    parent_url: Optional[str]
+    depth: int
+
+    def __init__(self, text: str, url: str, parent_url: Optional[str] = None, depth: int = 0):
+        self.text = text
+        self.url = url
+        self.parent_url = parent_url
+        self.depth = depth
+        self._parts = None
+
+    @classmethod
+    def from_link(cls, link: Link) -> 'LinkRef':
+        return cls(link.text, link.url, link.parent_url, link.depth)
+
+    def to_link(self) -> Link:
+        return Link.construct(text=self.text, url=self.url, parent_url=self.parent_url, depth=self.depth, raw=False)
+
+    @property
+    def parts(self) -> SplitResult:
+        if self._parts is None:
+            self._parts = urlsplit(self.url)
+        return self._parts
+
+    def domain(self) -> str:
+        return _domain(self.parts)
+
+    def raw_domain(self) -> str:
+        return _raw_domain(self.parts)
+
+    def create_child_link(self, text: Optional[str], url: Optional[str]) -> Optional['LinkRef']:
+        url = resolve_child_url(self.url, self.domain(), url)
         if url is None:
             return None
-        if text is None:
-            text = ""
-        # Disallow links that are too long. This breaks the PostgreSQL index on the url column
-        if len(url) > 2000:
-            print(f"Link too long: {url}")
-            return None
-        try:
-            link = self._create_child_link_inner(text, url)
-        except ValueError:
-            return None
+        # str() drops lxml's smart strings, which keep the whole document tree alive
+        return LinkRef(str(text or ""), url, self.url, self.depth + 1)
 
-        if link is None:
-            return None
+    def dict(self) -> dict:
+        return {'text': self.text, 'url': self.url, 'parent_url': self.parent_url, 'depth': self.depth}
+
+    # Lets pydantic models (e.g. `CrawlResult`) have LinkRef fields. Input is trusted: our own objects or their JSON
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
 
-        # Check if the url is one of the suppressed domains
-        for suppressed in SUPPRESSED_DOMAINS:
-            if suppressed in link.url:
-                return None
+    @classmethod
+    def validate(cls, v) -> 'LinkRef':
+        if isinstance(v, LinkRef):
+            return v
+        if isinstance(v, Link):
+            return cls.from_link(v)
+        if isinstance(v, dict):
+            return cls(v['text'], v['url'], v.get('parent_url'), v.get('depth', 0))
+        raise TypeError(f"Can't make a LinkRef from {type(v).__name__}")
 
-        return link
+    def __eq__(self, other):
+        if not isinstance(other, LinkRef):
+            return NotImplemented
+        return (self.text, self.url, self.parent_url, self.depth) == (other.text, other.url, other.parent_url, other.depth)
 
     def __hash__(self):
-        return (self.text,
-                self.url,
-                self.parent_url,
-                self.depth).__hash__()
+        return (self.text, self.url, self.parent_url, self.depth).__hash__()
+
+    def __repr__(self):
+        return f"LinkRef(url={self.url!r}, parent_url={self.parent_url!r}, depth={self.depth})"
 
 
 def test_suppressed():
-    for suppressed in SUPPRESSED_DOMAINS:
-        if suppressed in 'https://bayesianbiologist.com/2020/04/20/the-treachery-of-models/':
-            print(suppressed)
+    print(SUPPRESSED_MATCHER.search(
+        'https://bayesianbiologist.com/2020/04/20/the-treachery-of-models/'))
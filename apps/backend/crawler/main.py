@@ -2,10 +2,12 @@ import asyncio
 import time
 from prisma import Prisma
 
+from . import dbaccess, http_client, parse_service
 from .config import Config
 from .prismac import PostgresClient
 
 from .link import Link
+from .politeness import HostScheduler
 from .worker import Worker
 
 
@@ -24,24 +26,44 @@ async def main():
     start_time = time.time()
     config = Config()
     print(f"Starting with {config.num_workers} workers")
+    print(
+        f"Pipeline: {config.fetch_concurrency} fetches per worker, {config.parse_processes} parse processes, write batches of {config.write_batch_size}")
 
     # Initialize Prisma
     prisma_client = PostgresClient(config)
 
     prisma_client.connect()
 
+    # Tasks left in PROCESSING by a crashed run are picked up again once their lease expires
+    reclaimed = prisma_client.reclaim_expired_leases()
+    print(f"Reclaimed {reclaimed} tasks with expired leases")
+
+    seen = prisma_client.warm_seen_urls()
+    print(f"Loaded {seen} known urls into the frontier filter")
+
     # Initialize the shared work queue
     # await initialize_queue(prisma_client)
     done_queue: asyncio.Queue[bool] = asyncio.Queue()
     sentinel_queue: asyncio.Queue[bool] = asyncio.Queue()
 
+    # Parsing is CPU bound, so it is shared between all workers on a process pool
+    parser = parse_service.startup(
+        processes=config.parse_processes, timeout=config.parse_timeout)
+    # Rate limits are per host, not per worker
+    scheduler = HostScheduler(rate=config.host_rate)
+
+    # One connection pool for every worker, sized so each of them can have all its fetches in flight
+    await http_client.startup(limit=max(http_client.DEFAULT_CONNECTION_LIMIT, config.num_workers * config.fetch_concurrency))
+
     # Create a bunch of workers
     workers = [Worker(
         id=i,
         config=config,
         done_queue=done_queue,
         sentinel_queue=sentinel_queue,
-        prisma=prisma_client)
+        prisma=prisma_client,
+        parser=parser,
+        scheduler=scheduler)
         for i in range(config.num_workers)]
 
     # Start the workers
@@ -61,6 +83,10 @@ async def main():
     # for task in tasks:
     #     task.cancel()
     print("FINISHING")
+    parse_service.shutdown()
+    await http_client.shutdown()
+    print(f"Database pool: {dbaccess.pool_stats()}")
+    dbaccess.close_pool()
 
     print(
         f"Finished in {time.time() - start_time} seconds. Processed {done_queue.qsize()} links.")
@@ -0,0 +1,81 @@
+"""
+Compute SimHash fingerprints for every page that doesn't have one yet, and report the near duplicates among them.
+
+    python -m crawler.manual.backfill_simhash [--delete]
+
+With --delete, pages that are near duplicates of an older page are deleted (their embeddings go with them).
+"""
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from crawler import simhash
+from crawler.dbaccess import disable_statement_timeout
+from crawler.prismac import PostgresClient
+
+BATCH_SIZE = 2000
+
+
+def backfill(db: PostgresClient, delete: bool):
+    last_id = 0
+    stored = 0
+    duplicates: list[tuple[int, int]] = []
+
+    with ProcessPoolExecutor() as executor:
+        while True:
+            with db.cursor() as cursor:
+                pages = cursor.execute(
+                    "SELECT p.id, p.content FROM \"Page\" p LEFT JOIN \"PageSimhash\" s ON s.page_id = p.id WHERE s.page_id IS NULL AND p.id > %s ORDER BY p.id LIMIT %s",
+                    (last_id, BATCH_SIZE)).fetchall()
+            if len(pages) == 0:
+                break
+            last_id = pages[-1]['id']
+
+            fingerprints = executor.map(
+                simhash.simhash, [p['content'] for p in pages], chunksize=64)
+
+            # Pages in this batch aren't in the table yet, so check them against each other too
+            batch_bands: dict[tuple[int, int], list[tuple[int, int]]] = defaultdict(list)
+            to_store = []
+            for page, fingerprint in zip(pages, fingerprints):
+                if fingerprint is None:
+                    continue
+
+                original = db.find_near_duplicate(fingerprint)
+                if original is None:
+                    original = next((page_id for band in enumerate(simhash.bands(fingerprint))
+                                     for page_id, other in batch_bands[band]
+                                     if simhash.distance(fingerprint, other) <= simhash.MAX_DISTANCE), None)
+                if original is not None:
+                    duplicates.append((page['id'], original))
+                    if delete:
+                        continue
+
+                to_store.append((page['id'], fingerprint))
+                for band in enumerate(simhash.bands(fingerprint)):
+                    batch_bands[band].append((page['id'], fingerprint))
+
+            db.store_simhashes(to_store)
+            stored += len(to_store)
+            print(
+                f"Up to page {last_id}: stored {stored} fingerprints, found {len(duplicates)} near duplicates")
+
+    for page_id, original in duplicates:
+        print(f"Page {page_id} is a near duplicate of page {original}")
+
+    if delete and len(duplicates) > 0:
+        print(f"Deleting {len(duplicates)} pages")
+        db.query("DELETE FROM \"Page\" WHERE id = ANY(%s) RETURNING 1",
+                 ([page_id for page_id, _ in duplicates],))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--delete", action="store_true",
+                        help="Delete pages that are near duplicates of an older page")
+    args = parser.parse_args()
+
+    disable_statement_timeout()
+    db = PostgresClient()
+    db.connect()
+    backfill(db, args.delete)
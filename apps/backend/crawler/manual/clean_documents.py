@@ -3,7 +3,8 @@ from types import SimpleNamespace
 from prisma import Prisma
 from prisma.models import Page
 
-from crawler.link import SUPPRESSED_DOMAINS
+from crawler.dbaccess import disable_statement_timeout
+from crawler.link import is_suppressed
 
 from crawler.prismac import PostgresClient
 
@@ -18,8 +19,9 @@ async def clean_crawltask(db: PostgresClient):
     to_delete = []
 
     while True:
-        pages = db.cursor().execute(
-            "SELECT id, parent_url, url FROM \"CrawlTask\" WHERE status='PENDING' and depth=2 ORDER BY \"CrawlTask\".created_at DESC LIMIT 10000 OFFSET %s", (processed,)).fetchall()
+        with db.cursor() as cursor:
+            pages = cursor.execute(
+                "SELECT id, parent_url, url FROM \"CrawlTask\" WHERE status='PENDING' and depth=2 ORDER BY \"CrawlTask\".created_at DESC LIMIT 10000 OFFSET %s", (processed,)).fetchall()
 
         if len(pages) == 0:
             break
@@ -28,9 +30,8 @@ async def clean_crawltask(db: PostgresClient):
 
         for p in pages:
             p = SimpleNamespace(**p)
-            for suppressed in SUPPRESSED_DOMAINS:
-                if suppressed in p.url or (p.parent_url and suppressed in p.parent_url):
-                    to_delete.append(p.id)
+            if is_suppressed(p.url) or (p.parent_url and is_suppressed(p.parent_url)):
+                to_delete.append(p.id)
             # if not is_english(p.title + " " + p.content):
             #     print("NOT ENGLISH", p.url)
             #     to_delete.append(p.id)
@@ -41,16 +42,15 @@ async def clean_crawltask(db: PostgresClient):
         db.query(
             "DELETE FROM \"CrawlTask\" WHERE \"CrawlTask\".id = ANY(%s) RETURNING 1", (to_delete,))
 
-        db.conn.commit()
-
 async def main(db: PostgresClient):
     processed = 0
 
     to_delete = []
 
     while True:
-        pages = db.cursor().execute(
-            "SELECT id, parent_url, url FROM \"Page\" ORDER BY \"Page\".created_at WHERE parent_url NOT ILIKE 'user: %' DESC LIMIT 5000 OFFSET %s", (processed,)).fetchall()
+        with db.cursor() as cursor:
+            pages = cursor.execute(
+                "SELECT id, parent_url, url FROM \"Page\" ORDER BY \"Page\".created_at WHERE parent_url NOT ILIKE 'user: %' DESC LIMIT 5000 OFFSET %s", (processed,)).fetchall()
 
         if len(pages) == 0:
             break
@@ -59,9 +59,8 @@ async def main(db: PostgresClient):
 
         for p in pages:
             p = SimpleNamespace(**p)
-            for suppressed in SUPPRESSED_DOMAINS:
-                if suppressed in p.url or (p.parent_url and suppressed in p.parent_url):
-                    to_delete.append(p.id)
+            if is_suppressed(p.url) or (p.parent_url and is_suppressed(p.parent_url)):
+                to_delete.append(p.id)
             # if not is_english(p.title + " " + p.content):
             #     print("NOT ENGLISH", p.url)
             #     to_delete.append(p.id)
@@ -72,13 +71,12 @@ async def main(db: PostgresClient):
         db.query(
             "DELETE FROM \"Page\" WHERE \"Page\".id = ANY(%s) RETURNING 1", (to_delete,))
 
-        db.conn.commit()
-
 
 
 
 if __name__ == '__main__':
     import asyncio
+    disable_statement_timeout()
     db = PostgresClient()
     db.connect()
     asyncio.run(clean_crawltask(db))
@@ -0,0 +1,56 @@
+import re
+from typing import Iterable, Optional
+
+
+class SubstringMatcher:
+    """
+    Checks whether a string contains any of a fixed set of substrings, like `any(p in text for p in patterns)` but
+    without a Python loop over the patterns.
+
+    The patterns are compiled once into a single regex shaped like a trie (common prefixes are shared), so a lookup only
+    walks the characters of `text` instead of every pattern. Patterns that contain a shorter pattern as a prefix are
+    dropped, since the shorter one already matches.
+    """
+    patterns: frozenset[str]
+    _regex: Optional[re.Pattern]
+
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns = frozenset(p for p in patterns if p)
+
+        trie: dict = {}
+        for pattern in sorted(self.patterns):
+            node = trie
+            for char in pattern:
+                if '' in node:
+                    # A prefix of this pattern is already a pattern
+                    break
+                node = node.setdefault(char, {})
+            else:
+                node.clear()
+                node[''] = True
+
+        self._regex = re.compile(_trie_to_regex(trie)) if trie else None
+
+    def search(self, text: str) -> Optional[str]:
+        """Returns a pattern found in `text`, or `None`"""
+        if self._regex is None:
+            return None
+        match = self._regex.search(text)
+        return match.group() if match else None
+
+    def matches(self, text: str) -> bool:
+        return self._regex is not None and self._regex.search(text) is not None
+
+    def __contains__(self, text: str) -> bool:
+        return self.matches(text)
+
+
+def _trie_to_regex(node: dict) -> str:
+    if '' in node:
+        return ''
+
+    branches = [re.escape(char) + _trie_to_regex(child)
+                for char, child in sorted(node.items())]
+    if len(branches) == 1:
+        return branches[0]
+    return '(?:' + '|'.join(branches) + ')'
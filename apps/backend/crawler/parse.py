@@ -4,6 +4,7 @@ import html
 import json
 
 import feedparser
+import lxml.html
 from lxml import etree
 
 import trafilatura.feeds
@@ -16,8 +17,7 @@ import trafilatura
 from pydantic import BaseModel, validator
 from crawler.constants.whitelist import WHITELIST_DOMAINS
 
-from crawler.link import Link
-from bs4 import BeautifulSoup
+from crawler.link import Link, LinkRef
 
 
 class CrawlResult(BaseModel):
@@ -26,7 +26,10 @@ class CrawlResult(BaseModel):
     date: Optional[str]
     author: Optional[str]
     content: str  # Markdown
-    outbound_links: list[Link]
+    outbound_links: list[LinkRef]
+
+    class Config:
+        json_encoders = {LinkRef: LinkRef.dict}
 
     @validator('content')
     def validate(cls, v):
@@ -41,6 +44,7 @@ class CrawlResult(BaseModel):
 
 
 def parse_html_newspaper(html: str, link: Link) -> Optional[CrawlResult]:
+    # Newspaper only takes a string and builds its own tree. Its link xpath already skips ugc/sponsored/nofollow anchors
     article = newspaper.Article(link.url, keep_article_html=True)
     try:
         article.set_html(html)
@@ -57,10 +61,11 @@ def parse_html_newspaper(html: str, link: Link) -> Optional[CrawlResult]:
         "//a[not(@rel = 'ugc' or @rel = 'sponsored' or @rel = 'nofollow')]")
 
     # Extract href attribute and link text from each <a> tag
-    links = [link.create_child_link(element.text, element.get('href'))
+    parent = LinkRef.from_link(link)
+    links = [parent.create_child_link(element.text, element.get('href'))
              for element in link_elements]
     links = filter(lambda k: k is not None, links)
-    links = cast(list[Link], links)
+    links = cast(list[LinkRef], links)
 
     publish_date = article.publish_date.isoformat(
     ) if article.publish_date is not None else None
@@ -75,14 +80,31 @@ def parse_html_newspaper(html: str, link: Link) -> Optional[CrawlResult]:
     )
 
 
-def filter_out_ugc_sponsored(html: bytes) -> str:
-    # Parse the HTML content
-    tree = etree.HTML(html)
+def load_tree(html: bytes | str) -> Optional[lxml.html.HtmlElement]:
+    """Parse a page once. lxml picks the encoding up from the bytes (BOM / meta charset) like the old etree.HTML call"""
+    try:
+        return lxml.html.document_fromstring(html)
+    except ValueError:
+        # Strings with an XML encoding declaration have to be handed to lxml as bytes
+        if isinstance(html, str):
+            return load_tree(html.encode('utf-8'))
+        return None
+    except etree.ParserError:
+        return None
 
-    if tree is None:
-        return html.decode('utf-8', errors = 'ignore')
 
-    # Find and remove <a> tags with rel="ugc", "sponsored", or "nofollow"
+def decode_html(html: bytes | str, tree: Optional[lxml.html.HtmlElement]) -> str:
+    if isinstance(html, str):
+        return html
+    encoding = tree.getroottree().docinfo.encoding if tree is not None else None
+    try:
+        return html.decode(encoding or 'utf-8', errors='ignore')
+    except LookupError:
+        return html.decode('utf-8', errors='ignore')
+
+
+def prune_ugc_sponsored(tree: lxml.html.HtmlElement):
+    # Find <a> tags with rel="ugc", "sponsored", or "nofollow"
     links_to_remove = tree.xpath(
         "//a[@rel='ugc' or @rel='sponsored' or @rel='nofollow']")
     for link in links_to_remove:
@@ -90,24 +112,26 @@ def filter_out_ugc_sponsored(html: bytes) -> str:
         if 'href' in link.attrib:
             link.attrib.pop('href')
 
-    # Return the modified HTML content as a string
-    return etree.tostring(tree, encoding='unicode')
 
+def parse_html_trafilatura(tree: lxml.html.HtmlElement, link: Link) -> Optional[CrawlResult]:
+    # Read everything we need from the tree first: trafilatura cleans the tree it is given in place
+    title = extract_meta_title(tree)
+    if link.raw_domain() in WHITELIST_DOMAINS:
+        links = extract_links_from_html(tree, link)
+    else:
+        links = None
 
-def parse_html_trafilatura(html: str, link: Link) -> Optional[CrawlResult]:
-    content = trafilatura.extract(html, url=link.url, include_links=True, include_tables=False, include_comments=False, include_images=False, output_format='json',
+    content = trafilatura.extract(tree, url=link.url, include_links=True, include_tables=False, include_comments=False, include_images=False, output_format='json',
                                   with_metadata=True, favor_precision=True)
 
     if content is None:
         return None
     content = json.loads(content)
 
-    if link.raw_domain() in WHITELIST_DOMAINS:
-        links = extract_links_from_html(html, link)
-    else:
+    if links is None:
         links = extract_links_from_markdown(content["text"], link)
 
-    title = extract_meta_title(html) or content["title"]
+    title = title or content["title"]
 
     return CrawlResult(
         link=link,
@@ -119,21 +143,13 @@ def parse_html_trafilatura(html: str, link: Link) -> Optional[CrawlResult]:
     )
 
 
-def extract_links_from_html(html: str, link: Link) -> list[Link]:
-    links = []
-    soup = BeautifulSoup(html, 'lxml')
-
-    # Extract all <a> tags
-    link_elements = soup.find_all('a')
-    for a in soup.find_all("a"):
-        href = a.get("href")
-        links.append(href)
-
+def extract_links_from_html(tree: lxml.html.HtmlElement, link: Link) -> list[LinkRef]:
     # Extract href attribute and link text from each <a> tag
-    links = [link.create_child_link(element.text, element.get('href'))
-             for element in link_elements]
+    parent = LinkRef.from_link(link)
+    links = [parent.create_child_link(element.text_content(), element.get('href'))
+             for element in tree.iter('a')]
     links = list(filter(lambda k: k is not None, links))
-    links = cast(list[Link], links)
+    links = cast(list[LinkRef], links)
 
     # Filter out links that have the same url as the parent
     links = list(filter(lambda k: k.url != link.url, links))
@@ -174,15 +190,40 @@ def find_feed_urls_cached(base_domain: Link) -> list[Link]:
     return rss_links
 
 
-def parse_html(html: bytes, link: Link, should_rss: bool) -> Tuple[Optional[CrawlResult], list[Link]]:
-    html = filter_out_ugc_sponsored(html)
-    try:
-        a = parse_html_trafilatura(html, link)
-    except Exception:
-        print("Exception parsing trafilatura for", link.url)
-        a = None
+def page_text(tree: lxml.html.HtmlElement) -> str:
+    """
+    All the visible text in the page, with a space between elements so words of neighbouring elements aren't glued
+    together
+    """
+    return ' '.join(tree.xpath("//text()[not(ancestor::script or ancestor::style or ancestor::noscript)]"))
+
+
+def extractable_text(tree: lxml.html.HtmlElement) -> str:
+    """
+    An upper bound on what extraction can turn the page into: the visible text, plus what the markdown output of
+    trafilatura (include_links=True) adds around it, `[...](href)` for every link and a bullet for every list item
+    """
+    links = ' '.join(f'[]({href})' for href in tree.xpath("//a/@href"))
+    bullets = ' -' * len(tree.xpath("//li"))
+    return f'{page_text(tree)} {links}{bullets}'
+
+
+def parse_html(html: bytes | str, link: Link, should_rss: bool, tree: Optional[lxml.html.HtmlElement] = None) -> Tuple[Optional[CrawlResult], list[Link]]:
+    """
+    The page is parsed into a single lxml tree which title extraction, link extraction and trafilatura all share.
+    Only the newspaper fallback needs the page as a string again. Pass `tree` if the caller already loaded it
+    """
+    if tree is None:
+        tree = load_tree(html)
+    a = None
+    if tree is not None:
+        prune_ugc_sponsored(tree)
+        try:
+            a = parse_html_trafilatura(tree, link)
+        except Exception:
+            print("Exception parsing trafilatura for", link.url)
     if a is None:
-        a = parse_html_newspaper(html, link)
+        a = parse_html_newspaper(decode_html(html, tree), link)
 
     if a is not None:
         a.title = fix(a.title)
@@ -196,30 +237,30 @@ def parse_html(html: bytes, link: Link, should_rss: bool) -> Tuple[Optional[Craw
     return a, rss_links
 
 
-def extract_links_from_markdown(markdown_text: str, parent: Link) -> list[Link]:
+def extract_links_from_markdown(markdown_text: str, link: Link) -> list[LinkRef]:
     # Regular expression pattern for links
     link_pattern = r'\[([^\]]+)\]\(([^)]+)\)'
 
+    parent = LinkRef.from_link(link)
     links = []
 
     # Find all link matches using the pattern
     for match in re.findall(link_pattern, markdown_text):
         link_text, link_url = match
-        link = parent.create_child_link(link_text, link_url)
-        if link:
-            links.append(link)
+        child = parent.create_child_link(link_text, link_url)
+        if child:
+            links.append(child)
 
     return links
 
 
-def extract_meta_title(html: str) -> Optional[str]:
-    soup = BeautifulSoup(html, 'lxml')
-    title = soup.find("meta", property="og:title")
-    if title:
-        return title.get("content")  # type: ignore
-    title = soup.find('title')
-    if title:
-        return title.get_text()
+def extract_meta_title(tree: lxml.html.HtmlElement) -> Optional[str]:
+    title = tree.find(".//meta[@property='og:title']")
+    if title is not None:
+        return title.get("content")
+    title = tree.find('.//title')
+    if title is not None:
+        return title.text_content()
 
 
 def test_1():
@@ -0,0 +1,187 @@
+"""
+Parse service: a pool of pre-warmed processes that turn raw page bytes into `CrawlResult`s.
+
+Trafilatura, newspaper and the NLTK filters are pure CPU, so running them on the event loop serializes every worker onto
+one core. The pool is sized to the cores and every process imports the extractors and parses a small page once at
+startup, so the first real page does not pay for lazy initialization. Results come back as JSON.
+
+Each parse gets `timeout` seconds. The child interrupts itself with SIGALRM, and if it is stuck in C code and does not
+answer within a grace period the parent kills the pool and starts a fresh one.
+
+Call `startup()` once and `shutdown()` before exiting, like `http_client`.
+"""
+import asyncio
+import signal
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional, Tuple
+
+from . import filters
+from .config import DEFAULT_PARSE_PROCESSES, DEFAULT_PARSE_TIMEOUT
+from .link import Link
+from .parse import CrawlResult, extractable_text, load_tree, parse_html
+
+# Extra seconds the parent waits for a child that should have interrupted itself before killing the pool
+KILL_GRACE = 5
+
+WARM_UP_LINK = 'https://example.com/warm-up'
+WARM_UP_HTML = b"""<html><head><title>Warm up</title><meta property="og:title" content="Warm up"></head><body>
+<article><h1>Warm up</h1><p>This page is parsed once by every process in the pool when it starts. It loads trafilatura,
+newspaper and the NLTK tokenizers so that the first real page does not pay for it. It needs to be long enough for the
+extractors to consider it an article, so here are a few more sentences about nothing in particular.</p>
+<p>Another paragraph with a <a href="https://example.com/other">link to another page</a> in it. And one more sentence to
+make sure there is enough text.</p></article></body></html>"""
+
+
+class ParseTimeout(BaseException):
+    """
+    Raised by SIGALRM in the child. Not an `Exception`, so the `except Exception` of parse_html and the extractors
+    can't swallow it and carry on (into the newspaper fallback) with the alarm already spent
+    """
+
+
+def _on_alarm(signum, frame):
+    raise ParseTimeout()
+
+
+def _warm_up():
+    """Pool initializer"""
+    try:
+        link = Link.from_url(WARM_UP_LINK)
+        result, _ = parse_html(WARM_UP_HTML, link, False)
+        if result is not None:
+            filters.should_keep(result)
+    except Exception as e:
+        print(f"Parse process warm up failed: {e}")
+
+
+def _with_timeout(timeout: float, fn: Callable, *args):
+    """Runs in the child. Interrupts `fn` after `timeout` seconds if the platform has SIGALRM"""
+    if not hasattr(signal, 'SIGALRM'):
+        return fn(*args)
+
+    previous = signal.signal(signal.SIGALRM, _on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return fn(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def should_keep(result: CrawlResult, link: Link) -> bool:
+    return link.depth == 0 or filters.should_keep(result)
+
+
+def _parse(html: bytes, link: Link) -> Optional[str]:
+    result, _rss_links = parse_html(html, link, False)
+    return result.json() if result is not None else None
+
+
+def _parse_and_filter(html: bytes, link: Link) -> Tuple[Optional[str], Optional[bool]]:
+    tree = load_tree(html)
+    if tree is not None and link.depth > 0 and not filters.might_keep(extractable_text(tree), link):
+        # Too little text to pass the filter whatever extraction makes of it
+        return None, False
+
+    result, _rss_links = parse_html(html, link, False, tree=tree)
+    if result is None:
+        return None, None
+
+    return result.json(), should_keep(result, link)
+
+
+class ParseService:
+    processes: int
+    timeout: float
+    _executor: ProcessPoolExecutor
+
+    def __init__(self, processes: int = DEFAULT_PARSE_PROCESSES, timeout: float = DEFAULT_PARSE_TIMEOUT):
+        self.processes = processes
+        self.timeout = timeout
+        self._executor = self._new_executor()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.processes, initializer=_warm_up)
+
+    async def parse(self, html: bytes, link: Link) -> Optional[CrawlResult]:
+        """Parse `html`, returning `None` if extraction failed or took longer than `timeout`"""
+        result = await self._submit(_parse, html, link)
+        return CrawlResult.parse_raw(result) if result is not None else None
+
+    async def parse_and_filter(self, html: bytes, link: Link) -> Tuple[Optional[CrawlResult], Optional[bool]]:
+        """
+        Parse `html` and decide whether the page is worth keeping. Returns the result and `True` for a page to keep,
+        `False` (possibly without a result, if it was rejected before extraction) for a page to filter out, and
+        `None, None` if parsing failed or timed out.
+        """
+        result = await self._submit(_parse_and_filter, html, link)
+        if result is None:
+            return None, None
+        result_json, keep = result
+        return CrawlResult.parse_raw(result_json) if result_json is not None else None, keep
+
+    async def should_keep(self, result: CrawlResult, link: Link) -> bool:
+        return bool(await self._submit(should_keep, result, link))
+
+    async def _submit(self, fn: Callable, *args, retry: bool = True):
+        executor = self._executor
+        future = asyncio.wrap_future(
+            executor.submit(_with_timeout, self.timeout, fn, *args))
+        try:
+            return await asyncio.wait_for(future, self.timeout + KILL_GRACE)
+        except ParseTimeout:
+            print(f"Parse timed out after {self.timeout}s: {_describe(args)}")
+            return None
+        except asyncio.TimeoutError:
+            print(
+                f"Parse process stuck for {self.timeout + KILL_GRACE}s, restarting the pool: {_describe(args)}")
+            self._recycle(executor)
+            return None
+        except BrokenProcessPool:
+            # Killed along with a stuck parse (or the child crashed). Not this document's fault, so try it once more
+            self._recycle(executor)
+            if retry:
+                return await self._submit(fn, *args, retry=False)
+            return None
+
+    def _recycle(self, executor: ProcessPoolExecutor):
+        if executor is not self._executor:
+            # Someone else already replaced it
+            return
+        self._executor = self._new_executor()
+
+        # ProcessPoolExecutor can't cancel a running call, so the only way to stop it is to kill its processes
+        for process in list((executor._processes or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        self._executor.shutdown(cancel_futures=True)
+
+
+def _describe(args) -> str:
+    links = [a for a in args if isinstance(a, Link)]
+    return links[0].url if links else ''
+
+
+_service: Optional[ParseService] = None
+
+
+def startup(processes: int = DEFAULT_PARSE_PROCESSES, timeout: float = DEFAULT_PARSE_TIMEOUT) -> ParseService:
+    global _service
+    if _service is None:
+        _service = ParseService(processes, timeout)
+    return _service
+
+
+def shutdown():
+    global _service
+    if _service is not None:
+        _service.shutdown()
+        _service = None
+
+
+def get_service() -> ParseService:
+    """Returns the shared service, starting it with the default size if `startup()` has not been called"""
+    return startup()
@@ -0,0 +1,229 @@
+import asyncio
+import heapq
+import itertools
+import time
+from email.utils import parsedate_to_datetime
+from typing import Generic, Optional, TypeVar
+from urllib.robotparser import RobotFileParser
+
+from aiohttp import ClientError, ClientSession, ClientTimeout
+
+from .config import DEFAULT_HOST_RATE
+from .link import Link
+
+DEFAULT_HOST_BURST = 2  # requests a host may receive back to back before the rate applies
+ROBOTS_TTL = 60 * 60  # seconds to cache a parsed robots.txt
+ROBOTS_TIMEOUT = 5
+MAX_ROBOTS_ENTRIES = 50000
+MAX_BUCKETS = 50000
+MAX_CRAWL_DELAY = 60  # ignore crawl-delays longer than this, they would stall the host forever
+DEFAULT_RETRY_AFTER = 60  # seconds to back off a host that returned 429/503 without a Retry-After header
+MAX_RETRY_AFTER = 5 * 60
+
+# We send a browser user agent, so robots.txt rules addressed to everyone are the ones that apply to us
+ROBOTS_USER_AGENT = '*'
+
+T = TypeVar("T")
+
+
+class HostThrottled(Exception):
+    """The host asked us to slow down (429 or 503). The task should be retried later instead of failed"""
+    retry_after: float
+
+    def __init__(self, host: str, retry_after: float):
+        super().__init__(f"{host} is throttling us, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    rate: float
+    capacity: float
+    tokens: float
+    updated_at: float
+    paused_until: float
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+
+    def try_take(self, now: float) -> float:
+        """Take a token if one is available. Returns 0 on success, otherwise the number of seconds until one is"""
+        if now < self.paused_until:
+            return self.paused_until - now
+
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def is_idle(self, now: float) -> bool:
+        return now >= self.paused_until and self.tokens + (now - self.updated_at) * self.rate >= self.capacity
+
+
+class RobotsCache:
+    """Parsed robots.txt per origin, cached for `ttl` seconds. Concurrent lookups for the same origin share one fetch"""
+    ttl: float
+    _entries: dict[str, tuple[float, RobotFileParser]]
+    _pending: dict[str, asyncio.Future]
+
+    def __init__(self, ttl: float = ROBOTS_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._pending = {}
+
+    async def get(self, link: Link, session: ClientSession) -> RobotFileParser:
+        origin = link.domain()
+        entry = self._entries.get(origin)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        if origin in self._pending:
+            return await asyncio.shield(self._pending[origin])
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[origin] = future
+        try:
+            robots = await self._fetch(origin, session)
+            self._store(origin, robots)
+            future.set_result(robots)
+            return robots
+        finally:
+            if not future.done():
+                future.set_result(_allow_all())
+            del self._pending[origin]
+
+    def _store(self, origin: str, robots: RobotFileParser):
+        now = time.monotonic()
+        if len(self._entries) >= MAX_ROBOTS_ENTRIES:
+            self._entries = {k: v for k, v in self._entries.items()
+                             if v[0] > now}
+        self._entries[origin] = (now + self.ttl, robots)
+
+    @staticmethod
+    async def _fetch(origin: str, session: ClientSession) -> RobotFileParser:
+        try:
+            async with session.get(origin + '/robots.txt', timeout=ClientTimeout(total=ROBOTS_TIMEOUT)) as response:
+                if not response.ok:
+                    # Missing robots.txt (or one we can't read) means everything is allowed
+                    return _allow_all()
+                text = await response.text(errors='ignore')
+        except (ClientError, asyncio.TimeoutError, UnicodeDecodeError):
+            return _allow_all()
+
+        robots = RobotFileParser()
+        robots.parse(text.splitlines())
+        return robots
+
+
+def _allow_all() -> RobotFileParser:
+    robots = RobotFileParser()
+    robots.parse([])
+    return robots
+
+
+def parse_retry_after(value: Optional[str]) -> float:
+    """Parse a Retry-After header, which is either a number of seconds or an HTTP date"""
+    if not value:
+        return DEFAULT_RETRY_AFTER
+
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(
+                value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return DEFAULT_RETRY_AFTER
+
+    return min(max(seconds, 1), MAX_RETRY_AFTER)
+
+
+class HostScheduler:
+    """
+    Keeps the crawler polite: each host gets a token bucket (slowed down to its robots.txt crawl-delay), robots.txt
+    rules are honored, and hosts that answer 429/503 are paused. Shared by all workers in the process.
+    """
+    rate: float
+    burst: float
+    robots: RobotsCache
+    _buckets: dict[str, TokenBucket]
+
+    def __init__(self, rate: float = DEFAULT_HOST_RATE, burst: float = DEFAULT_HOST_BURST, robots_ttl: float = ROBOTS_TTL):
+        self.rate = rate
+        self.burst = burst
+        self.robots = RobotsCache(robots_ttl)
+        self._buckets = {}
+
+    def _bucket(self, host: str) -> TokenBucket:
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            if len(self._buckets) >= MAX_BUCKETS:
+                now = time.monotonic()
+                self._buckets = {k: v for k, v in self._buckets.items()
+                                 if not v.is_idle(now)}
+            bucket = TokenBucket(self.rate, self.burst)
+            self._buckets[host] = bucket
+        return bucket
+
+    def try_acquire(self, link: Link) -> float:
+        """Returns 0 if we may fetch `link` now, otherwise the number of seconds to wait before trying again"""
+        return self._bucket(link.raw_domain()).try_take(time.monotonic())
+
+    async def wait_for_turn(self, link: Link):
+        while (delay := self.try_acquire(link)) > 0:
+            await asyncio.sleep(delay)
+
+    def backoff(self, link: Link, seconds: float):
+        bucket = self._bucket(link.raw_domain())
+        bucket.paused_until = max(
+            bucket.paused_until, time.monotonic() + seconds)
+
+    async def is_allowed(self, link: Link, session: ClientSession) -> bool:
+        """Check robots.txt for `link`, applying the host's crawl-delay to its token bucket"""
+        robots = await self.robots.get(link, session)
+
+        crawl_delay = robots.crawl_delay(ROBOTS_USER_AGENT)
+        if crawl_delay:
+            bucket = self._bucket(link.raw_domain())
+            bucket.rate = min(bucket.rate, 1 / min(float(crawl_delay), MAX_CRAWL_DELAY))
+            bucket.capacity = 1
+
+        return robots.can_fetch(ROBOTS_USER_AGENT, link.url)
+
+
+class DeferredTasks(Generic[T]):
+    """Items parked until a given time, e.g. tasks for a host that is currently throttled"""
+    _heap: list[tuple[float, int, T]]
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def defer(self, item: T, delay: float):
+        heapq.heappush(
+            self._heap, (time.monotonic() + delay, next(self._counter), item))
+
+    def pop_ready(self) -> Optional[T]:
+        if self._heap and self._heap[0][0] <= time.monotonic():
+            return heapq.heappop(self._heap)[2]
+        return None
+
+    def drain(self) -> list[T]:
+        items = [item for _, _, item in self._heap]
+        self._heap = []
+        return items
+
+    def next_ready_in(self) -> float:
+        if not self._heap:
+            return 0
+        return max(self._heap[0][0] - time.monotonic(), 0)
@@ -1,4 +1,6 @@
-from typing import Optional, Type, TypeVar, Union
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Iterator, Optional, Type, TypeVar, Union
 
 import mmh3
 import psycopg
@@ -7,90 +9,172 @@ from prisma.enums import TaskStatus
 from prisma.errors import UniqueViolationError
 from prisma.models import CrawlTask, Page, User
 from prisma.partials import NodePage
-from psycopg import Connection, Cursor, sql
+from psycopg import AsyncCursor, Connection, Cursor, sql
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
 from psycopg.rows import class_row, dict_row
 
-from .dbaccess import DB, db
-from .link import Link
+from . import simhash
+from .bloom import ScalableBloomFilter
+from .dbaccess import get_async_pool, get_pool
+from .link import Link, LinkRef, canonical_key
 from .parse import CrawlResult
+from .recommendation import bm25_index
+
+# Read queries the API makes, shared by `PostgresClient` and `AsyncPostgresClient`
+PAGES_BY_ID = sql.SQL('SELECT * FROM "Page" WHERE id = ANY(%s);')
+PAGE_STUBS_BY_ID = sql.SQL(
+    'SELECT id, title, date, author, created_at, updated_at, outbound_urls, parent_url, url, content_hash, depth, page_rank FROM "Page" WHERE id = ANY(%s);')
+NODES_BY_URL = sql.SQL(
+    'SELECT id, outbound_urls, title, url FROM "Page" WHERE url = ANY(%s);')
+# Pages that have the url in their outbound_urls
+NODES_LINKING_TO = sql.SQL(
+    'SELECT id, outbound_urls, title, url FROM "Page" WHERE %s = ANY(outbound_urls);')
+
+
+def page_query(**kwargs) -> tuple[sql.Composed, tuple]:
+    if 'id' in kwargs:
+        where_field = 'id'
+    elif 'url' in kwargs:
+        where_field = 'url'
+    else:
+        raise Exception("Must specify id or url")
+    query = sql.SQL(
+        'SELECT * FROM "Page" WHERE {} = %s LIMIT 1;').format(sql.Identifier(where_field))
+    return query, (kwargs[where_field],)
+
+
+def reorder_pages(ids: list[int], pages: list[Page]) -> list[Page]:
+    index_hashmap = {id: idx for idx, id in enumerate(ids)}
+
+    # Remains in same order as ids list
+    return sorted(pages, key=lambda p: index_hashmap[p.id])
 
 
 class PostgresClient:
-    conn: DB
-    _inner_cursor: Cursor
+    """
+    Every method checks a connection out of the shared pool for just its own statements, so concurrent workers and
+    requests never interleave on one connection
+    """
+    pool: ConnectionPool
     cfg: Optional[Config]
+    # Canonical keys of every url we have a committed task for, so duplicates never reach the database. Only the crawler
+    # needs it: it is allocated by `warm_seen_urls`, and without it duplicates are left to the unique index on url
+    seen_urls: Optional[ScalableBloomFilter]
 
     T = TypeVar("T")
 
-    @property
-    def _cursor(self) -> Cursor:
-        if not hasattr(self, '_inner_cursor'):
-            raise RuntimeError("You must call .connect() first!")
-        return self._inner_cursor
-
-    @_cursor.setter
-    def _cursor(self, value: Cursor):
-        self._inner_cursor = value
-
     def __init__(self, cfg: Optional[Config] = None):
         if cfg is None:
             cfg = Config(empty=True)
         self.cfg = cfg
+        self.seen_urls = None
 
     def connect(self):
-        self.conn = db
-        self._cursor = self.conn.cursor(row_factory=dict_row)
+        self.pool = get_pool()
         print("Connected to database")
 
-    def cursor(self, row_class: Optional[Type[T]] = None) -> Union[Cursor[T], Cursor[dict]]:
-
-        if row_class:
-            cursor = self.conn.cursor(row_factory=class_row(row_class))
-        else:
-            cursor = self.conn.cursor(row_factory=dict_row)
-        return cursor
+    @contextmanager
+    def connection(self) -> Iterator[Connection]:
+        """A pooled connection for the duration of the block. Commits when the block exits, rolls back if it raises"""
+        with self.pool.connection() as conn:
+            yield conn
+
+    @contextmanager
+    def cursor(self, row_class: Optional[Type[T]] = None) -> Iterator[Union[Cursor[T], Cursor[dict]]]:
+        with self.connection() as conn:
+            if row_class:
+                cursor = conn.cursor(row_factory=class_row(row_class))
+            else:
+                cursor = conn.cursor(row_factory=dict_row)
+            with cursor:
+                yield cursor
 
     def query(self, query: sql.SQL | str, *args):
-        self._cursor.execute(query, *args)
-        if self._cursor.rowcount > 0:
-            return self._cursor.fetchall()
+        with self.cursor() as cursor:
+            cursor.execute(query, *args)
+            if cursor.rowcount > 0:
+                return cursor.fetchall()
 
     async def disconnect(self):
-        self._cursor.close()
-        self.conn.close()
+        # The pool is shared by the whole process and is closed with it
+        pass
 
     async def filter_page(self, task: CrawlTask):
-        query = sql.SQL('UPDATE "CrawlTask" SET status = %s WHERE id = %s;')
-        self._cursor.execute(query, (TaskStatus.FILTERED, task.id))
-        self.conn.commit()
+        self.set_task_status(task, TaskStatus.FILTERED)
 
     async def fail_page(self, task: CrawlTask):
-        query = sql.SQL("UPDATE {} SET status = %s WHERE id = %s;").format(
-            sql.Identifier("CrawlTask"))
-        self._cursor.execute(query, (TaskStatus.FAILED, task.id))
-        self.conn.commit()
+        self.set_task_status(task, TaskStatus.FAILED)
 
-    def add_outgoing_links(self, links: list[Link]):
+    def add_outgoing_links(self, links: list[Link | LinkRef]):
         links_to_add = [l for l in links if l.depth <=
                         self.cfg.max_crawl_depth]
         count = self.add_tasks(links_to_add)
         print(f"PSYCOPG: Added {count} tasks to db")
 
-    def store_raw_page(self, depth: int, crawl_result: CrawlResult) -> Page | None:
+    def store_raw_page(self, depth: int, crawl_result: CrawlResult, embedding_lease_seconds: Optional[int] = None) -> Page | None:
+        """
+        Store the page, queue it for `generate_embeddings` and add it to the BM25 index if this process has it loaded.
+        A caller that embeds the page itself passes `embedding_lease_seconds`: the queued page is then leased to it from
+        the start, so no embedding worker picks it up too, and it is only embedded by a worker if the caller fails
+        """
         content_hash = str(mmh3.hash128(crawl_result.content, signed=False))
 
         query = sql.SQL("INSERT INTO {} (content_hash, url, parent_url, title, date, author, content, outbound_urls, depth) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING RETURNING *;").format(sql.Identifier("Page"))
-        self._cursor.execute(query, (content_hash, crawl_result.link.url, crawl_result.link.parent_url, crawl_result.title,
-                                     crawl_result.date, crawl_result.author, crawl_result.content, [link.url for link in crawl_result.outbound_links], depth))
-        self.conn.commit()
-
-        if self._cursor.rowcount == 0:
+        with self.cursor() as cursor:
+            cursor.execute(query, (content_hash, crawl_result.link.url, crawl_result.link.parent_url, crawl_result.title,
+                                   crawl_result.date, crawl_result.author, crawl_result.content, [link.url for link in crawl_result.outbound_links], depth))
+            row = cursor.fetchone()
+            if row is not None and embedding_lease_seconds is None:
+                cursor.execute(sql.SQL("INSERT INTO {} (page_id, depth) VALUES (%s, %s);").format(
+                    sql.Identifier("EmbeddingTask")), (row['id'], depth))
+            elif row is not None:
+                cursor.execute(sql.SQL("INSERT INTO {} (page_id, depth, leased_until, attempts) VALUES (%s, %s, NOW() + make_interval(secs => %s), 1);").format(
+                    sql.Identifier("EmbeddingTask")), (row['id'], depth, embedding_lease_seconds))
+
+        if row is None:
             return None
-        return Page(**self._cursor.fetchone())
+        page = Page(**row)
+        bm25_index.add_pages([page])
+        return page
+
+    def find_near_duplicate(self, fingerprint: int, url: Optional[str] = None) -> Optional[int]:
+        """
+        Id of a stored page whose SimHash is within `simhash.MAX_DISTANCE` bits of `fingerprint`, if any. The page
+        stored at `url` doesn't count, so a page that is crawled again isn't a duplicate of itself
+        """
+        query = sql.SQL("SELECT page_id, simhash FROM {} WHERE (band0 = %s OR band1 = %s OR band2 = %s OR band3 = %s) AND page_id IS DISTINCT FROM (SELECT id FROM {} WHERE url = %s);").format(
+            sql.Identifier("PageSimhash"), sql.Identifier("Page"))
+        with self.cursor() as cursor:
+            rows = cursor.execute(query, (*simhash.bands(fingerprint), url)).fetchall()
+
+        for row in rows:
+            if simhash.distance(fingerprint, simhash.from_signed(row['simhash'])) <= simhash.MAX_DISTANCE:
+                return row['page_id']
+        return None
+
+    def store_simhashes(self, fingerprints: list[tuple[int, int]]):
+        """Store `(page_id, fingerprint)` pairs"""
+        query = sql.SQL("INSERT INTO {} (page_id, simhash, band0, band1, band2, band3) VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT (page_id) DO UPDATE SET simhash = EXCLUDED.simhash, band0 = EXCLUDED.band0, band1 = EXCLUDED.band1, band2 = EXCLUDED.band2, band3 = EXCLUDED.band3;").format(
+            sql.Identifier("PageSimhash"))
+        with self.connection() as conn:
+            conn.cursor().executemany(query, [(page_id, simhash.to_signed(fingerprint), *simhash.bands(fingerprint))
+                                              for page_id, fingerprint in fingerprints])
 
     def store_page(self, task: CrawlTask, crawl_result: CrawlResult) -> Optional[Page]:
         try:
+            fingerprint = simhash.simhash(crawl_result.content)
+            if fingerprint is not None:
+                duplicate = self.find_near_duplicate(fingerprint, crawl_result.link.url)
+                if duplicate is not None:
+                    # Syndicated copy or the same page with different boilerplate. Don't store, embed or rank it twice
+                    print(
+                        f"WARN: Near duplicate of page {duplicate}: {crawl_result.link.url}")
+                    self.set_task_status(task, TaskStatus.FILTERED)
+                    return None
+
             page = self.store_raw_page(task.depth, crawl_result)
+            if page is not None and fingerprint is not None:
+                self.store_simhashes([(page.id, fingerprint)])
             self.finish_task(task)
             self.add_outgoing_links(crawl_result.outbound_links)
             return page
@@ -99,55 +183,184 @@ class PostgresClient:
             return None
 
     async def get_task(self) -> CrawlTask | None:
-        query = sql.SQL("UPDATE {} SET status = %s WHERE id = (SELECT id FROM {} WHERE status::text = %s ORDER BY depth ASC, boost DESC, id ASC FOR UPDATE SKIP LOCKED LIMIT 1) RETURNING *;").format(
-            sql.Identifier("CrawlTask"), sql.Identifier("CrawlTask"))
-        self._cursor.execute(
-            query, (TaskStatus.PROCESSING, TaskStatus.PENDING))
-        self.conn.commit()
-
-        task = self._cursor.fetchone()
-        if task:
-            return CrawlTask(**task)
+        tasks = await self.lease_tasks(1)
+        if tasks:
+            return tasks[0]
         else:
             return None
 
-    def add_tasks(self, links: list[Link]):
+    async def lease_tasks(self, count: int, lease_seconds: Optional[int] = None) -> list[CrawlTask]:
+        """
+        Claim up to `count` pending tasks in a single statement. Each task is moved to PROCESSING with a lease that
+        expires after `lease_seconds`; if the worker never finishes it, `reclaim_expired_leases` makes it pending again.
+        """
+        if lease_seconds is None:
+            lease_seconds = self.cfg.task_lease_seconds
+        # On the default executor, so the other crawl stages on the event loop keep going
+        return await asyncio.get_running_loop().run_in_executor(None, self._lease_tasks, count, lease_seconds)
+
+    def _lease_tasks(self, count: int, lease_seconds: int) -> list[CrawlTask]:
+        query = sql.SQL("UPDATE {} SET status = %s, leased_until = NOW() + make_interval(secs => %s) WHERE id = ANY(ARRAY(SELECT id FROM {} WHERE status::text = %s AND (not_before IS NULL OR not_before <= NOW()) ORDER BY depth ASC, boost DESC, id ASC FOR UPDATE SKIP LOCKED LIMIT %s)) RETURNING *;").format(
+            sql.Identifier("CrawlTask"), sql.Identifier("CrawlTask"))
+        with self.cursor() as cursor:
+            cursor.execute(
+                query, (TaskStatus.PROCESSING, lease_seconds, TaskStatus.PENDING, count))
+            tasks = [CrawlTask(**task) for task in cursor.fetchall()]
+        # RETURNING does not preserve the ORDER BY of the subquery
+        tasks.sort(key=lambda t: (t.depth, -t.boost, t.id))
+        return tasks
+
+    def reclaim_expired_leases(self) -> int:
+        """Return tasks whose lease ran out (e.g. the worker crashed) to PENDING so they get crawled again"""
+        query = sql.SQL("UPDATE {} SET status = %s, leased_until = NULL WHERE status::text = %s AND (leased_until IS NULL OR leased_until < NOW());").format(
+            sql.Identifier("CrawlTask"))
+        with self.connection() as conn:
+            return conn.execute(query, (TaskStatus.PENDING, TaskStatus.PROCESSING)).rowcount
+
+    def renew_leases(self, tasks: list[CrawlTask], lease_seconds: Optional[int] = None) -> set[int]:
+        """Extend the leases of tasks we still hold. Returns the ids renewed, tasks that are no longer leased are left out"""
+        if lease_seconds is None:
+            lease_seconds = self.cfg.task_lease_seconds
+        if len(tasks) == 0:
+            return set()
+        query = sql.SQL("UPDATE {} SET leased_until = NOW() + make_interval(secs => %s) WHERE id = ANY(%s) AND status::text = %s RETURNING id;").format(
+            sql.Identifier("CrawlTask"))
+        with self.connection() as conn:
+            rows = conn.execute(query, (lease_seconds, [t.id for t in tasks], TaskStatus.PROCESSING)).fetchall()
+        return {row[0] for row in rows}
+
+    def release_tasks(self, tasks: list[CrawlTask]):
+        """Give back leased tasks that were never worked on"""
+        if len(tasks) == 0:
+            return
+        query = sql.SQL("UPDATE {} SET status = %s, leased_until = NULL WHERE id = ANY(%s) AND status::text = %s;").format(
+            sql.Identifier("CrawlTask"))
+        with self.connection() as conn:
+            conn.execute(
+                query, (TaskStatus.PENDING, [t.id for t in tasks], TaskStatus.PROCESSING))
+
+    def defer_tasks(self, tasks: list[CrawlTask], delay: float):
+        """Give back leased tasks that are not to be handed out again for `delay` seconds, e.g. for a throttled host"""
+        if len(tasks) == 0:
+            return
+        query = sql.SQL("UPDATE {} SET status = %s, leased_until = NULL, not_before = NOW() + make_interval(secs => %s) WHERE id = ANY(%s) AND status::text = %s;").format(
+            sql.Identifier("CrawlTask"))
+        with self.connection() as conn:
+            conn.execute(
+                query, (TaskStatus.PENDING, delay, [t.id for t in tasks], TaskStatus.PROCESSING))
+
+    def lease_embedding_tasks(self, count: int, lease_seconds: int, max_attempts: int) -> list[Page]:
+        """
+        Claim up to `count` queued pages for embedding, shallowest first, and return them. Like `lease_tasks`, rows are
+        locked with SKIP LOCKED so any number of workers can share the queue. A page whose lease runs out is handed out
+        again, up to `max_attempts` times
+        """
+        lease = sql.SQL("UPDATE {} SET leased_until = NOW() + make_interval(secs => %s), attempts = attempts + 1 WHERE page_id = ANY(ARRAY(SELECT page_id FROM {} WHERE (leased_until IS NULL OR leased_until < NOW()) AND attempts < %s ORDER BY depth ASC, page_id ASC FOR UPDATE SKIP LOCKED LIMIT %s)) RETURNING page_id;").format(
+            sql.Identifier("EmbeddingTask"), sql.Identifier("EmbeddingTask"))
+        with self.cursor() as cursor:
+            cursor.execute(lease, (lease_seconds, max_attempts, count))
+            page_ids = [row['page_id'] for row in cursor.fetchall()]
+            cursor.execute('SELECT id, url, title, content FROM "Page" WHERE id = ANY(%s);', (page_ids,))
+            return [Page(**page) for page in cursor.fetchall()]
+
+    def release_embedding_tasks(self, pages: list[Page]):
+        """Give up the lease on queued pages so they are handed out again, as long as they have attempts left"""
+        if len(pages) == 0:
+            return
+        query = sql.SQL("UPDATE {} SET leased_until = NULL WHERE page_id = ANY(%s);").format(
+            sql.Identifier("EmbeddingTask"))
+        with self.connection() as conn:
+            conn.execute(query, ([p.id for p in pages],))
+
+    def embedding_backlog(self, max_attempts: int) -> dict[str, int]:
+        """Queued pages waiting for a worker, leased right now, and given up on after `max_attempts`"""
+        query = sql.SQL("""SELECT
+              COUNT(*) FILTER (WHERE (leased_until IS NULL OR leased_until < NOW()) AND attempts < %(max)s) AS waiting,
+              COUNT(*) FILTER (WHERE leased_until >= NOW()) AS leased,
+              COUNT(*) FILTER (WHERE (leased_until IS NULL OR leased_until < NOW()) AND attempts >= %(max)s) AS failed
+            FROM {};""").format(sql.Identifier("EmbeddingTask"))
+        with self.cursor() as cursor:
+            return cursor.execute(query, dict(max=max_attempts)).fetchone()
+
+    def warm_seen_urls(self) -> int:
+        """Create `seen_urls` and load the canonical keys of every existing task into it. Call once at startup"""
+        self.seen_urls = ScalableBloomFilter(
+            self.cfg.seen_urls_capacity, self.cfg.seen_urls_error_rate)
+        # Named (server side) cursor, so the table is streamed instead of loaded into memory at once
+        with self.connection() as conn, conn.cursor(name="warm_seen_urls") as cursor:
+            cursor.itersize = 50000
+            cursor.execute('SELECT url FROM "CrawlTask";')
+            added = self.seen_urls.update(canonical_key(row[0]) for row in cursor)
+
+        return added
+
+    def unseen_links(self, links: list[Link | LinkRef], staged: Optional[set[str]] = None) -> list[Link | LinkRef]:
+        """
+        Drop links we already have a task for under some variant of the url (http/https, www, utm params...), and
+        repeats within `links`. Nothing is marked as seen: call `mark_seen` once their tasks are committed. `staged` is
+        the canonical keys of links waiting to be written elsewhere; the keys of the returned links are added to it
+        """
+        staged = set() if staged is None else staged
+        unseen = []
+        for link in links:
+            key = canonical_key(link.url)
+            if key in staged or (self.seen_urls is not None and key in self.seen_urls):
+                continue
+            staged.add(key)
+            unseen.append(link)
+        return unseen
+
+    def mark_seen(self, links: list[Link | LinkRef]):
+        """Record links whose tasks are now in the database"""
+        if self.seen_urls is not None:
+            self.seen_urls.update(canonical_key(link.url) for link in links)
+
+    def add_tasks(self, links: list[Link | LinkRef]):
+        links = self.unseen_links(links)
+        if len(links) == 0:
+            return 0
+
         tasks_data = [{'status': TaskStatus.PENDING, 'url': link.url, 'depth': link.depth,
                        'parent_url': link.parent_url, 'text': link.text} for link in links]
 
         query = sql.SQL("INSERT INTO \"CrawlTask\" (status, url, depth, parent_url, text) VALUES (%(status)s, %(url)s, %(depth)s, %(parent_url)s, %(text)s) ON CONFLICT DO NOTHING;").format(
             sql.Identifier("CrawlTask"))
-        self._cursor.executemany(query, tasks_data)
-        self.conn.commit()
+        with self.connection() as conn:
+            conn.cursor().executemany(query, tasks_data)
+        # Only now: if the insert failed, a later sighting of these urls must still be able to add them
+        self.mark_seen(links)
 
         return len(links)
 
     def finish_task(self, task: CrawlTask):
+        self.set_task_status(task, TaskStatus.COMPLETED)
+
+    def set_task_status(self, task: CrawlTask, status: TaskStatus):
         query = sql.SQL("UPDATE {} SET status = %s WHERE id = %s;").format(
             sql.Identifier("CrawlTask"))
-        self._cursor.execute(query, (TaskStatus.COMPLETED, task.id))
-        self.conn.commit()
+        with self.connection() as conn:
+            conn.execute(query, (status, task.id))
 
     async def is_already_explored(self, url: str) -> bool:
         query = sql.SQL("SELECT 1 FROM {} WHERE parent_url = %s LIMIT 1;").format(
             sql.Identifier("CrawlTask"))
-        self._cursor.execute(query, (url,))
-        return self._cursor.fetchone() is not None
+        with self.connection() as conn:
+            return conn.execute(query, (url,)).fetchone() is not None
 
     def get_random_url(self) -> list[Page]:
         random_url_query = sql.SQL(
             """--sql
             SELECT url FROM "Page" WHERE depth < 1 ORDER BY RANDOM() LIMIT 1;""")
-        self._cursor.execute(random_url_query)
-        url = self._cursor.fetchone()['url']
+        with self.cursor() as cursor:
+            url = cursor.execute(random_url_query).fetchone()['url']
         return url
 
     def get_urls_by_depth(self, depth: int) -> list[str]:
         query = sql.SQL(
             """--sql
             SELECT url FROM "Page" WHERE depth < %s;""")
-        self._cursor.execute(query, (depth,))
-        return [p['url'] for p in self._cursor.fetchall()]
+        with self.cursor() as cursor:
+            return [p['url'] for p in cursor.execute(query, (depth,)).fetchall()]
 
     def get_network(self, center_url: str, depth: int) -> list[NodePage]:
 
@@ -181,59 +394,36 @@ class PostgresClient:
             JOIN PageGraph pg ON p.url = ANY(pg.outbound_urls) AND pg.depth < %s
         ) SELECT DISTINCT * FROM PageGraph;
         """)
-        self._cursor.execute(deep_query, (center_url, depth))
-        # ok when is p None though that should not happen lol
-        return [NodePage(**p) for p in self._cursor.fetchall()]
+        with self.cursor() as cursor:
+            # ok when is p None though that should not happen lol
+            return [NodePage(**p) for p in cursor.execute(deep_query, (center_url, depth)).fetchall()]
 
     def get_page(self, **kwargs) -> Page | None:
-        if 'id' in kwargs:
-            where_field = 'id'
-        elif 'url' in kwargs:
-            where_field = 'url'
-        else:
-            raise Exception("Must specify id or url")
-        query = sql.SQL(
-            'SELECT * FROM "Page" WHERE {} = %s LIMIT 1;').format(sql.Identifier(where_field))
-        self._cursor.execute(query, (kwargs[where_field],))
-        page = self._cursor.fetchone()
+        with self.cursor() as cursor:
+            page = cursor.execute(*page_query(**kwargs)).fetchone()
         if page:
             return Page(**page)
         else:
             return None
 
-    @classmethod
-    def _reorder_pages(cls, ids: list[int], pages: list[Page]) -> list[Page]:
-        index_hashmap = {id: idx for idx, id in enumerate(ids)}
-
-        # Remains in same order as ids list
-        return sorted(pages, key=lambda p: index_hashmap[p.id])
-
     def get_pages_by_url(self, urls: list[str]) -> list[NodePage]:
-        query = sql.SQL(
-            'SELECT id, outbound_urls, title, url FROM "Page" WHERE url = ANY(%s);')
-        self._cursor.execute(query, (urls,))
-
-        return [NodePage(**p) for p in self._cursor.fetchall()]
+        with self.cursor() as cursor:
+            return [NodePage(**p) for p in cursor.execute(NODES_BY_URL, (urls,)).fetchall()]
 
     def reverse_find_pages_by_url(self, page_url: str) -> list[NodePage]:
-        # Find pages that contain the urls in their outbound_urls
-        query = sql.SQL(
-            'SELECT id, outbound_urls, title, url FROM "Page" WHERE %s = ANY(outbound_urls);')
-        self._cursor.execute(query, (page_url,))
-
-        return [NodePage(**p) for p in self._cursor.fetchall()]
+        with self.cursor() as cursor:
+            return [NodePage(**p) for p in cursor.execute(NODES_LINKING_TO, (page_url,)).fetchall()]
 
     def get_pages_by_id(self, ids: list[int]) -> list[Page]:
-        query = sql.SQL('SELECT * FROM "Page" WHERE id = ANY(%s);')
-        self._cursor.execute(query, (ids,))
+        with self.cursor() as cursor:
+            pages = cursor.execute(PAGES_BY_ID, (ids,)).fetchall()
 
-        return PostgresClient._reorder_pages(ids, [Page(**page) for page in self._cursor.fetchall()])
+        return reorder_pages(ids, [Page(**page) for page in pages])
 
     def get_page_stubs_by_id(self, ids: list[int]) -> list[Page]:
-        query = sql.SQL(
-            'SELECT id, title, date, author, created_at, updated_at, outbound_urls, parent_url, url, content_hash, depth, page_rank FROM "Page" WHERE id = ANY(%s);')
-        self._cursor.execute(query, (ids,))
-        return PostgresClient._reorder_pages(ids, [Page(**page, content='') for page in self._cursor.fetchall()])
+        with self.cursor() as cursor:
+            pages = cursor.execute(PAGE_STUBS_BY_ID, (ids,)).fetchall()
+        return reorder_pages(ids, [Page(**page, content='') for page in pages])
 
     def __enter__(self):
         self.connect()
@@ -243,4 +433,59 @@ class PostgresClient:
         self.disconnect()
 
 
+class AsyncPostgresClient:
+    """
+    The read queries of `PostgresClient` on the async pool, for the API. A request waiting on the database yields to the
+    event loop instead of blocking every other request the worker is serving
+    """
+    pool: AsyncConnectionPool
+
+    T = TypeVar("T")
+
+    async def connect(self):
+        self.pool = await get_async_pool()
+
+    @asynccontextmanager
+    async def cursor(self, row_class: Optional[Type[T]] = None) -> AsyncIterator[Union[AsyncCursor[T], AsyncCursor[dict]]]:
+        async with self.pool.connection() as conn:
+            row_factory = class_row(row_class) if row_class else dict_row
+            async with conn.cursor(row_factory=row_factory) as cursor:
+                yield cursor
+
+    async def query(self, query: sql.SQL | str, *args):
+        async with self.cursor() as cursor:
+            await cursor.execute(query, *args)
+            if cursor.rowcount > 0:
+                return await cursor.fetchall()
+
+    async def get_page(self, **kwargs) -> Page | None:
+        async with self.cursor() as cursor:
+            await cursor.execute(*page_query(**kwargs))
+            page = await cursor.fetchone()
+        return Page(**page) if page else None
+
+    async def get_pages_by_url(self, urls: list[str]) -> list[NodePage]:
+        async with self.cursor() as cursor:
+            await cursor.execute(NODES_BY_URL, (urls,))
+            return [NodePage(**p) for p in await cursor.fetchall()]
+
+    async def reverse_find_pages_by_url(self, page_url: str) -> list[NodePage]:
+        async with self.cursor() as cursor:
+            await cursor.execute(NODES_LINKING_TO, (page_url,))
+            return [NodePage(**p) for p in await cursor.fetchall()]
+
+    async def get_pages_by_id(self, ids: list[int]) -> list[Page]:
+        async with self.cursor() as cursor:
+            await cursor.execute(PAGES_BY_ID, (ids,))
+            pages = await cursor.fetchall()
+        return reorder_pages(ids, [Page(**page) for page in pages])
+
+    async def get_page_stubs_by_id(self, ids: list[int]) -> list[Page]:
+        async with self.cursor() as cursor:
+            await cursor.execute(PAGE_STUBS_BY_ID, (ids,))
+            pages = await cursor.fetchall()
+        return reorder_pages(ids, [Page(**page, content='') for page in pages])
+
+
 pg_client = PostgresClient()
+async_pg_client = AsyncPostgresClient()
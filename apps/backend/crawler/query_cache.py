@@ -0,0 +1,211 @@
+"""
+Caches for /search text queries. Embedding a query costs an NLTK tokenization and a forward pass of the model, and
+popular queries come back again and again.
+
+`QueryVectorCache` keeps query vectors in an in-memory LRU, optionally backed by a directory of .npy files
+(QUERY_CACHE_DIR) so they survive restarts and are shared between the API's worker processes. `ResultCache` keeps the
+final result list of a query for a short time, since new pages and page ranks change it.
+
+Both are keyed on `normalize_query`, and count hits and misses for `/health/cache`.
+"""
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DEFAULT_VECTOR_ENTRIES = int(os.environ.get('QUERY_CACHE_ENTRIES', 4096))
+DEFAULT_VECTOR_DIR = os.environ.get('QUERY_CACHE_DIR')  # No disk tier unless set
+DEFAULT_DISK_ENTRIES = int(os.environ.get('QUERY_CACHE_DISK_ENTRIES', 100_000))
+DEFAULT_RESULT_ENTRIES = int(os.environ.get('RESULT_CACHE_ENTRIES', 1024))
+DEFAULT_RESULT_TTL_SECONDS = float(os.environ.get('RESULT_CACHE_TTL_SECONDS', 300))
+
+
+def normalize_query(query: str) -> str:
+    """
+    Queries that differ only in case or whitespace get the same vector (the model lowercases its input) and the same
+    full-text matches. Quotes are kept: they switch on full-text search
+    """
+    return ' '.join(query.lower().split())
+
+
+class QueryVectorCache:
+    max_entries: int
+    directory: Optional[str]
+    max_disk_entries: int
+    stats: dict[str, int]
+    _memory: OrderedDict[str, np.ndarray]
+    # Keys on disk, least recently used first
+    _disk_index: OrderedDict[str, None]
+
+    def __init__(self, max_entries: int = DEFAULT_VECTOR_ENTRIES, directory: Optional[str] = DEFAULT_VECTOR_DIR,
+                 max_disk_entries: int = DEFAULT_DISK_ENTRIES):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+        self._memory = OrderedDict()
+        self._disk_index = OrderedDict()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._load_disk_index()
+
+    def _load_disk_index(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.npy'):
+                files.append((entry.stat().st_mtime, entry.name[:-len('.npy')]))
+        files.sort()
+        self._disk_index = OrderedDict((key, None) for _, key in files)
+        self._evict_disk()
+
+    @staticmethod
+    def _key(query: str) -> str:
+        return hashlib.sha1(query.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.npy')
+
+    def get_or_compute(self, query: str, compute: Callable[[str], np.ndarray]) -> np.ndarray:
+        """The vector of `query`, calling `compute(query)` if it is in neither tier"""
+        query = normalize_query(query)
+        vector = self._memory.get(query)
+        if vector is not None:
+            self._memory.move_to_end(query)
+            self.stats['memory_hits'] += 1
+            return vector
+
+        vector = self._read_disk(query)
+        if vector is not None:
+            self.stats['disk_hits'] += 1
+        else:
+            self.stats['misses'] += 1
+            vector = compute(query)
+            self._write_disk(query, vector)
+
+        self._memory[query] = vector
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+        return vector
+
+    def _read_disk(self, query: str) -> Optional[np.ndarray]:
+        if self.directory is None:
+            return None
+        key = self._key(query)
+        if key not in self._disk_index:
+            # Another worker process may have written it since we listed the directory
+            if not os.path.exists(self._path(key)):
+                return None
+            self._disk_index[key] = None
+
+        try:
+            vector = np.load(self._path(key), allow_pickle=False)
+            os.utime(self._path(key))
+        except (OSError, ValueError):
+            # Evicted by another process or half written, treat as a miss
+            self._disk_index.pop(key, None)
+            return None
+        self._disk_index.move_to_end(key)
+        return vector
+
+    def _write_disk(self, query: str, vector: np.ndarray):
+        if self.directory is None:
+            return
+        key = self._key(query)
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, vector, allow_pickle=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # Full disk or read-only directory: the vector is still good, it is only kept in memory
+            print(f"Query cache: could not write {path}: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self._disk_index[key] = None
+        self._disk_index.move_to_end(key)
+        self._evict_disk()
+
+    def _evict_disk(self):
+        while len(self._disk_index) > self.max_disk_entries:
+            key, _ = self._disk_index.popitem(last=False)
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+
+class ResultCache:
+    """LRU of query results that expire `ttl_seconds` after they were computed"""
+    max_entries: int
+    ttl_seconds: float
+    stats: dict[str, int]
+    _entries: OrderedDict[str, tuple[float, Any]]
+
+    def __init__(self, max_entries: int = DEFAULT_RESULT_ENTRIES, ttl_seconds: float = DEFAULT_RESULT_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0}
+        self._entries = OrderedDict()
+
+    def get(self, query: str) -> Optional[Any]:
+        query = normalize_query(query)
+        entry = self._entries.get(query)
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[query]
+            self.stats['expired'] += 1
+            return None
+
+        self._entries.move_to_end(query)
+        self.stats['hits'] += 1
+        return value
+
+    def put(self, query: str, value: Any):
+        query = normalize_query(query)
+        self._entries[query] = (time.monotonic() + self.ttl_seconds, value)
+        self._entries.move_to_end(query)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+_vector_cache: Optional[QueryVectorCache] = None
+_result_cache: Optional[ResultCache] = None
+
+
+def get_vector_cache() -> QueryVectorCache:
+    """The process-wide query vector cache, created on first use"""
+    global _vector_cache
+    if _vector_cache is None:
+        _vector_cache = QueryVectorCache()
+    return _vector_cache
+
+
+def get_result_cache() -> ResultCache:
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = ResultCache()
+    return _result_cache
+
+
+def cache_stats() -> dict[str, dict[str, int]]:
+    stats = {}
+    if _vector_cache is not None:
+        stats['query_vectors'] = {**_vector_cache.stats, 'memory_entries': len(_vector_cache._memory),
+                                  'disk_entries': len(_vector_cache._disk_index)}
+    if _result_cache is not None:
+        stats['results'] = {**_result_cache.stats, 'entries': len(_result_cache._entries)}
+    return stats
@@ -0,0 +1,331 @@
+"""
+In-process nearest neighbour search over the page embeddings, so similarity queries don't scan Embeddings in Postgres.
+
+Postgres stays the source of truth. The snapshot in ANN_INDEX_DIR is a copy of the Embeddings table:
+
+    vectors.bin   memory-mapped float16 (or float32) matrix, one row per embedding window
+    urls.txt      the page url of each row, one per line
+    hnsw.bin      HNSW graph over the rows of vectors.bin (hnswlib, cosine distance like pgvector's <=>)
+    meta.json     number of rows, dtype, the highest Embeddings.id__ copied so far, and the ids copied near it
+
+Build it with `python -m crawler.recommendation.ann_index build`, and bring it up to date with `update` (only rows
+added since the last run are read). Rows are appended to vectors.bin first, and the graph is extended from the mapped
+matrix, so a build never holds the table in Python memory. Only one build/update runs at a time per directory, and
+readers only trust the rows counted in meta.json, which is written last.
+
+hnswlib can't search a memory-mapped matrix: the API loads hnsw.bin, with its own float32 copy of the vectors, into each
+process. vectors.bin is for the builds and anything else that reads the vectors (in the page cache, shared by every
+process that maps it).
+
+Embeddings.id__ comes from a sequence, so a transaction that started earlier can commit a lower id after we've copied
+higher ones. Every sync therefore looks again at the last SYNC_OVERLAP_IDS ids below the highest one copied, and copies
+the ones it hasn't got yet. A row whose transaction commits more than that many ids late is only picked up by a build.
+
+The API loads the snapshot at startup (`startup()`) and keeps it current in memory: new Embeddings rows are added to the
+graph right after it stores embeddings itself, and every ANN_SYNC_SECONDS for rows written by the embedding workers.
+The rows are added on the default executor, so a large sync doesn't hold up queries on the event loop. Rows of deleted
+pages are left in the index until the next build. They drop out of results because their page is gone.
+
+The index answers queries by vector (text queries, /search with a vector). Pages similar to a page are always ranked page
+to page from PageCentroid in Postgres, so a feed doesn't change with whether the index is loaded.
+
+Needs hnswlib (`poetry install -E ann`). Without ANN_INDEX_DIR, or without a snapshot, queries go to Postgres.
+"""
+import argparse
+import asyncio
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+import numpy as np
+from dotenv import load_dotenv
+from psycopg.rows import dict_row
+
+from ..dbaccess import disable_statement_timeout, get_async_pool, get_pool
+
+load_dotenv()
+
+DIM = 768
+DEFAULT_INDEX_DIR = os.environ.get('ANN_INDEX_DIR')
+DEFAULT_SYNC_SECONDS = float(os.environ.get('ANN_SYNC_SECONDS', 30))
+# HNSW parameters: graph degree, build-time and query-time beam width. `EF_SEARCH` must stay above the k we query
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 400
+EXPORT_BATCH_ROWS = 10_000
+# How far below the highest copied id a sync looks for rows committed out of order
+SYNC_OVERLAP_IDS = int(os.environ.get('ANN_SYNC_OVERLAP_IDS', 100_000))
+
+NEW_EMBEDDING_IDS = 'SELECT id__ FROM Embeddings WHERE id__ > %s ORDER BY id__'
+EMBEDDINGS_BY_ID = 'SELECT id__, url, vec::real[] AS vec FROM Embeddings WHERE id__ = ANY(%s) ORDER BY id__'
+
+
+class EmbeddingIndex:
+    directory: str
+    # Only build_index/update_index write the files, everyone else just adds rows in memory
+    writable: bool
+    dtype: str
+    count: int
+    last_id: int
+    # Ids copied within SYNC_OVERLAP_IDS of `last_id`, the ones a sync must not copy twice
+    recent_ids: set[int]
+    urls: list[str]
+    # Held while the graph is resized, which hnswlib doesn't allow during a query or an add
+    _resize_lock: threading.Lock
+    # One add at a time, they take the next labels
+    _add_lock: threading.Lock
+
+    def __init__(self, directory: str, writable: bool = False):
+        import hnswlib
+
+        self.directory = directory
+        self.writable = writable
+        self._resize_lock = threading.Lock()
+        self._add_lock = threading.Lock()
+        with open(self._path('meta.json')) as f:
+            meta = json.load(f)
+        # Snapshots written while vectors.bin was left out have no dtype, and need a build before an update
+        self.dtype = meta.get('dtype')
+        self.count = meta['count']
+        self.last_id = meta['last_id']
+        if 'recent_ids' in meta:
+            self.recent_ids = set(meta['recent_ids'])
+        else:
+            # Snapshot from before the overlap: take everything up to last_id as copied, like it did
+            self.recent_ids = set(range(self.sync_floor() + 1, self.last_id + 1))
+
+        with open(self._path('urls.txt')) as f:
+            self.urls = [line.rstrip('\n') for _, line in zip(range(self.count), f)]
+
+        self.hnsw = hnswlib.Index(space='cosine', dim=DIM)
+        self.hnsw.load_index(self._path('hnsw.bin'), max_elements=max(self.count, 1))
+        self.hnsw.set_ef(HNSW_EF_SEARCH)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def missing_ids(self, ids: list[int]) -> list[int]:
+        """Which of the ids Embeddings has past `sync_floor()` are not in the index yet"""
+        return [i for i in ids if i > self.last_id or (i > self.sync_floor() and i not in self.recent_ids)]
+
+    def sync_floor(self) -> int:
+        """Rows above this id are looked at again by every sync"""
+        return max(self.last_id - SYNC_OVERLAP_IDS, 0)
+
+    def export_new_rows(self) -> int:
+        """Append Embeddings rows added since the snapshot was taken to the files on disk. Hold `_lock` while calling"""
+        assert self.writable, "Open the index with writable=True to update the files"
+        assert self.dtype is not None, f"No vectors.bin in {self.directory}, build the index again"
+        added = 0
+        with get_pool().connection() as conn, conn.cursor(row_factory=dict_row) as cursor:
+            ids = self.missing_ids([row['id__'] for row in cursor.execute(NEW_EMBEDDING_IDS, (self.sync_floor(),))])
+            for batch_start in range(0, len(ids), EXPORT_BATCH_ROWS):
+                rows = cursor.execute(EMBEDDINGS_BY_ID, (ids[batch_start:batch_start + EXPORT_BATCH_ROWS],)).fetchall()
+                rows = self._new_rows(rows)
+                start = self.count
+                self._append_files(start, rows)
+                # The graph is built from the mapped matrix, like a reader of the snapshot would see it
+                self._add_to_graph(self.matrix(start + len(rows))[start:], rows)
+                added += len(rows)
+                print(f"ANN: Exported {self.count} rows")
+
+        self.hnsw.save_index(self._path('hnsw.bin.tmp'))
+        os.replace(self._path('hnsw.bin.tmp'), self._path('hnsw.bin'))
+        # meta.json is written last: a reader trusts only the first `count` rows of the other files
+        _write_meta(self.directory, dict(dim=DIM, dtype=self.dtype, count=self.count, last_id=self.last_id,
+                                         recent_ids=sorted(self.recent_ids)))
+        return added
+
+    def _append_files(self, start: int, rows: list[dict]):
+        offset = start * DIM * np.dtype(self.dtype).itemsize
+        with open(self._path('vectors.bin'), 'r+b') as f:
+            # Drop anything a crashed update left behind the last committed row
+            f.truncate(offset)
+        if rows:
+            matrix = np.memmap(self._path('vectors.bin'), dtype=self.dtype, mode='r+', offset=offset,
+                               shape=(len(rows), DIM))
+            matrix[:] = np.array([r['vec'] for r in rows], dtype=np.float32)
+            matrix.flush()
+
+        with open(self._path('urls.txt'), 'r+b') as f:
+            for _ in range(start):
+                f.readline()
+            f.truncate(f.tell())
+            f.writelines((r['url'] + '\n').encode('utf-8') for r in rows)
+
+    def matrix(self, count: Optional[int] = None) -> np.memmap:
+        """The first `count` exported vectors (the committed ones by default), without loading them into memory"""
+        count = self.count if count is None else count
+        if count == 0:
+            # An empty file can't be mapped
+            return np.empty((0, DIM), dtype=self.dtype)
+        return np.memmap(self._path('vectors.bin'), dtype=self.dtype, mode='r', shape=(count, DIM))
+
+    def add_rows(self, rows: list[dict]):
+        """
+        Add `{id__, url, vec}` rows of Embeddings to the in-memory graph, skipping rows it already has. Safe to call
+        off the event loop while it queries the index
+        """
+        with self._add_lock:
+            rows = self._new_rows(rows)
+            self._add_to_graph(np.array([r['vec'] for r in rows], dtype=np.float32), rows)
+
+    def _new_rows(self, rows: list[dict]) -> list[dict]:
+        missing = set(self.missing_ids([r['id__'] for r in rows]))
+        return [r for r in rows if r['id__'] in missing]
+
+    def _add_to_graph(self, vectors: np.ndarray, rows: list[dict]):
+        if len(rows) == 0:
+            return
+        needed = self.count + len(rows)
+        if needed > self.hnsw.get_max_elements():
+            with self._resize_lock:
+                self.hnsw.resize_index(max(needed, 2 * self.hnsw.get_max_elements()))
+
+        # Urls first: a query running alongside may already find the new labels
+        self.urls.extend(r['url'] for r in rows)
+        self.hnsw.add_items(np.asarray(vectors, dtype=np.float32), np.arange(self.count, needed))
+        self.count = needed
+        self.last_id = max(self.last_id, max(r['id__'] for r in rows))
+        floor = self.sync_floor()
+        self.recent_ids = {i for i in self.recent_ids if i > floor} | {r['id__'] for r in rows}
+
+    def nearest(self, vector: np.ndarray, k: int) -> Optional[list[tuple[str, float]]]:
+        """
+        The `k` closest rows as `(url, cosine distance)`, closest first. None while a sync is resizing the graph: rather
+        than wait for it on the event loop, ask Postgres
+        """
+        k = min(k, self.count)
+        if k == 0:
+            return []
+        if not self._resize_lock.acquire(blocking=False):
+            return None
+        try:
+            labels, distances = self.hnsw.knn_query(np.asarray(vector, dtype=np.float32).reshape(1, -1), k=k)
+        finally:
+            self._resize_lock.release()
+        return [(self.urls[label], float(distance)) for label, distance in zip(labels[0], distances[0])]
+
+
+def build_index(directory: str, dtype: str = 'float16') -> EmbeddingIndex:
+    """Export the whole Embeddings table to a new snapshot in `directory`"""
+    import hnswlib
+
+    os.makedirs(directory, exist_ok=True)
+    with _lock(directory):
+        hnsw = hnswlib.Index(space='cosine', dim=DIM)
+        hnsw.init_index(max_elements=1, ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_M)
+        hnsw.save_index(os.path.join(directory, 'hnsw.bin'))
+        open(os.path.join(directory, 'urls.txt'), 'w').close()
+        open(os.path.join(directory, 'vectors.bin'), 'wb').close()
+        _write_meta(directory, dict(dim=DIM, dtype=dtype, count=0, last_id=0, recent_ids=[]))
+
+        index = EmbeddingIndex(directory, writable=True)
+        index.export_new_rows()
+    return index
+
+
+def update_index(directory: str) -> EmbeddingIndex:
+    """Bring the snapshot in `directory` up to date with Embeddings"""
+    with _lock(directory):
+        # Loaded under the lock, so no other update can append behind our back
+        index = EmbeddingIndex(directory, writable=True)
+        added = index.export_new_rows()
+    print(f"ANN: Added {added} rows, {index.count} in total")
+    return index
+
+
+def _write_meta(directory: str, meta: dict):
+    path = os.path.join(directory, 'meta.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(path + '.tmp', path)
+
+
+@contextmanager
+def _lock(directory: str):
+    with open(os.path.join(directory, 'lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+_index: Optional[EmbeddingIndex] = None
+_sync_task: Optional[asyncio.Task] = None
+# The periodic sync and the one after the API stores embeddings would otherwise fetch the same rows
+_sync_lock = asyncio.Lock()
+
+
+def get_index() -> Optional[EmbeddingIndex]:
+    """The index loaded by `startup()`, or None to query Postgres"""
+    return _index
+
+
+async def sync_index():
+    """Add the rows written to Embeddings since the last sync to the loaded index, in memory only"""
+    if _index is None:
+        return
+    index = _index
+    async with _sync_lock:
+        pool = await get_async_pool()
+        async with pool.connection() as conn, conn.cursor(row_factory=dict_row) as cursor:
+            await cursor.execute(NEW_EMBEDDING_IDS, (index.sync_floor(),))
+            ids = index.missing_ids([row['id__'] for row in await cursor.fetchall()])
+            rows = []
+            if ids:
+                await cursor.execute(EMBEDDINGS_BY_ID, (ids,))
+                rows = await cursor.fetchall()
+        # Inserting into the graph takes seconds after a burst of new pages
+        await asyncio.get_running_loop().run_in_executor(None, index.add_rows, rows)
+    if rows:
+        print(f"ANN: Added {len(rows)} rows, {index.count} in total")
+
+
+async def _sync_periodically(seconds: float):
+    while True:
+        await asyncio.sleep(seconds)
+        try:
+            await sync_index()
+        except Exception as e:
+            print(f"ANN: Sync failed: {e}")
+
+
+async def startup(directory: Optional[str] = DEFAULT_INDEX_DIR, sync_seconds: float = DEFAULT_SYNC_SECONDS):
+    global _index, _sync_task
+    if directory is None or not os.path.exists(os.path.join(directory, 'meta.json')):
+        print("ANN: No index, similarity queries go to Postgres")
+        return
+
+    _index = EmbeddingIndex(directory)
+    print(f"ANN: Loaded {_index.count} rows from {directory}")
+    await sync_index()
+    _sync_task = asyncio.create_task(_sync_periodically(sync_seconds))
+
+
+async def shutdown():
+    global _index, _sync_task
+    if _sync_task is not None:
+        _sync_task.cancel()
+        _sync_task = None
+    _index = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["build", "update"])
+    parser.add_argument("--dir", default=DEFAULT_INDEX_DIR, required=DEFAULT_INDEX_DIR is None)
+    parser.add_argument("--dtype", choices=["float16", "float32"], default="float16")
+    args = parser.parse_args()
+
+    # A build reads the whole table, it can take longer than the API's statement_timeout
+    disable_statement_timeout()
+    if args.command == "build":
+        index = build_index(args.dir, args.dtype)
+        print(f"ANN: Built index of {index.count} rows in {args.dir}")
+    else:
+        update_index(args.dir)
@@ -0,0 +1,564 @@
+"""
+In-process BM25 index over the title and content of the pages, so /search gets lexical matches on every query without
+ts_rank going through "Page".
+
+Postgres stays the source of truth, like for the HNSW index in `ann_index`. BM25_INDEX_DIR holds a snapshot made of
+immutable segments:
+
+    NNNNNN.docs.npy     page id and length (in terms) of each document of the segment
+    NNNNNN.terms.npy    the segment's terms, sorted
+    NNNNNN.offsets.npy  byte offset, byte size and document frequency of each term's postings
+    NNNNNN.postings     per term, (document number delta, term frequency) pairs as varints
+    meta.json           the segments, the highest Page.id indexed so far and the ids indexed near it, written last
+
+Everything is memory-mapped, and only the postings of the query terms are decoded. Build the snapshot with
+`python -m crawler.recommendation.bm25_index build`, and add a segment for the pages stored since with `update`. Run
+`build` again now and then to fold the small segments of the updates back into SEGMENT_PAGES sized ones.
+
+Page.id comes from a sequence, so a transaction that started earlier can commit a lower id after we've indexed higher
+ones. Like `ann_index`, every sync and update looks again at the last SYNC_OVERLAP_IDS ids below the highest one indexed,
+and indexes the ones it hasn't got yet.
+
+The API loads the snapshot at startup (`startup()`). Pages it stores itself (`PostgresClient.store_raw_page`) are added
+to an in-memory segment right away, and pages written by the crawler workers every BM25_SYNC_SECONDS, tokenized off the
+event loop. Once the in-memory segment has MEMORY_SEGMENT_PAGES pages it is packed into arrays (`FrozenSegment`) and a
+new one is started. Deleted pages stay in the index until the next build. They drop out of results because their page
+is gone.
+
+Text is tokenized like Postgres' 'english' configuration: lowercased, stemmed, without stop words. Queries are a bag of
+words, the quotes and `-` of `websearch_to_tsquery` are not supported.
+"""
+import argparse
+import asyncio
+import fcntl
+import functools
+import json
+import math
+import mmap
+import os
+import re
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional
+
+import numpy as np
+from dotenv import load_dotenv
+from nltk.stem import PorterStemmer
+from psycopg.rows import dict_row
+
+from ..dbaccess import disable_statement_timeout, get_async_pool, get_pool
+
+load_dotenv()
+
+DEFAULT_INDEX_DIR = os.environ.get('BM25_INDEX_DIR')
+DEFAULT_SYNC_SECONDS = float(os.environ.get('BM25_SYNC_SECONDS', 30))
+# Okapi BM25 parameters: term frequency saturation and document length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+# A term in the title counts this many times, like the 'A' weight of the title in "Page".ts
+TITLE_WEIGHT = 2
+SEGMENT_PAGES = 50_000
+# Pages the API keeps in lists before packing them into a `FrozenSegment`
+MEMORY_SEGMENT_PAGES = 5_000
+EXPORT_BATCH_ROWS = 1_000
+# How far below the highest indexed id a sync looks for pages committed out of order
+SYNC_OVERLAP_IDS = int(os.environ.get('BM25_SYNC_OVERLAP_IDS', 100_000))
+MAX_TERM_LENGTH = 40
+
+STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between both but by
+can could did do does doing down during each few for from further had has have having he her here hers herself him
+himself his how i if in into is it its itself just me more most my myself no nor not now of off on once only or other
+our ours ourselves out over own same she should so some such than that the their theirs them themselves then there
+these they this those through to too under until up very was we were what when where which while who whom why will
+with would you your yours yourself yourselves
+""".split())
+
+NEW_PAGE_IDS = 'SELECT id FROM "Page" WHERE id > %s ORDER BY id'
+PAGES_BY_ID = 'SELECT id, title, content FROM "Page" WHERE id = ANY(%s) ORDER BY id'
+
+_WORD = re.compile(r'\w+')
+_stemmer = PorterStemmer()
+
+
+@functools.lru_cache(maxsize=200_000)
+def _stem(word: str) -> str:
+    return _stemmer.stem(word)
+
+
+def tokenize(text: str) -> list[str]:
+    return [_stem(word) for word in _WORD.findall(text.lower())
+            if word not in STOPWORDS and len(word) <= MAX_TERM_LENGTH]
+
+
+def document_terms(title: Optional[str], content: Optional[str]) -> Counter:
+    terms = Counter(tokenize(content or ''))
+    for term in tokenize(title or ''):
+        terms[term] += TITLE_WEIGHT
+    return terms
+
+
+def _rows_terms(rows: list[dict]) -> list[Counter]:
+    return [document_terms(row['title'], row['content']) for row in rows]
+
+
+def _sync_floor(last_id: int) -> int:
+    """Pages above this id are looked at again by every sync"""
+    return max(last_id - SYNC_OVERLAP_IDS, 0)
+
+
+def _missing_ids(ids: list[int], last_id: int, recent_ids: set[int]) -> list[int]:
+    """Which of the ids "Page" has past `_sync_floor(last_id)` are not indexed yet"""
+    floor = _sync_floor(last_id)
+    return [i for i in ids if i > last_id or (i > floor and i not in recent_ids)]
+
+
+def _recent_ids(meta: dict) -> set[int]:
+    if 'recent_ids' in meta:
+        return set(meta['recent_ids'])
+    # Snapshot from before the overlap: take everything up to last_id as indexed, like it did
+    return set(range(_sync_floor(meta['last_id']) + 1, meta['last_id'] + 1))
+
+
+def encode_varints(values: np.ndarray) -> tuple[bytes, np.ndarray]:
+    """
+    LEB128 varints: 7 bits a byte, least significant first, the high bit set on all but the last byte of a value.
+    Returns the bytes and the size of each value
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    sizes = np.ones(len(values), dtype=np.int64)
+    for i in range(1, 10):
+        sizes += values >= np.uint64(1 << (7 * i))
+
+    starts = np.cumsum(sizes) - sizes
+    out = np.empty(int(sizes.sum()), dtype=np.uint8)
+    for i in range(int(sizes.max(initial=0))):
+        has = sizes > i
+        low = (values[has] >> np.uint64(7 * i)) & np.uint64(0x7f)
+        more = (sizes[has] > i + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[has] + i] = low | more
+    return out.tobytes(), sizes
+
+
+def decode_varints(buf: np.ndarray) -> np.ndarray:
+    """Inverse of `encode_varints`, for values below 2**53 (they are summed as float64)"""
+    ends = np.flatnonzero(buf < 0x80)
+    sizes = np.diff(ends, prepend=-1)
+    value = np.repeat(np.arange(len(ends)), sizes)
+    position = np.arange(len(buf)) - np.repeat(ends - sizes + 1, sizes)
+    parts = (buf & 0x7f).astype(np.uint64) << (7 * position).astype(np.uint64)
+    return np.bincount(value, weights=parts, minlength=len(ends)).astype(np.int64)
+
+
+_NO_POSTINGS = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+
+class MemorySegment:
+    """Documents that aren't in a segment file (yet). Postings are `(document number, term frequency)` lists"""
+    ids: list[int]
+    doc_lengths: list[int]
+    postings: dict[str, list[tuple[int, int]]]
+    total_length: int
+    # Arrays `lengths` and `get` made from the lists, used while the list is as long as when they were made. Searches
+    # run in a thread while the event loop adds documents, so nothing is invalidated by the adding side
+    _lengths: np.ndarray
+    _arrays: dict[str, tuple[int, np.ndarray, np.ndarray]]
+
+    def __init__(self):
+        self.ids = []
+        self.doc_lengths = []
+        self.postings = {}
+        self.total_length = 0
+        self._lengths = np.zeros(0, dtype=np.int64)
+        self._arrays = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        lengths = self._lengths
+        if len(lengths) != len(self.doc_lengths):
+            lengths = self._lengths = np.array(self.doc_lengths, dtype=np.int64)
+        return lengths
+
+    def add(self, page_id: int, title: Optional[str], content: Optional[str]):
+        self.add_terms(page_id, document_terms(title, content))
+
+    def add_terms(self, page_id: int, terms: Counter):
+        doc = len(self.ids)
+        length = sum(terms.values())
+        self.ids.append(page_id)
+        self.doc_lengths.append(length)
+        self.total_length += length
+        for term, frequency in terms.items():
+            self.postings.setdefault(term, []).append((doc, frequency))
+
+    def df(self, term: str) -> int:
+        return len(self.postings.get(term, ()))
+
+    def get(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        """Document numbers and term frequencies of the documents containing `term`"""
+        postings = self.postings.get(term)
+        if not postings:
+            return _NO_POSTINGS
+        cached = self._arrays.get(term)
+        if cached is not None and cached[0] == len(postings):
+            return cached[1], cached[2]
+        pairs = np.array(postings, dtype=np.int64)
+        self._arrays[term] = len(pairs), pairs[:, 0], pairs[:, 1]
+        return pairs[:, 0], pairs[:, 1]
+
+    def write(self, directory: str, name: str):
+        """Write the documents as segment `name` of `directory`"""
+        terms = sorted(self.postings)
+        pairs = [np.array(self.postings[term], dtype=np.int64) for term in terms]
+        for p in pairs:
+            p[:, 0] = np.diff(p[:, 0], prepend=0)
+        data, sizes = encode_varints(np.concatenate([p.ravel() for p in pairs]) if pairs else [])
+
+        offsets = np.zeros((len(terms), 3), dtype=np.int64)
+        if terms:
+            values_per_term = np.array([p.size for p in pairs])
+            offsets[:, 1] = np.add.reduceat(sizes, np.cumsum(values_per_term) - values_per_term)
+            offsets[:, 0] = np.cumsum(offsets[:, 1]) - offsets[:, 1]
+            offsets[:, 2] = values_per_term // 2
+
+        path = os.path.join(directory, name)
+        with open(path + '.postings', 'wb') as f:
+            f.write(data)
+        np.save(path + '.terms.npy', np.array(terms, dtype=f'<U{MAX_TERM_LENGTH}'))
+        np.save(path + '.offsets.npy', offsets)
+        np.save(path + '.docs.npy', np.array([self.ids, self.doc_lengths], dtype=np.int64).T.reshape(-1, 2))
+
+
+class FrozenSegment:
+    """A full `MemorySegment` packed into arrays: the postings of each term are a slice of `docs` and `frequencies`"""
+    ids: np.ndarray
+    lengths: np.ndarray
+    total_length: int
+
+    def __init__(self, memory: MemorySegment):
+        self.ids = np.array(memory.ids, dtype=np.int64)
+        self.lengths = np.array(memory.doc_lengths, dtype=np.int64)
+        self.total_length = memory.total_length
+        self.terms = {term: i for i, term in enumerate(memory.postings)}
+        counts = np.array([len(p) for p in memory.postings.values()], dtype=np.int64)
+        self.starts = np.concatenate([[0], np.cumsum(counts)])
+        pairs = np.array([pair for p in memory.postings.values() for pair in p], dtype=np.int64).reshape(-1, 2)
+        self.docs = np.ascontiguousarray(pairs[:, 0])
+        self.frequencies = np.ascontiguousarray(pairs[:, 1])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def df(self, term: str) -> int:
+        i = self.terms.get(term)
+        return 0 if i is None else int(self.starts[i + 1] - self.starts[i])
+
+    def get(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        i = self.terms.get(term)
+        if i is None:
+            return _NO_POSTINGS
+        start, end = self.starts[i], self.starts[i + 1]
+        return self.docs[start:end], self.frequencies[start:end]
+
+
+class Segment:
+    """A segment on disk, memory-mapped"""
+    ids: np.ndarray
+    lengths: np.ndarray
+    total_length: int
+
+    def __init__(self, directory: str, name: str):
+        path = os.path.join(directory, name)
+        docs = np.load(path + '.docs.npy', mmap_mode='r')
+        self.ids = docs[:, 0]
+        self.lengths = docs[:, 1]
+        self.total_length = int(self.lengths.sum())
+        self.terms = np.load(path + '.terms.npy', mmap_mode='r')
+        self.offsets = np.load(path + '.offsets.npy', mmap_mode='r')
+        self.postings = b''
+        if os.path.getsize(path + '.postings') > 0:
+            with open(path + '.postings', 'rb') as f:
+                self.postings = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _find(self, term: str) -> Optional[int]:
+        i = int(np.searchsorted(self.terms, term))
+        if i < len(self.terms) and self.terms[i] == term:
+            return i
+        return None
+
+    def df(self, term: str) -> int:
+        i = self._find(term)
+        return 0 if i is None else int(self.offsets[i, 2])
+
+    def get(self, term: str) -> tuple[np.ndarray, np.ndarray]:
+        i = self._find(term)
+        if i is None:
+            return _NO_POSTINGS
+        offset, size, _ = self.offsets[i]
+        buf = np.frombuffer(self.postings, dtype=np.uint8, count=int(size), offset=int(offset))
+        pairs = decode_varints(buf).reshape(-1, 2)
+        return np.cumsum(pairs[:, 0]), pairs[:, 1]
+
+
+class BM25Index:
+    directory: str
+    segments: list[Segment]
+    # Pages added since the snapshot was taken, in this process only: full in-memory segments, and the one being filled
+    frozen: list[FrozenSegment]
+    memory: MemorySegment
+    # Highest Page.id indexed, and the ids indexed within SYNC_OVERLAP_IDS of it
+    synced_id: int
+    recent_ids: set[int]
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        self.segments = [Segment(directory, name) for name in meta['segments']]
+        self.synced_id = meta['last_id']
+        self.recent_ids = _recent_ids(meta)
+        self.frozen = []
+        self.memory = MemorySegment()
+
+    def __len__(self):
+        return sum(len(s) for s in [*self.segments, *self.frozen, self.memory])
+
+    def sync_floor(self) -> int:
+        return _sync_floor(self.synced_id)
+
+    def missing_ids(self, ids: list[int]) -> list[int]:
+        return _missing_ids(ids, self.synced_id, self.recent_ids)
+
+    def add_page(self, page_id: int, title: Optional[str], content: Optional[str]):
+        if self.missing_ids([page_id]):
+            self.add_terms(page_id, document_terms(title, content))
+
+    def add_terms(self, page_id: int, terms: Counter):
+        """Add a page tokenized with `document_terms`, unless the index has it already"""
+        if not self.missing_ids([page_id]):
+            return
+        self.memory.add_terms(page_id, terms)
+        self.synced_id = max(self.synced_id, page_id)
+        self.recent_ids.add(page_id)
+        # At most SYNC_OVERLAP_IDS of them are above the floor, so this drops the rest every so often
+        if len(self.recent_ids) > 2 * SYNC_OVERLAP_IDS:
+            floor = self.sync_floor()
+            self.recent_ids = {i for i in self.recent_ids if i > floor}
+        if len(self.memory) >= MEMORY_SEGMENT_PAGES:
+            self.frozen.append(FrozenSegment(self.memory))
+            self.memory = MemorySegment()
+
+    def search(self, text: str, k: int) -> list[tuple[int, float]]:
+        """
+        The `k` best matching pages for `text` as `(page id, BM25 score)`, best first. Safe to call from a thread while
+        pages are added: it searches the pages the index had when it started
+        """
+        segments = [*self.segments, *self.frozen, self.memory]
+        docs = sum(len(s) for s in segments)
+        terms = set(tokenize(text))
+        if docs == 0 or not terms:
+            return []
+        average_length = sum(s.total_length for s in segments) / docs
+
+        scores = [np.zeros(len(s)) for s in segments]
+        lengths = [s.lengths for s in segments]
+        for term in terms:
+            df = sum(s.df(term) for s in segments)
+            if df == 0:
+                continue
+            idf = math.log(1 + (docs - df + 0.5) / (df + 0.5))
+            for s, segment_scores, segment_lengths in zip(segments, scores, lengths):
+                matches, frequencies = s.get(term)
+                if len(matches) == 0:
+                    continue
+                if matches[-1] >= len(segment_scores):
+                    # Added to the memory segment since the search started
+                    keep = matches < len(segment_scores)
+                    matches, frequencies = matches[keep], frequencies[keep]
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * segment_lengths[matches] / average_length)
+                # Document numbers are unique within a term, so this adds once per document
+                segment_scores[matches] += idf * frequencies * (BM25_K1 + 1) / (frequencies + norm)
+
+        best: list[tuple[int, float]] = []
+        for s, segment_scores in zip(segments, scores):
+            top = np.flatnonzero(segment_scores)
+            if len(top) > k:
+                top = top[np.argpartition(-segment_scores[top], k)[:k]]
+            best.extend((int(s.ids[doc]), float(segment_scores[doc])) for doc in top)
+        best.sort(key=lambda match: match[1], reverse=True)
+        return best[:k]
+
+
+def _export(directory: str, meta: dict) -> list[str]:
+    """Write the pages `meta` doesn't have yet as new segments, updating `meta`. Hold `_lock` while calling"""
+    written = []
+    segment = MemorySegment()
+    last_id, recent_ids = meta['last_id'], _recent_ids(meta)
+
+    def flush():
+        nonlocal segment
+        name = f"{meta['next_segment']:06d}"
+        segment.write(directory, name)
+        meta['next_segment'] += 1
+        written.append(name)
+        print(f"BM25: Wrote segment {name} of {len(segment)} pages")
+        segment = MemorySegment()
+
+    with get_pool().connection() as conn, conn.cursor(row_factory=dict_row) as cursor:
+        ids = [row['id'] for row in cursor.execute(NEW_PAGE_IDS, (_sync_floor(last_id),))]
+        ids = _missing_ids(ids, last_id, recent_ids)
+        for batch_start in range(0, len(ids), EXPORT_BATCH_ROWS):
+            for row in cursor.execute(PAGES_BY_ID, (ids[batch_start:batch_start + EXPORT_BATCH_ROWS],)).fetchall():
+                segment.add(row['id'], row['title'], row['content'])
+                recent_ids.add(row['id'])
+                last_id = max(last_id, row['id'])
+            if len(segment) >= SEGMENT_PAGES:
+                flush()
+    if len(segment) > 0:
+        flush()
+    meta['last_id'] = last_id
+    meta['recent_ids'] = sorted(i for i in recent_ids if i > _sync_floor(last_id))
+    return written
+
+
+def build_index(directory: str) -> BM25Index:
+    """Index every page into a new snapshot in `directory`, replacing the segments that were there"""
+    os.makedirs(directory, exist_ok=True)
+    with _lock(directory):
+        old = _read_meta(directory)
+        # New segment names, so an API process still reading the old ones isn't disturbed
+        meta = dict(segments=[], last_id=0, recent_ids=[], next_segment=old['next_segment'] if old else 0)
+        meta['segments'] = _export(directory, meta)
+        _write_meta(directory, meta)
+        if old:
+            for name in old['segments']:
+                for suffix in ('.docs.npy', '.terms.npy', '.offsets.npy', '.postings'):
+                    os.remove(os.path.join(directory, name + suffix))
+    return BM25Index(directory)
+
+
+def update_index(directory: str) -> BM25Index:
+    """Add the pages stored since the last build or update to the snapshot in `directory`, as a new segment"""
+    with _lock(directory):
+        meta = _read_meta(directory)
+        assert meta is not None, f"No BM25 index in {directory}, build one first"
+        written = _export(directory, meta)
+        meta['segments'] += written
+        _write_meta(directory, meta)
+    index = BM25Index(directory)
+    print(f"BM25: Added {len(written)} segments, {len(index)} pages in total")
+    return index
+
+
+def _read_meta(directory: str) -> Optional[dict]:
+    path = os.path.join(directory, 'meta.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_meta(directory: str, meta: dict):
+    path = os.path.join(directory, 'meta.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(path + '.tmp', path)
+
+
+@contextmanager
+def _lock(directory: str):
+    with open(os.path.join(directory, 'lock'), 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+_index: Optional[BM25Index] = None
+_sync_task: Optional[asyncio.Task] = None
+
+
+def get_index() -> Optional[BM25Index]:
+    """The index loaded by `startup()`, or None to search with ts_rank in Postgres"""
+    return _index
+
+
+def add_pages(pages: list) -> None:
+    """Make just-stored pages searchable in this process, if it has the index loaded"""
+    if _index is None:
+        return
+    for page in pages:
+        _index.add_page(page.id, page.title, page.content)
+
+
+async def sync_index():
+    """Add the pages stored since the last sync to the loaded index, in memory only"""
+    if _index is None:
+        return
+    pool = await get_async_pool()
+    loop = asyncio.get_running_loop()
+    added = 0
+    async with pool.connection() as conn, conn.cursor(row_factory=dict_row) as cursor:
+        await cursor.execute(NEW_PAGE_IDS, (_index.sync_floor(),))
+        ids = _index.missing_ids([row['id'] for row in await cursor.fetchall()])
+        for batch_start in range(0, len(ids), EXPORT_BATCH_ROWS):
+            await cursor.execute(PAGES_BY_ID, (ids[batch_start:batch_start + EXPORT_BATCH_ROWS],))
+            rows = await cursor.fetchall()
+            # Stemming is CPU bound, so tokenize in a thread and only add the terms on the event loop
+            terms = await loop.run_in_executor(None, _rows_terms, rows)
+            for row, page_terms in zip(rows, terms):
+                _index.add_terms(row['id'], page_terms)
+            added += len(rows)
+    if added:
+        print(f"BM25: Added {added} pages, {len(_index)} in total")
+
+
+async def _sync_periodically(seconds: float):
+    while True:
+        await asyncio.sleep(seconds)
+        try:
+            await sync_index()
+        except Exception as e:
+            print(f"BM25: Sync failed: {e}")
+
+
+async def startup(directory: Optional[str] = DEFAULT_INDEX_DIR, sync_seconds: float = DEFAULT_SYNC_SECONDS):
+    global _index, _sync_task
+    if directory is None or not os.path.exists(os.path.join(directory, 'meta.json')):
+        print("BM25: No index, full-text search goes to Postgres")
+        return
+
+    _index = BM25Index(directory)
+    print(f"BM25: Loaded {len(_index)} pages from {directory}")
+    await sync_index()
+    _sync_task = asyncio.create_task(_sync_periodically(sync_seconds))
+
+
+async def shutdown():
+    global _index, _sync_task
+    if _sync_task is not None:
+        _sync_task.cancel()
+        _sync_task = None
+    _index = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["build", "update"])
+    parser.add_argument("--dir", default=DEFAULT_INDEX_DIR, required=DEFAULT_INDEX_DIR is None)
+    args = parser.parse_args()
+
+    # A build reads the whole table, it can take longer than the API's statement_timeout
+    disable_statement_timeout()
+    if args.command == "build":
+        index = build_index(args.dir)
+        print(f"BM25: Built index of {len(index)} pages in {args.dir}")
+    else:
+        update_index(args.dir)
@@ -1,5 +1,7 @@
+import argparse
 import asyncio
 import os
+import time
 from multiprocessing import freeze_support
 from typing import Callable, Iterator, Optional
 
@@ -10,12 +12,13 @@ from crawler.prismac import PostgresClient
 from dotenv import load_dotenv
 from prisma import Prisma, models
 from prisma.models import Page
-from psycopg import Cursor, sql
+from psycopg import AsyncCursor, Cursor, sql
 from psycopg.rows import dict_row
 from pydantic import BaseModel
-from sentence_transformers import SentenceTransformer
 
-from ..dbaccess import DB, db
+from ..dbaccess import get_async_pool, get_pool
+from . import ann_index
+from .embedding_backends import OnnxBackend, TorchBackend, get_backend
 
 load_dotenv()
 
@@ -24,6 +27,23 @@ client = Prisma()
 assert len(os.environ['DATABASE_URL_PG']) > 1, "DATABASE_URL not set"
 assert len(os.environ['DATABASE_URL_SUPABASE']) > 1, "DATABASE_URL not set"
 
+# Windows per forward pass. Bigger batches keep the CPU busier, at the cost of memory
+DEFAULT_EMBEDDING_BATCH_SIZE = 64
+# Only the first few windows of a page are embedded to save computation
+MAX_WINDOWS_PER_PAGE = 3
+
+# Window vectors looked at per similarity query, and pages returned
+SIMILAR_NEIGHBOURS = 250
+SIMILAR_LIMIT = 20
+
+# Embedding queue (the EmbeddingTask table), see `generate_embeddings`
+DEFAULT_PAGES_PER_LEASE = 50
+DEFAULT_EMBEDDING_LEASE_SECONDS = 600
+# A page that failed to embed or whose lease ran out this many times is left in the queue and skipped
+MAX_EMBEDDING_ATTEMPTS = 3
+EMPTY_QUEUE_SLEEP_SECONDS = 5
+METRICS_INTERVAL_SECONDS = 30
+
 
 def overlapping_windows(s: str, stride: int = 100, size: int = 120) -> Iterator[str]:
     arr: list[str] = nltk.word_tokenize(s)
@@ -34,10 +54,13 @@ def overlapping_windows(s: str, stride: int = 100, size: int = 120) -> Iterator[
 
 
 class Embedder:
-    model: SentenceTransformer
+    backend: TorchBackend | OnnxBackend
+    batch_size: int
 
-    def __init__(self):
-        self.model = SentenceTransformer('BAAI/bge-base-en-v1.5')
+    def __init__(self, backend: Optional[str] = None):
+        """`backend` is "torch" or "onnx", defaulting to EMBEDDING_BACKEND. See `embedding_backends`"""
+        self.backend = get_backend(backend)
+        self.batch_size = int(os.environ.get('EMBEDDING_BATCH_SIZE', DEFAULT_EMBEDDING_BATCH_SIZE))
 
     def embed(self, text: str, stride: int = 360, size: int = 380, for_query: bool = False) -> np.ndarray:
         """
@@ -47,23 +70,19 @@ class Embedder:
         :param text:
         :return: ndarray of shape (n, 768) where n is the number of windows
         """
+        return self.encode(self.windows(text, stride, size, for_query))
 
+    def windows(self, text: str, stride: int = 360, size: int = 380, for_query: bool = False) -> list[str]:
         windows = list(overlapping_windows(text, stride, size))
 
         if for_query:
             windows = [
                 "Represent this sentence for searching relevant passages:" + x for x in windows]
         # Trim to first N windows only to save computation
-        if len(windows) > 3:
-            windows = windows[0:3]
-
-        return self.encode(windows)
-
-    def encode(self, windows):
-        result = self.model.encode(windows, normalize_embeddings=True)
-        print("Using device", self.model.device)
+        return windows[0:MAX_WINDOWS_PER_PAGE]
 
-        return result
+    def encode(self, windows: list[str]) -> np.ndarray:
+        return self.backend.encode(windows, self.batch_size)
 
     def generate_vecs(self, title: str, content: str, url: str) -> list[tuple[str, int, list]]:
         """
@@ -85,6 +104,25 @@ class Embedder:
             )
         return to_append
 
+    def generate_vecs_for_pages(self, pages: list[Page]) -> list[tuple[str, int, list]]:
+        """
+        `generate_vecs` for many pages with a single `encode` call, so windows of different pages share batches
+
+        :return: List of tuples of (url, index, vec), in page order
+        """
+        owners: list[tuple[str, int]] = []
+        windows: list[str] = []
+        for p in pages:
+            page_windows = self.windows(p.title + " " + p.content)
+            owners.extend((p.url, idx) for idx in range(len(page_windows)))
+            windows.extend(page_windows)
+
+        if len(windows) == 0:
+            return []
+
+        embeddings = self.encode(windows)
+        return [(url, idx, e.tolist()) for (url, idx), e in zip(owners, embeddings)]
+
 
 class NearestNeighboursQuery(BaseModel):
     vector: Optional[np.ndarray]
@@ -93,6 +131,10 @@ class NearestNeighboursQuery(BaseModel):
     # (Case 2) Search by URL similarity (article already exists in the DB)
     url: Optional[str]
 
+    # The page's precomputed mean vector. Pages stored before PageCentroid existed fall back to averaging their windows
+    VECTOR_FOR_URL = 'SELECT c.vec::real[] as vec FROM "PageCentroid" c JOIN "Page" p ON p.id = c.page_id WHERE p.url = %(url)s'
+    MEAN_VECTOR_FOR_URL = 'SELECT avg(vec)::real[] as vec, url FROM Embeddings WHERE url = %(url)s GROUP BY url'
+
     class Config:
         arbitrary_types_allowed = True
 
@@ -108,8 +150,18 @@ class NearestNeighboursQuery(BaseModel):
         It's insanely slow if we do it in the same query using a CTE because postgres optimizer
         """
         if self.vector is None:
-            result = cursor.execute(
-                'SELECT avg(vec) as vec, url FROM Embeddings WHERE url = %(url)s GROUP BY url', dict(url=self.url)).fetchall()
+            result = cursor.execute(self.VECTOR_FOR_URL, dict(url=self.url)).fetchall()
+            if not result:
+                result = cursor.execute(self.MEAN_VECTOR_FOR_URL, dict(url=self.url)).fetchall()
+            self.vector = np.array(result[0]['vec'])
+
+    async def get_vector_async(self, cursor: AsyncCursor):
+        if self.vector is None:
+            await cursor.execute(self.VECTOR_FOR_URL, dict(url=self.url))
+            result = await cursor.fetchall()
+            if not result:
+                await cursor.execute(self.MEAN_VECTOR_FOR_URL, dict(url=self.url))
+                result = await cursor.fetchall()
             self.vector = np.array(result[0]['vec'])
 
     def to_sql_expr(self) -> tuple[str, dict]:
@@ -121,7 +173,7 @@ class NearestNeighboursQuery(BaseModel):
             return 'SELECT avg(vec) as vec, url FROM Embeddings WHERE url = %(url)s GROUP BY url', dict(url=self.url)
 
 
-def _query_fts(query: str) -> list[PageResponse]:
+def _fts_query(query: str) -> sql.Composed:
     """
     Query using full-text search for exact word matches
 
@@ -143,9 +195,12 @@ def _query_fts(query: str) -> list[PageResponse]:
         FROM "Page"
         WHERE ts @@ {query}
         ORDER BY score DESC LIMIT 50""").format(query=sql.SQL("websearch_to_tsquery('english', {})").format(query))
-    cursor = db.cursor(row_factory=dict_row)
+    return sql_query
+
 
-    similar = cursor.execute(sql_query, ).fetchall()
+def _query_fts(query: str) -> list[PageResponse]:
+    with get_pool().connection() as conn:
+        similar = conn.cursor(row_factory=dict_row).execute(_fts_query(query), ).fetchall()
 
     return [PageResponse.from_page_dict(x) for x in similar]
 
@@ -193,6 +248,18 @@ def _query_similar(query: NearestNeighboursQuery) -> list[PageResponse]:
     else:
         fts_results = []
 
+    return _combine_results(embedding_results, fts_results)
+
+
+async def query_similar(query: NearestNeighboursQuery) -> list[PageResponse]:
+    """
+    The embedding search of `_query_similar` on the async pool, for request handlers. Text queries go through
+    `hybrid_search`, which runs FTS alongside
+    """
+    return _combine_results(await _query_similar_embeddings_async(query), [])
+
+
+def _combine_results(embedding_results: list[PageResponse], fts_results: list[PageResponse]) -> list[PageResponse]:
     # Normalize scores
     for p in fts_results:
         p.score = 2.5 * (p.score ** 1.5) + 1.5
@@ -226,31 +293,120 @@ def _query_similar(query: NearestNeighboursQuery) -> list[PageResponse]:
     return combined
 
 
-def _query_similar_embeddings(query: NearestNeighboursQuery) -> list[PageResponse]:
-    cursor = db.cursor(row_factory=dict_row)
-    query.get_vector(cursor)
-
-    want_cte, want_cte_dict = query.to_sql_expr()
-
+def _embedding_weight(query: NearestNeighboursQuery) -> float:
     # if it's a text query, then vector search is more useless
-    embedding_weight = 0.25 if query.text_query is not None else 1.0
+    return 0.25 if query.text_query is not None else 1.0
 
-    want_cte_dict['embedding_weight'] = embedding_weight
-    similar = cursor.execute(f"""
+
+def _similar_embeddings_query(query: NearestNeighboursQuery) -> tuple[str, dict]:
+    """Call once `query.vector` is known"""
+    want_cte, want_cte_dict = query.to_sql_expr()
+    want_cte_dict['embedding_weight'] = _embedding_weight(query)
+    return f"""
     -- Get average of the first X vectors for the article we WANT
 WITH want AS ({want_cte}),
  matching_vecs AS (
         SELECT e.vec <=> w.vec as dist, e.url as url from Embeddings as e, want as w 
             WHERE e.url != w.url
-            ORDER BY dist LIMIT 250
+            ORDER BY dist LIMIT %(neighbours)s
  ),
  domain_counts AS (SELECT COUNT(url) as num_matching_windows, AVG(dist) as dist, MIN(url) as url FROM matching_vecs GROUP BY url)
  select "Page".*,
  -- Scoring algorithm: (similarity * page_rank^0.5 * (amount of matching windows ^ 0.15))
  -- Higher is better
  COALESCE((1 - dist) ^ %(embedding_weight)s * (COALESCE("Page".page_rank, 1) ^ 1.0) * (domain_counts.num_matching_windows ^ (0.20 * %(embedding_weight)s)), -1) as score
-  from "Page" INNER JOIN domain_counts ON domain_counts.url = "Page".url  ORDER BY score DESC LIMIT 20
-    """, want_cte_dict).fetchall()
+  from "Page" INNER JOIN domain_counts ON domain_counts.url = "Page".url  ORDER BY score DESC LIMIT %(limit)s
+    """, dict(want_cte_dict, neighbours=SIMILAR_NEIGHBOURS, limit=SIMILAR_LIMIT)
+
+
+def _similar_pages_query(query: NearestNeighboursQuery) -> tuple[str, dict]:
+    """
+    Pages similar to the page `query.url`: one probe of the PageCentroid vector index, instead of matching windows
+    against every window in Embeddings. Scored like `_similar_embeddings_query`, with the page's centroid as its only
+    window. Call once `query.vector` is known
+    """
+    want_cte, want_cte_dict = query.to_sql_expr()
+    want_cte_dict['embedding_weight'] = _embedding_weight(query)
+    return f"""
+WITH want AS ({want_cte}),
+ matching_pages AS (
+        SELECT c.vec <=> w.vec as dist, c.page_id from "PageCentroid" as c, want as w
+            ORDER BY dist LIMIT %(neighbours)s
+ )
+ select "Page".*,
+ COALESCE((1 - dist) ^ %(embedding_weight)s * (COALESCE("Page".page_rank, 1) ^ 1.0), -1) as score
+  from "Page" INNER JOIN matching_pages ON matching_pages.page_id = "Page".id
+  WHERE "Page".url != %(url)s
+  ORDER BY score DESC LIMIT %(limit)s
+    """, dict(want_cte_dict, neighbours=SIMILAR_NEIGHBOURS, limit=SIMILAR_LIMIT)
+
+
+def _similar_query(query: NearestNeighboursQuery, by_page: bool) -> tuple[str, dict]:
+    return _similar_pages_query(query) if by_page else _similar_embeddings_query(query)
+
+
+def _use_ann_index(query: NearestNeighboursQuery) -> Optional[ann_index.EmbeddingIndex]:
+    """
+    The in-process index if it is loaded and the query is by vector. A query by url is always scored page to page
+    (`_similar_pages_query`), so its ranking is the same whether the index is loaded or not
+    """
+    index = ann_index.get_index()
+    if index is None or query.vector is None:
+        return None
+    return index
+
+
+def _nearest_urls(index: Optional[ann_index.EmbeddingIndex],
+                  query: NearestNeighboursQuery) -> Optional[dict[str, tuple[int, float]]]:
+    """
+    The `matching_vecs` and `domain_counts` steps of `_similar_embeddings_query` on the in-process index:
+    url -> (number of matching windows, mean distance). None if there's no index or it can't answer right now
+    """
+    if index is None:
+        return None
+    neighbours = index.nearest(query.vector, SIMILAR_NEIGHBOURS)
+    return _group_windows(neighbours) if neighbours is not None else None
+
+
+def _group_windows(neighbours: list[tuple[str, float]]) -> dict[str, tuple[int, float]]:
+    windows: dict[str, list[float]] = {}
+    for url, dist in neighbours:
+        windows.setdefault(url, []).append(dist)
+    return {url: (len(dists), sum(dists) / len(dists)) for url, dists in windows.items()}
+
+
+def _score_pages(query: NearestNeighboursQuery, matches: dict[str, tuple[int, float]], pages: list[dict]) -> list[PageResponse]:
+    """The scoring of `_similar_embeddings_query`, for pages found through the in-process index"""
+    weight = _embedding_weight(query)
+    scored = []
+    for page in pages:
+        num_matching_windows, dist = matches[page['url']]
+        similarity = 1 - dist
+        if similarity < 0:
+            # Postgres can't raise a negative number to a fractional power either, the query falls back to -1
+            score = -1
+        else:
+            score = similarity ** weight * ((page['page_rank'] or 1) ** 1.0) * (num_matching_windows ** (0.20 * weight))
+        scored.append(PageResponse.from_prisma_page(Page(**page), score))
+
+    scored.sort(key=lambda p: p.score, reverse=True)
+    return scored[:SIMILAR_LIMIT]
+
+
+def _query_similar_embeddings(query: NearestNeighboursQuery) -> list[PageResponse]:
+    matches = _nearest_urls(_use_ann_index(query), query)
+    if matches is not None:
+        with get_pool().connection() as conn:
+            pages = conn.cursor(row_factory=dict_row).execute(
+                'SELECT * FROM "Page" WHERE url = ANY(%s)', (list(matches),)).fetchall()
+        return _score_pages(query, matches, pages)
+
+    # A page looked up by url (the feed, /search of a stored page) is compared page to page
+    by_page = query.vector is None
+    with get_pool().connection() as conn:
+        cursor = conn.cursor(row_factory=dict_row)
+        query.get_vector(cursor)
+        similar = cursor.execute(*_similar_query(query, by_page)).fetchall()
 
     similar_urls = [
         PageResponse.from_prisma_page(Page(**x), x['score']) for x in similar
@@ -259,44 +415,172 @@ WITH want AS ({want_cte}),
     return similar_urls
 
 
+async def _query_similar_embeddings_async(query: NearestNeighboursQuery) -> list[PageResponse]:
+    pool = await get_async_pool()
+    matches = _nearest_urls(_use_ann_index(query), query)
+    if matches is not None:
+        async with pool.connection() as conn:
+            cursor = conn.cursor(row_factory=dict_row)
+            await cursor.execute('SELECT * FROM "Page" WHERE url = ANY(%s)', (list(matches),))
+            pages = await cursor.fetchall()
+        return _score_pages(query, matches, pages)
+
+    by_page = query.vector is None
+    async with pool.connection() as conn:
+        cursor = conn.cursor(row_factory=dict_row)
+        await query.get_vector_async(cursor)
+        await cursor.execute(*_similar_query(query, by_page))
+        similar = await cursor.fetchall()
+
+    return [PageResponse.from_prisma_page(Page(**x), x['score']) for x in similar]
+
+
 async def generate_feed_from_page(url: str) -> list[PageResponse]:
     query = NearestNeighboursQuery(url=url)
-    similar = _query_similar(query)
+    similar = await query_similar(query)
     return similar
 
 
-async def store_embeddings_for_pages(pages: list[Page]):
-    to_append = []
-    print("Calculating embeddings for {} pages".format(len(pages)))
-    for i, p in enumerate(pages):
-        print(f'{i}: Generating embeddings for {p.title} from ({p.url})',)
-        data = model.generate_vecs(p.title, p.content, p.url)
-        to_append.extend(data)
+# `_similar_pages_query` for many pages at once: each page's centroid probes the index in a LATERAL subquery
+SIMILAR_TO_PAGES = """
+WITH want AS (
+  SELECT p.url AS want_url, c.vec FROM "Page" p JOIN "PageCentroid" c ON c.page_id = p.id WHERE p.url = ANY(%(urls)s)
+),
+ scored AS (
+  SELECT w.want_url, "Page".id,
+    COALESCE((1 - m.dist) ^ %(embedding_weight)s * (COALESCE("Page".page_rank, 1) ^ 1.0), -1) as score
+  FROM want w
+  CROSS JOIN LATERAL (
+    SELECT c.page_id, c.vec <=> w.vec as dist FROM "PageCentroid" c ORDER BY c.vec <=> w.vec LIMIT %(neighbours)s
+  ) m
+  JOIN "Page" ON "Page".id = m.page_id
+  WHERE "Page".url != w.want_url
+ ),
+ ranked AS (
+  SELECT *, row_number() OVER (PARTITION BY want_url ORDER BY score DESC) AS rank FROM scored
+ )
+SELECT ranked.want_url, ranked.score, "Page".* FROM ranked JOIN "Page" ON "Page".id = ranked.id
+WHERE ranked.rank <= %(limit)s
+"""
 
-    cur = db.cursor()
-    cur.executemany("""INSERT INTO Embeddings ("url", "index", "vec") VALUES (%s, %s, %s)""", [
-                    (x[0], x[1], x[2]) for x in to_append])
-    db.commit()
 
+async def similar_to_pages(urls: list[str]) -> dict[str, list[PageResponse]]:
+    """
+    `generate_feed_from_page` for many pages in one search instead of one per page: url -> similar pages, best first.
+    Pages without embeddings are left out
+    """
+    urls = list(dict.fromkeys(urls))
+    feeds: dict[str, list[PageResponse]] = {}
+    if not urls:
+        return feeds
+
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cursor = conn.cursor(row_factory=dict_row)
+        await cursor.execute(SIMILAR_TO_PAGES, dict(urls=urls, embedding_weight=1.0, neighbours=SIMILAR_NEIGHBOURS,
+                                                    limit=SIMILAR_LIMIT))
+        for row in await cursor.fetchall():
+            want_url = row.pop('want_url')
+            feeds.setdefault(want_url, []).append(PageResponse.from_prisma_page(Page(**row), row['score']))
+
+    # Same normalization `query_similar` gives the results of a single page
+    for url, similar in feeds.items():
+        feeds[url] = _combine_results(similar, [])
+    return feeds
+
+
+# Recompute the PageCentroid of the given pages from their windows
+UPDATE_CENTROIDS = """
+    INSERT INTO "PageCentroid" (page_id, vec)
+    SELECT p.id, avg(e.vec) FROM "Page" p JOIN Embeddings e ON e.url = p.url WHERE p.id = ANY(%s) GROUP BY p.id
+    ON CONFLICT (page_id) DO UPDATE SET vec = EXCLUDED.vec
+"""
+
+
+async def store_embeddings_for_pages(pages: list[Page]) -> int:
+    """Embed and store the pages, and take them off the embedding queue. Returns the number of vectors stored"""
+    print("Calculating embeddings for {} pages".format(len(pages)))
+    to_append = model.generate_vecs_for_pages(pages)
+    print(f"Storing {len(to_append)} embeddings")
+
+    with get_pool().connection() as conn:
+        with conn.cursor().copy("""COPY Embeddings ("url", "index", "vec") FROM STDIN""") as copy:
+            for url, idx, vec in to_append:
+                # pgvector's text format, same as the literal in `NearestNeighboursQuery.to_sql_expr`
+                copy.write_row((url, idx, str(vec)))
+        page_ids = [p.id for p in pages]
+        conn.execute(UPDATE_CENTROIDS, (page_ids,))
+        conn.execute('DELETE FROM "EmbeddingTask" WHERE page_id = ANY(%s)', (page_ids,))
+
+    # Make the pages searchable right away if this process serves similarity queries from the in-process index. The
+    # embeddings are committed by now, so a failure here must not make the caller embed the pages again
+    try:
+        await ann_index.sync_index()
+    except Exception as e:
+        print(f"Could not sync the ANN index, it catches up on the next sync: {e}")
+    return len(to_append)
+
+
+async def embed_leased_pages(db: PostgresClient, pages: list[Page]) -> int:
+    """
+    `store_embeddings_for_pages` for pages leased from the queue. If the batch fails, the pages are tried one at a time,
+    so one bad page doesn't hold back the others. A page that fails on its own is released, to be tried again until it
+    runs out of attempts. Returns the number of vectors stored
+    """
+    try:
+        return await store_embeddings_for_pages(pages)
+    except Exception as e:
+        print(f"Embedding {len(pages)} pages failed, trying them one at a time: {e}")
+
+    vectors = 0
+    for page in pages:
+        try:
+            vectors += await store_embeddings_for_pages([page])
+        except Exception as e:
+            print(f"Embedding page {page.id} ({page.url}) failed: {e}")
+            db.release_embedding_tasks([page])
+    return vectors
+
+
+async def generate_embeddings(db: PostgresClient, pages_per_lease: int = DEFAULT_PAGES_PER_LEASE,
+                              lease_seconds: int = DEFAULT_EMBEDDING_LEASE_SECONDS):
+    """
+    Embed pages from the EmbeddingTask queue until stopped. Pages are queued by `PostgresClient.store_raw_page` and the
+    crawler's write buffer.
 
-async def generate_embeddings(db: PostgresClient):
-    global model
+    Start as many of these as you like, on one machine or several: each batch is leased with SKIP LOCKED, so no two
+    workers embed the same page, and a batch whose worker died is picked up again once its lease runs out
+    """
+    pages_done = vectors_done = 0
+    last_report = time.monotonic()
 
     while True:
-        pages = db.cursor(Page).execute(
-            '''SELECT p.* FROM "Page" AS p LEFT JOIN Embeddings AS e ON p.url = e.url WHERE e.url IS NULL ORDER BY p.depth ASC LIMIT 50''').fetchall()
+        pages = db.lease_embedding_tasks(pages_per_lease, lease_seconds, MAX_EMBEDDING_ATTEMPTS)
+        if len(pages) > 0:
+            vectors_done += await embed_leased_pages(db, pages)
+            pages_done += len(pages)
+
+        elapsed = time.monotonic() - last_report
+        if elapsed >= METRICS_INTERVAL_SECONDS:
+            backlog = db.embedding_backlog(MAX_EMBEDDING_ATTEMPTS)
+            print(f"Embedded {pages_done / elapsed:.1f} pages/s, {vectors_done / elapsed:.1f} vectors/s. Backlog: "
+                  f"{backlog['waiting']} waiting, {backlog['leased']} leased, {backlog['failed']} failed")
+            pages_done = vectors_done = 0
+            last_report = time.monotonic()
 
         if len(pages) == 0:
-            print("ERR: No pages to process")
-            return
-
-        await store_embeddings_for_pages(pages)
+            await asyncio.sleep(EMPTY_QUEUE_SLEEP_SECONDS)
 
 model = Embedder()
 
 
 if __name__ == "__main__":
     freeze_support()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages_per_lease", type=int, default=DEFAULT_PAGES_PER_LEASE)
+    parser.add_argument("--lease_seconds", type=int, default=DEFAULT_EMBEDDING_LEASE_SECONDS)
+    args = parser.parse_args()
+
     client = PostgresClient()
     client.connect()
-    asyncio.run(generate_embeddings(client))
+    asyncio.run(generate_embeddings(client, args.pages_per_lease, args.lease_seconds))
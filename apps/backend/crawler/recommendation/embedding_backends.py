@@ -0,0 +1,135 @@
+"""
+Inference backends for `Embedder`. Pick one with EMBEDDING_BACKEND:
+
+    torch  sentence-transformers on PyTorch (default)
+    onnx   the same model exported to ONNX and run with ONNX Runtime (`poetry install -E onnx`). Set
+           EMBEDDING_QUANTIZE=1 for int8 dynamic quantization and EMBEDDING_THREADS to pin the number of threads
+
+The ONNX export is done once with PyTorch and cached in EMBEDDING_ONNX_DIR (default ~/.cache/resonant/onnx). After that
+only the tokenizer and ONNX Runtime are used.
+"""
+import os
+from typing import Optional
+
+import numpy as np
+
+MODEL_NAME = 'BAAI/bge-base-en-v1.5'
+DEFAULT_ONNX_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'resonant', 'onnx')
+ONNX_OPSET = 14
+
+
+class TorchBackend:
+    def __init__(self, model_name: str = MODEL_NAME):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+        print("Using device", self.model.device)
+
+    def encode(self, windows: list[str], batch_size: int) -> np.ndarray:
+        # encode() sorts the windows by length before batching, so each batch is padded to about the same length, and
+        # returns the vectors in input order
+        return self.model.encode(windows, batch_size=batch_size, normalize_embeddings=True)
+
+
+class OnnxBackend:
+    """
+    The transformer of the sentence-transformers model run by ONNX Runtime. Pooling is done here: BGE models embed a
+    text as its normalized [CLS] vector
+    """
+
+    def __init__(self, model_name: str = MODEL_NAME, quantize: bool = False, threads: Optional[int] = None,
+                 cache_dir: Optional[str] = None):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        cache_dir = os.path.join(cache_dir or DEFAULT_ONNX_DIR, model_name.replace('/', '--'))
+        path = os.path.join(cache_dir, 'model.onnx')
+        if not os.path.exists(path):
+            export_onnx(model_name, cache_dir)
+        if quantize:
+            path = quantize_onnx(path)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(cache_dir)
+        with open(os.path.join(cache_dir, 'max_seq_length')) as f:
+            self.max_seq_length = int(f.read())
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # One batch at a time, so all threads go to the matrix multiplications within an operator
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.inter_op_num_threads = 1
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        print(f"Using ONNX Runtime ({'int8' if quantize else 'fp32'}, {threads or 'default'} threads): {path}")
+
+    def encode(self, windows: list[str], batch_size: int) -> np.ndarray:
+        if len(windows) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        # Longest first like sentence-transformers, so a batch is padded to about the same length
+        order = sorted(range(len(windows)), key=lambda i: -len(windows[i]))
+        result: list[Optional[np.ndarray]] = [None] * len(windows)
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            tokens = self.tokenizer([windows[i] for i in batch], padding=True, truncation=True,
+                                    max_length=self.max_seq_length, return_tensors='np')
+            inputs = {name: value.astype(np.int64) for name, value in tokens.items() if name in self.input_names}
+            hidden = self.session.run(None, inputs)[0]
+            cls = hidden[:, 0]
+            cls = cls / np.linalg.norm(cls, axis=1, keepdims=True)
+            for i, vec in zip(batch, cls):
+                result[i] = vec
+
+        return np.stack(result)
+
+
+def export_onnx(model_name: str, out_dir: str):
+    """Export the transformer of a sentence-transformers model, with its tokenizer, to `out_dir`"""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    st = SentenceTransformer(model_name, device='cpu')
+    transformer = st[0]
+    os.makedirs(out_dir, exist_ok=True)
+    transformer.tokenizer.save_pretrained(out_dir)
+    with open(os.path.join(out_dir, 'max_seq_length'), 'w') as f:
+        f.write(str(st.max_seq_length))
+
+    sample = transformer.tokenizer(['an example sentence'], return_tensors='pt')
+    input_names = list(sample.keys())
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in input_names}
+    dynamic_axes['last_hidden_state'] = {0: 'batch', 1: 'sequence'}
+
+    model = transformer.auto_model.eval()
+    tmp_path = os.path.join(out_dir, 'model.onnx.tmp')
+    with torch.no_grad():
+        torch.onnx.export(model, tuple(sample[name] for name in input_names), tmp_path,
+                          input_names=input_names, output_names=['last_hidden_state'],
+                          dynamic_axes=dynamic_axes, opset_version=ONNX_OPSET)
+    # Rename last, so an interrupted export isn't mistaken for a finished one
+    os.replace(tmp_path, os.path.join(out_dir, 'model.onnx'))
+    print(f"Exported {model_name} to {out_dir}")
+
+
+def quantize_onnx(path: str) -> str:
+    """int8 dynamic quantization of the weights, cached next to the fp32 model"""
+    quantized = path.replace('.onnx', '.int8.onnx')
+    if not os.path.exists(quantized):
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        tmp_path = quantized + '.tmp'
+        quantize_dynamic(path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, quantized)
+    return quantized
+
+
+def get_backend(name: Optional[str] = None):
+    name = name or os.environ.get('EMBEDDING_BACKEND', 'torch')
+    if name == 'torch':
+        return TorchBackend()
+    if name == 'onnx':
+        threads = os.environ.get('EMBEDDING_THREADS')
+        return OnnxBackend(quantize=os.environ.get('EMBEDDING_QUANTIZE', '0') == '1',
+                           threads=int(threads) if threads else None,
+                           cache_dir=os.environ.get('EMBEDDING_ONNX_DIR'))
+    raise ValueError(f"Unknown embedding backend {name}, expected torch or onnx")
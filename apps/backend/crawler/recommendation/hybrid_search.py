@@ -0,0 +1,120 @@
+"""
+Hybrid retrieval for /search text queries: full-text search and the embedding search run side by side, and their
+rankings are merged with reciprocal rank fusion (RRF). Full-text search uses the in-process BM25 index (`bm25_index`)
+when it is loaded, and `websearch_to_tsquery` over "Page".ts otherwise.
+
+RRF only looks at the rank of a page in each list, so the BM25 or ts_rank scores of FTS and the cosine based scores
+of the embedding search don't have to be put on the same scale first. A page scores sum(1 / (RRF_K + rank)) over the
+lists it is in.
+
+Each branch has its own deadline (FTS_TIMEOUT_SECONDS, VECTOR_TIMEOUT_SECONDS). A branch that misses it or fails is
+left out and the other one's results are returned on their own. The Postgres FTS query also gets the deadline as its
+statement_timeout, so Postgres stops working on it too.
+"""
+import asyncio
+import os
+import time
+from typing import Awaitable, Optional
+
+from api.page_response import PageResponse
+from dotenv import load_dotenv
+from prisma.models import Page
+from psycopg.errors import QueryCanceled
+from psycopg.rows import dict_row
+
+from ..dbaccess import get_async_pool
+from . import bm25_index
+from .embedding import (NearestNeighboursQuery, _fts_query,
+                        _query_similar_embeddings_async)
+
+load_dotenv()
+
+# The usual RRF constant: damps the difference between the first few ranks so one list can't decide the top alone
+RRF_K = 60
+DEFAULT_FTS_TIMEOUT_SECONDS = float(os.environ.get('FTS_TIMEOUT_SECONDS', 0.5))
+DEFAULT_VECTOR_TIMEOUT_SECONDS = float(os.environ.get('VECTOR_TIMEOUT_SECONDS', 1.0))
+# As many matches as `_fts_query` returns
+FTS_LIMIT = 50
+
+stats = {'fts_timeouts': 0, 'fts_errors': 0, 'vector_timeouts': 0, 'vector_errors': 0}
+
+
+def reciprocal_rank_fusion(rankings: list[list[PageResponse]], k: int = RRF_K) -> list[PageResponse]:
+    """Merge rankings (best first) into one, scored by the sum of 1 / (k + rank) with ranks starting at 1"""
+    pages: dict[int, PageResponse] = {}
+    scores: dict[int, float] = {}
+    for ranking in rankings:
+        for rank, page in enumerate(ranking, start=1):
+            pages.setdefault(page.id, page)
+            scores[page.id] = scores.get(page.id, 0) + 1 / (k + rank)
+
+    for page_id, page in pages.items():
+        page.score = scores[page_id]
+    return sorted(pages.values(), key=lambda p: p.score, reverse=True)
+
+
+async def fts_branch(text: str, timeout: float = DEFAULT_FTS_TIMEOUT_SECONDS) -> list[PageResponse]:
+    """Full-text matches, best first"""
+    index = bm25_index.get_index()
+    if index is not None:
+        return await bm25_branch(index, text)
+    return await postgres_fts_branch(text, timeout)
+
+
+async def bm25_branch(index: bm25_index.BM25Index, text: str) -> list[PageResponse]:
+    # Scoring is CPU bound, keep it off the event loop so the vector branch runs alongside
+    matches = await asyncio.get_running_loop().run_in_executor(None, index.search, text, FTS_LIMIT)
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cursor = conn.cursor(row_factory=dict_row)
+        await cursor.execute('SELECT * FROM "Page" WHERE id = ANY(%s)', ([page_id for page_id, _ in matches],))
+        pages = {row['id']: row for row in await cursor.fetchall()}
+    return [PageResponse.from_prisma_page(Page(**pages[page_id]), score)
+            for page_id, score in matches if page_id in pages]
+
+
+async def postgres_fts_branch(text: str, timeout: float = DEFAULT_FTS_TIMEOUT_SECONDS) -> list[PageResponse]:
+    """`websearch_to_tsquery` over "Page".ts"""
+    pool = await get_async_pool()
+    async with pool.connection() as conn:
+        cursor = conn.cursor(row_factory=dict_row)
+        # Local to this transaction, the connection keeps the pool's timeout afterwards
+        await cursor.execute("SELECT set_config('statement_timeout', %s, true)", (str(int(timeout * 1000)),))
+        await cursor.execute(_fts_query(text))
+        rows = await cursor.fetchall()
+    return [PageResponse.from_page_dict(row) for row in rows]
+
+
+async def vector_branch(query: NearestNeighboursQuery) -> list[PageResponse]:
+    """The embedding search of `query_similar` (HNSW index or Postgres), best first"""
+    return await _query_similar_embeddings_async(query)
+
+
+async def _run_branch(name: str, branch: Awaitable[list[PageResponse]], timeout: float) -> Optional[list[PageResponse]]:
+    """The branch's results, or None if it missed its deadline or failed"""
+    start = time.perf_counter()
+    try:
+        # A little slack, so a statement_timeout on the server side is reported as the timeout it is
+        return await asyncio.wait_for(branch, timeout * 1.1)
+    except (asyncio.TimeoutError, QueryCanceled):
+        stats[f'{name}_timeouts'] += 1
+        print(f"Hybrid search: {name} branch timed out after {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        stats[f'{name}_errors'] += 1
+        print(f"Hybrid search: {name} branch failed: {e}")
+    return None
+
+
+async def hybrid_search(query: NearestNeighboursQuery, fts_timeout: float = DEFAULT_FTS_TIMEOUT_SECONDS,
+                        vector_timeout: float = DEFAULT_VECTOR_TIMEOUT_SECONDS) -> tuple[list[PageResponse], bool]:
+    """
+    Both branches for a text query with its vector, fused with RRF. Whatever branches finish in time make up the
+    results, so they are partial (or empty) when one is slow. Returns the results and whether both branches made it
+    """
+    assert query.text_query, "Hybrid search needs the text of the query"
+    fts, vector = await asyncio.gather(
+        _run_branch('fts', fts_branch(query.text_query, fts_timeout), fts_timeout),
+        _run_branch('vector', vector_branch(query), vector_timeout),
+    )
+    rankings = [r for r in (vector, fts) if r is not None]
+    return reciprocal_rank_fusion(rankings), len(rankings) == 2
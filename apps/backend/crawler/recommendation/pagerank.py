@@ -9,6 +9,7 @@ from psycopg import Connection
 from psycopg.rows import kwargs_row
 
 from crawler.dbaccess import db
+from crawler.link import canonical_key
 
 from dotenv import load_dotenv
 
@@ -117,6 +118,35 @@ def insert_pagerank(db: Connection, scores: dict[int, float]):
     db.commit()
 
 
+# Read by ../pagerank
+PAGES_JSON = "/tmp/file.json"
+
+
+def export_pages(path: str = PAGES_JSON):
+    """
+    Dump the link graph for the Rust pagerank. Every url is replaced by its canonical key, so the http/https, www,
+    trailing slash and tracking parameter variants of a page are a single node
+    """
+    cursor = db.cursor(name="export_pages")
+    cursor.itersize = 10000
+    cursor.execute('SELECT id, url, outbound_urls, depth FROM "Page";')
+
+    count = 0
+    with open(path, "w+") as f:
+        f.write("[")
+        for id, url, outbound_urls, depth in cursor:
+            if count > 0:
+                f.write(",")
+            json.dump({"id": id, "url": canonical_key(url), "depth": depth,
+                       "outbound_urls": [canonical_key(u) for u in outbound_urls]}, f)
+            count += 1
+        f.write("]")
+
+    cursor.close()
+    db.commit()
+    print(f"Exported {count} pages to {path}")
+
+
 def combine_domain_and_page_scores(domains: dict[str, float], pages: dict[str, float]) -> dict[str, float]:
     pages_combined = {}
     for url, page_score in pages.items():
@@ -154,6 +184,8 @@ def main():
     # print(topurls)
     # return
 
+    export_pages()
+
     cmd = ["cargo", "run", "--release", "--", "quiet"]
     result = subprocess.run(cmd, stdout=subprocess.PIPE, cwd="../pagerank")
 
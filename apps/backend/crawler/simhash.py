@@ -0,0 +1,61 @@
+"""
+SimHash fingerprints for near-duplicate detection.
+
+Each page gets a 64-bit fingerprint built from its word 3-shingles. Pages that differ by a few lines (syndicated copies,
+a changed footer) have fingerprints a few bits apart. The fingerprint is split into `NUM_BANDS` bands of 16 bits. Two
+fingerprints within `MAX_DISTANCE` bits of each other must agree on at least one whole band, so looking up each band
+exactly finds every candidate.
+"""
+import re
+from typing import Optional
+
+import mmh3
+import numpy as np
+
+NUM_BITS = 64
+NUM_BANDS = 4
+BAND_BITS = NUM_BITS // NUM_BANDS
+# Fingerprints this many bits apart or closer are duplicates. Must stay below NUM_BANDS for the banded lookup to be exact
+MAX_DISTANCE = 3
+SHINGLE_SIZE = 3
+# Shorter pages have too few shingles for a meaningful fingerprint (and are mostly filtered out anyway)
+MIN_TOKENS = 50
+
+_TOKEN = re.compile(r"\w+")
+_BIT_POSITIONS = np.arange(NUM_BITS, dtype=np.uint64)
+
+
+def simhash(text: str) -> Optional[int]:
+    """Unsigned 64-bit fingerprint of `text`, or `None` if it is too short to fingerprint"""
+    tokens = _TOKEN.findall(text.lower())
+    if len(tokens) < MIN_TOKENS:
+        return None
+
+    shingles = [' '.join(tokens[i:i + SHINGLE_SIZE])
+                for i in range(len(tokens) - SHINGLE_SIZE + 1)]
+    hashes, counts = np.unique(np.fromiter((mmh3.hash64(s, signed=False)[0] for s in shingles),
+                                           dtype=np.uint64, count=len(shingles)), return_counts=True)
+
+    # For every bit: +count for shingles that have it set, -count for those that don't
+    bits = ((hashes[:, None] >> _BIT_POSITIONS) & np.uint64(1)).astype(np.int64)
+    votes = (2 * bits - 1).T @ counts
+
+    return sum(1 << int(i) for i in np.flatnonzero(votes > 0))
+
+
+def bands(fingerprint: int) -> list[int]:
+    mask = (1 << BAND_BITS) - 1
+    return [(fingerprint >> (i * BAND_BITS)) & mask for i in range(NUM_BANDS)]
+
+
+def distance(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+
+def to_signed(fingerprint: int) -> int:
+    """Postgres BIGINT is signed"""
+    return fingerprint - (1 << NUM_BITS) if fingerprint >= 1 << (NUM_BITS - 1) else fingerprint
+
+
+def from_signed(value: int) -> int:
+    return value & ((1 << NUM_BITS) - 1)
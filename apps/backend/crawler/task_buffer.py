@@ -0,0 +1,94 @@
+import asyncio
+import time
+from collections import deque
+from typing import Optional
+
+from prisma.models import CrawlTask
+
+from .config import Config
+from .prismac import PostgresClient
+
+# How often (in seconds) a buffer sweeps the table for tasks whose lease ran out
+RECLAIM_INTERVAL = 60
+# Buffered tasks get their lease extended once less than this share of it is left
+RENEW_FRACTION = 0.5
+
+
+class TaskBuffer:
+    """
+    Worker-local prefetch buffer of leased `CrawlTask`s.
+
+    Instead of one round trip per task, the buffer leases `task_batch_size` tasks at a time and refills once it drops to
+    `task_low_water_mark`. The leases of buffered tasks are renewed before they run out, so a task waiting behind a slow
+    batch isn't reclaimed and handed to a second worker. Tasks that are still buffered when the worker stops are
+    released back to PENDING. The queries run on the default executor, not on the event loop.
+    """
+    prisma: PostgresClient
+    config: Config
+    _tasks: deque[CrawlTask]
+    # Monotonic time at which the lease of each buffered task runs out, by task id
+    _expires: dict[int, float]
+    _last_reclaim: float
+
+    def __init__(self, *, prisma: PostgresClient, config: Config):
+        self.prisma = prisma
+        self.config = config
+        self._tasks = deque()
+        self._expires = {}
+        self._last_reclaim = 0
+
+    def __len__(self):
+        return len(self._tasks)
+
+    async def get(self) -> Optional[CrawlTask]:
+        """Returns the next task to crawl, or `None` if there are no more tasks in the database"""
+        await self.renew()
+        if len(self._tasks) <= self.config.task_low_water_mark:
+            await self.refill()
+
+        if len(self._tasks) == 0:
+            return None
+        task = self._tasks.popleft()
+        del self._expires[task.id]
+        return task
+
+    async def refill(self):
+        if time.monotonic() - self._last_reclaim >= RECLAIM_INTERVAL:
+            self._last_reclaim = time.monotonic()
+            reclaimed = await asyncio.get_running_loop().run_in_executor(None, self.prisma.reclaim_expired_leases)
+            if reclaimed:
+                print(f"Reclaimed {reclaimed} tasks with expired leases")
+
+        wanted = self.config.task_batch_size - len(self._tasks)
+        if wanted <= 0:
+            return
+
+        leased_at = time.monotonic()
+        tasks = await self.prisma.lease_tasks(wanted)
+        self._tasks.extend(tasks)
+        for task in tasks:
+            self._expires[task.id] = leased_at + self.config.task_lease_seconds
+
+    async def renew(self):
+        """Extend the leases of the buffered tasks if any of them is close to running out"""
+        if len(self._tasks) == 0:
+            return
+        now = time.monotonic()
+        if min(self._expires.values()) - now > self.config.task_lease_seconds * RENEW_FRACTION:
+            return
+
+        # A lease that already ran out may have been reclaimed and leased by another worker, leave that task to it
+        held = [t for t in self._tasks if self._expires[t.id] > now]
+        renewed = await asyncio.get_running_loop().run_in_executor(None, self.prisma.renew_leases, held)
+        dropped = len(self._tasks) - len(renewed)
+        self._tasks = deque(t for t in self._tasks if t.id in renewed)
+        self._expires = {task_id: now + self.config.task_lease_seconds for task_id in renewed}
+        if dropped:
+            print(f"Dropped {dropped} buffered tasks that are no longer leased to this worker")
+
+    def release(self):
+        """Hand any tasks we leased but did not get to back to the other workers"""
+        tasks = list(self._tasks)
+        self._tasks.clear()
+        self._expires.clear()
+        self.prisma.release_tasks(tasks)
@@ -0,0 +1,78 @@
+import json
+
+import numpy as np
+
+from crawler.recommendation.bm25_index import (BM25Index, FrozenSegment,
+                                               MemorySegment, Segment,
+                                               decode_varints, encode_varints)
+
+
+def test_varints_round_trip():
+    values = np.array([0, 1, 127, 128, 300, 16_383, 16_384, 2 ** 31, 2 ** 40])
+    data, sizes = encode_varints(values)
+    assert sizes.tolist() == [1, 1, 1, 2, 2, 2, 3, 5, 6]
+    assert data[:4] == bytes([0, 1, 127, 0x80])
+    assert decode_varints(np.frombuffer(data, dtype=np.uint8)).tolist() == values.tolist()
+
+
+def test_segment_file_matches_memory(tmp_path):
+    memory = MemorySegment()
+    memory.add(10, "Rust async runtimes", "Tokio schedules tasks. Async rust needs a runtime.")
+    memory.add(11, "Gardening", "Tomatoes need sun and water")
+    memory.add(12, None, "Writing an async runtime in rust, from scratch")
+    memory.write(str(tmp_path), '000000')
+
+    for segment in (Segment(str(tmp_path), '000000'), FrozenSegment(memory)):
+        assert segment.ids.tolist() == [10, 11, 12]
+        assert segment.lengths.tolist() == memory.doc_lengths
+        for term in memory.postings:
+            assert segment.df(term) == memory.df(term)
+            assert [a.tolist() for a in segment.get(term)] == [a.tolist() for a in memory.get(term)]
+        assert segment.df('missing') == 0
+
+
+def test_search_across_segments(tmp_path):
+    first = MemorySegment()
+    first.add(1, "Rust async runtimes", "Tokio schedules tasks on a thread pool")
+    first.add(2, "Gardening", "Tomatoes need sun and water")
+    first.write(str(tmp_path), '000000')
+    with open(tmp_path / 'meta.json', 'w') as f:
+        json.dump(dict(segments=['000000'], last_id=2, recent_ids=[1, 2], next_segment=1), f)
+
+    index = BM25Index(str(tmp_path))
+    index.add_page(3, "Async Python", "asyncio runs tasks on an event loop")
+    # Synced again later, counted once
+    index.add_page(3, "Async Python", "asyncio runs tasks on an event loop")
+    assert len(index) == 3
+
+    matches = index.search("async tasks", k=10)
+    assert sorted(page_id for page_id, _ in matches) == [1, 3]
+    assert index.search("tomato", k=10)[0][0] == 2
+    assert index.search("the of", k=10) == []
+
+
+def test_sync_picks_up_ids_committed_out_of_order(tmp_path):
+    MemorySegment().write(str(tmp_path), '000000')
+    with open(tmp_path / 'meta.json', 'w') as f:
+        json.dump(dict(segments=['000000'], last_id=0, recent_ids=[], next_segment=1), f)
+
+    index = BM25Index(str(tmp_path))
+    index.add_page(5, "Later id", "committed first")
+    # Page 4 committed after 5 was indexed
+    assert index.missing_ids([4, 5]) == [4]
+    index.add_page(4, "Earlier id", "committed second")
+    assert index.missing_ids([4, 5]) == []
+    assert len(index) == 2
+
+
+def test_memory_segment_arrays_follow_added_pages():
+    memory = MemorySegment()
+    memory.add(1, "Async Python", "asyncio runs tasks")
+    [term] = [t for t in memory.postings if t.startswith('task')]
+    # Cached by a search
+    assert memory.get(term)[0].tolist() == [0]
+    assert memory.lengths.tolist() == memory.doc_lengths
+
+    memory.add(2, None, "more tasks")
+    assert memory.get(term)[0].tolist() == [0, 1]
+    assert memory.lengths.tolist() == memory.doc_lengths
@@ -0,0 +1,26 @@
+from crawler.bloom import ScalableBloomFilter
+from crawler.link import canonical_key, clean_url
+
+
+def test_clean_url_strips_tracking_params():
+    assert clean_url('https://A.com:443/x/?utm_source=a&id=2&fbclid=1#top') == 'https://a.com/x/?id=2'
+    assert clean_url('https://a.com/search?q=python') == 'https://a.com/search?q=python'
+
+
+def test_canonical_key_merges_variants():
+    variants = ['https://a.com/post', 'http://www.a.com/post/', 'https://a.com/post?utm_medium=email',
+                'https://www.a.com/post#comments']
+    assert len({canonical_key(url) for url in variants}) == 1
+
+    assert canonical_key('https://a.com/?b=2&a=1') == canonical_key('https://a.com?a=1&b=2')
+    assert canonical_key('https://a.com/post') != canonical_key('https://a.com/post?page=2')
+
+
+def test_bloom_filter_never_forgets():
+    seen = ScalableBloomFilter(100, 0.001)
+    keys = [f'a.com/post/{i}' for i in range(1000)]
+    seen.update(keys)
+
+    assert all(key in seen for key in keys)
+    assert not seen.add(keys[0])
+    assert sum(f'b.com/{i}' in seen for i in range(1000)) < 20
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('onnxruntime')
+pytest.importorskip('sentence_transformers')
+
+from crawler.recommendation.embedding_backends import OnnxBackend, TorchBackend  # noqa: E402
+from crawler.tests.test_simhash import fixture_text  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def windows() -> list[str]:
+    windows = []
+    for name in ['blog_post.html', 'long_essay.html', 'lethain_post.html']:
+        words = fixture_text(name).split()
+        windows.extend(' '.join(words[i:i + 300]) for i in range(0, min(len(words), 900), 300))
+    return windows + ["Represent this sentence for searching relevant passages:rust async runtimes", "short"]
+
+
+@pytest.fixture(scope='module')
+def torch_vectors(windows) -> np.ndarray:
+    return TorchBackend().encode(windows, batch_size=4)
+
+
+@pytest.mark.parametrize('quantize, min_similarity', [(False, 0.999), (True, 0.97)])
+def test_onnx_matches_torch(tmp_path_factory, windows, torch_vectors, quantize, min_similarity):
+    backend = OnnxBackend(quantize=quantize, cache_dir=str(tmp_path_factory.getbasetemp() / 'onnx'))
+    vectors = backend.encode(windows, batch_size=4)
+
+    assert vectors.shape == torch_vectors.shape
+    # Both are normalized, so the row-wise dot product is the cosine similarity
+    similarity = np.sum(vectors * torch_vectors, axis=1)
+    assert similarity.min() >= min_similarity
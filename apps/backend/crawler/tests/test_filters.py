@@ -0,0 +1,102 @@
+import json
+
+import nltk
+import pytest
+import trafilatura
+from nltk.tokenize import NLTKWordTokenizer
+
+from crawler import filters
+from crawler.link import Link
+from crawler.parse import extractable_text, load_tree, page_text, parse_html
+from crawler.tests.test_parse import read_fixture
+
+FIXTURES = ['blog_post.html', 'long_essay.html',
+            'lethain_post.html', 'short_note.html', 'latin1_page.html', 'link_heavy.html']
+
+
+def crawl_fixture(name: str):
+    result, _ = parse_html(read_fixture(name), Link.from_url(f'https://example.com/{name}'), False)
+    return result
+
+
+def test_count_sentences():
+    assert filters.count_sentences('') == 0
+    assert filters.count_sentences('One sentence without an end') == 1
+    assert filters.count_sentences('First. Second! Third? Fourth.') == 4
+    # Abbreviations, initials and a lowercase continuation don't end a sentence
+    assert filters.count_sentences(
+        'Dr. Smith met J. Doe at 5 p.m. today. Then they left, i.e. went home. etc. and so on.') == 2
+
+
+def test_token_counts_close_to_treebank():
+    # The Treebank tokenizer is what word_tokenize runs on each sentence, and needs no downloaded data
+    treebank = NLTKWordTokenizer()
+    for name in FIXTURES:
+        crawl = crawl_fixture(name)
+        if crawl is None:
+            continue
+        for line in crawl.content.splitlines():
+            if not line.strip():
+                continue
+            expected = len(treebank.tokenize(line))
+            assert abs(len(filters._TOKEN.findall(line)) - expected) <= max(2, expected * 0.1), line
+
+
+def test_might_keep_rejects_short_pages():
+    link = Link.from_url('https://example.com/a/b')
+    link.depth = 1
+    short = load_tree(b'<html><head><script>var a = [1, 2, 3, 4, 5, 6, 7, 8, 9];</script></head>'
+                      b'<body><nav>Home About</nav><p>Nothing here yet.</p></body></html>' + b' ' * 1000)
+    long = load_tree(read_fixture('long_essay.html'))
+
+    assert not filters.might_keep(extractable_text(short), link)
+    assert filters.might_keep(extractable_text(long), link)
+    assert not filters.might_keep(extractable_text(long), Link.from_url('https://example.com/post/comments/'))
+
+
+@pytest.mark.parametrize('name', FIXTURES)
+def test_might_keep_counts_at_least_what_extraction_keeps(name):
+    html = read_fixture(name)
+    bound = len(filters._TOKEN.findall(extractable_text(load_tree(html))))
+
+    crawl = crawl_fixture(name)
+    if crawl is not None:
+        assert len(filters._TOKEN.findall(crawl.content)) <= bound
+    # The markdown output has the link targets in it too
+    extracted = trafilatura.extract(load_tree(html), include_links=True, output_format='json', favor_precision=True)
+    if extracted is not None:
+        assert len(filters._TOKEN.findall(json.loads(extracted)['text'])) <= bound
+
+
+def test_might_keep_counts_link_targets():
+    # Under MIN_WORDS tokens of visible text, well over once the link targets are in
+    tree = load_tree(read_fixture('link_heavy.html'))
+    link = Link.from_url('https://example.com/link_heavy.html')
+    assert len(filters._TOKEN.findall(page_text(tree))) < filters.MIN_WORDS
+    assert filters.might_keep(extractable_text(tree), link)
+
+
+def _has_punkt() -> bool:
+    for resource in ('tokenizers/punkt_tab', 'tokenizers/punkt'):
+        try:
+            nltk.data.find(resource)
+            return True
+        except LookupError:
+            pass
+    return False
+
+
+@pytest.mark.skipif(not _has_punkt(), reason="NLTK punkt data is not installed")
+@pytest.mark.parametrize('name', FIXTURES)
+def test_should_keep_matches_nltk(name):
+    crawl = crawl_fixture(name)
+    if crawl is None:
+        pytest.skip("nothing extracted")
+
+    assert filters.should_keep(crawl) == filters.should_keep_nltk(crawl)
+
+    stats = filters.text_stats(crawl.content)
+    words, _ = filters.tokenize_by_line(crawl.content)
+    sentences = nltk.sent_tokenize(crawl.content)
+    assert abs(stats.num_words - len(words)) <= max(5, 0.1 * len(words))
+    assert abs(stats.num_sentences - len(sentences)) <= max(2, 0.1 * len(sentences))
@@ -0,0 +1,40 @@
+import os
+
+import pytest
+from crawler.http_cache import HttpCache
+from crawler.link import Link
+from crawler.parse import CrawlResult
+
+
+def crawl_result(url: str) -> CrawlResult:
+    return CrawlResult(link=Link.from_url(url), title="Title", date=None, author=None, content="Some text",
+                       outbound_links=[])
+
+
+@pytest.mark.asyncio
+async def test_corrupt_result_is_a_miss(tmp_path):
+    cache = HttpCache(str(tmp_path))
+    url = 'https://example.com/a'
+    await cache.put(url, b'<html></html>', crawl_result(url), etag='"v1"')
+    assert (await cache.get(url)).result.title == "Title"
+
+    # Chop the compressed result off the end of the entry
+    path = cache._path(cache._key(url))
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 4)
+    assert await cache.get(url) is None
+    assert cache.total_bytes == 0
+
+
+@pytest.mark.asyncio
+async def test_size_limit_covers_other_processes(tmp_path):
+    first, second = HttpCache(str(tmp_path)), HttpCache(str(tmp_path))
+    await first.put('https://example.com/a', b'a' * 1000, crawl_result('https://example.com/a'), etag='"a"')
+    # Stored by the other cache after our last scan, still readable
+    assert (await second.get('https://example.com/a')).body == b'a' * 1000
+
+    second.max_bytes = first.total_bytes + 100
+    second._last_scan = 0
+    await second.put('https://example.com/b', b'b' * 1000, crawl_result('https://example.com/b'), etag='"b"')
+    # The rescan counted the entry of `first` too, so one of the two had to go
+    assert len(os.listdir(tmp_path)) == 1
@@ -0,0 +1,22 @@
+import pytest
+
+# Importing the embedding module loads the model
+pytest.importorskip('sentence_transformers')
+
+from api.page_response import PageResponse  # noqa: E402
+from crawler.recommendation.hybrid_search import reciprocal_rank_fusion  # noqa: E402
+
+
+def pages(*ids: int) -> list[PageResponse]:
+    return [PageResponse(id=i, url=f"https://example.com/{i}", title=str(i), excerpt="") for i in ids]
+
+
+def test_rrf_prefers_pages_in_both_rankings():
+    fused = reciprocal_rank_fusion([pages(1, 2, 3), pages(3, 4)], k=60)
+    assert [p.id for p in fused] == [3, 1, 2, 4]
+    assert fused[0].score == pytest.approx(1 / 63 + 1 / 61)
+
+
+def test_rrf_of_one_ranking_keeps_its_order():
+    assert [p.id for p in reciprocal_rank_fusion([pages(5, 2, 9)])] == [5, 2, 9]
+    assert reciprocal_rank_fusion([]) == []
@@ -22,8 +22,8 @@ def fix_weird_chars():
         for p in results:
             p['title'] = fix(p['title'])
 
-        db.cursor().executemany(update_query, [(x['title'], x['id']) for x in results])
-        db.conn.commit()
+        with db.cursor() as cursor:
+            cursor.executemany(update_query, [(x['title'], x['id']) for x in results])
 
 if __name__ == "__main__":
     fix_weird_chars()
@@ -0,0 +1,24 @@
+from crawler.link import SUPPRESSED_DOMAINS, is_suppressed
+from crawler.matcher import SubstringMatcher
+
+
+def test_matcher_is_substring_search():
+    matcher = SubstringMatcher(['docs.google', 'docs.google.com', 'amazon.', 'https://t.co'])
+
+    assert matcher.matches('https://docs.google.com/document/d/1')
+    assert matcher.search('https://www.amazon.co.uk/dp/1') == 'amazon.'
+    assert matcher.matches('https://t.co/abc')
+    # Same as the old `in` check: 't.co' is a substring of 't.com'
+    assert matcher.matches('https://t.com/abc')
+    assert not matcher.matches('https://t.org/abc')
+    assert not matcher.matches('https://example.com/')
+    assert not SubstringMatcher([]).matches('https://example.com/')
+
+
+def test_is_suppressed_matches_linear_scan():
+    urls = ['https://en.wikipedia.org/wiki/Trie', 'https://www.amazon.com/dp/1', 'https://danluu.com/',
+            'https://me.example.com/', 'mehttps://vuejs.org/guide', 'https://vuejs.org/guide',
+            'https://www.paulgraham.com/greatwork.html', 'https://news.ycombinator.com/item?id=1',
+            'https://git.sr.ht/~sircmpwn/', 'http://tools.ietf.org/html/rfc2616']
+    for url in urls:
+        assert is_suppressed(url) == any(s in url for s in SUPPRESSED_DOMAINS), url
@@ -0,0 +1,55 @@
+import os
+
+from crawler.link import Link, LinkRef
+from crawler.parse import (CrawlResult, extract_meta_title, load_tree,
+                           parse_html, prune_ugc_sponsored)
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'fixtures', 'pages')
+
+
+def read_fixture(name: str) -> bytes:
+    with open(os.path.join(FIXTURE_DIR, name), 'rb') as f:
+        return f.read()
+
+
+def test_prune_ugc_sponsored():
+    tree = load_tree(
+        b'<html><body><a rel="ugc" href="https://spam.com">x</a><a href="https://ok.com">y</a></body></html>')
+    prune_ugc_sponsored(tree)
+    assert [a.get('href') for a in tree.iter('a')] == [None, 'https://ok.com']
+
+
+def test_meta_title_prefers_og_title():
+    tree = load_tree(read_fixture('blog_post.html'))
+    assert extract_meta_title(tree) == 'Building a small search engine'
+
+    tree = load_tree(read_fixture('long_essay.html'))
+    assert extract_meta_title(tree) == 'Notes on attention'
+
+
+def test_parse_html_whitelisted_links_skip_ugc():
+    link = Link.from_url('https://lethain.com/staff-archetypes/')
+    result, _ = parse_html(read_fixture('lethain_post.html'), link, False)
+
+    assert result is not None
+    urls = [l.url for l in result.outbound_links]
+    assert len(urls) > 0
+    assert not any('ads.example.net' in url for url in urls)
+
+
+def test_parse_html_accepts_str_with_xml_declaration():
+    html = '<?xml version="1.0" encoding="utf-8"?>' + \
+        read_fixture('blog_post.html').decode('utf-8')
+    result, _ = parse_html(html, Link.from_url(
+        'https://example.com/blog_post.html'), False)
+    assert result is not None
+
+
+def test_crawl_result_json_round_trip_keeps_links():
+    link = Link.from_url('https://lethain.com/staff-archetypes/')
+    result, _ = parse_html(read_fixture('lethain_post.html'), link, False)
+
+    restored = CrawlResult.parse_raw(result.json())
+    assert restored.outbound_links == result.outbound_links
+    assert all(isinstance(l, LinkRef) for l in restored.outbound_links)
+    assert restored.outbound_links[0].to_link().domain() == result.outbound_links[0].domain()
@@ -0,0 +1,36 @@
+import time
+
+import pytest
+from crawler import parse
+from crawler.link import Link
+from crawler.parse_service import ParseService, ParseTimeout, _with_timeout
+from crawler.tests.test_parse import read_fixture
+
+
+@pytest.mark.asyncio
+async def test_parse_service_parses_and_times_out():
+    service = ParseService(processes=1, timeout=1)
+    try:
+        result = await service.parse(read_fixture('blog_post.html'), Link.from_url('https://example.com/blog_post.html'))
+        assert result is not None
+        assert result.title == 'Building a small search engine'
+
+        # Anything running past the timeout is interrupted in the child
+        assert await service._submit(time.sleep, 5) is None
+    finally:
+        service.shutdown()
+
+
+def test_timeout_is_not_swallowed_by_fallback(monkeypatch):
+    fallback = []
+
+    def hang(tree, link):
+        while True:
+            pass
+
+    monkeypatch.setattr(parse, 'parse_html_trafilatura', hang)
+    monkeypatch.setattr(parse, 'parse_html_newspaper', lambda html, link: fallback.append(link))
+    with pytest.raises(ParseTimeout):
+        _with_timeout(0.5, parse.parse_html, read_fixture('blog_post.html'),
+                      Link.from_url('https://example.com/blog_post.html'), False)
+    assert fallback == []
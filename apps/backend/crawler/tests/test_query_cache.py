@@ -0,0 +1,51 @@
+import numpy as np
+
+from crawler.query_cache import QueryVectorCache, ResultCache
+
+
+def test_vector_cache_tiers(tmp_path):
+    calls = []
+
+    def embed(query: str) -> np.ndarray:
+        calls.append(query)
+        return np.full(4, len(calls), dtype=np.float32)
+
+    cache = QueryVectorCache(max_entries=1, directory=str(tmp_path))
+    first = cache.get_or_compute("Rust  async", embed)
+    assert np.array_equal(cache.get_or_compute("rust async", embed), first)
+    cache.get_or_compute("python", embed)
+    # Evicted from memory by "python", still on disk
+    assert np.array_equal(cache.get_or_compute("rust async", embed), first)
+    assert calls == ["rust async", "python"]
+    assert cache.stats == {'memory_hits': 1, 'disk_hits': 1, 'misses': 2}
+
+    # A new process finds the vectors on disk
+    restarted = QueryVectorCache(max_entries=1, directory=str(tmp_path))
+    assert np.array_equal(restarted.get_or_compute("python", embed), np.full(4, 2))
+    assert restarted.stats['disk_hits'] == 1
+
+
+def test_result_cache_expires(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('crawler.query_cache.time.monotonic', lambda: now[0])
+    cache = ResultCache(max_entries=2, ttl_seconds=10)
+
+    cache.put('"exact phrase"', [1, 2])
+    assert cache.get('"Exact  Phrase"') == [1, 2]
+    now[0] += 11
+    assert cache.get('"exact phrase"') is None
+    assert cache.stats == {'hits': 1, 'misses': 0, 'expired': 1}
+
+
+def test_vector_cache_survives_a_failed_disk_write(tmp_path, monkeypatch):
+    cache = QueryVectorCache(max_entries=2, directory=str(tmp_path))
+
+    def full_disk(*args, **kwargs):
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr('crawler.query_cache.np.save', full_disk)
+    vector = cache.get_or_compute("rust async", lambda query: np.ones(4, dtype=np.float32))
+    assert np.array_equal(vector, np.ones(4))
+    assert list(tmp_path.iterdir()) == []
+    # Kept in memory
+    assert np.array_equal(cache.get_or_compute("rust async", lambda query: np.zeros(4)), np.ones(4))
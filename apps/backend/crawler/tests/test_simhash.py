@@ -0,0 +1,32 @@
+from crawler import simhash
+from crawler.link import Link
+from crawler.parse import parse_html
+from crawler.tests.test_parse import read_fixture
+
+
+def fixture_text(name: str) -> str:
+    result, _ = parse_html(read_fixture(name), Link.from_url(f'https://example.com/{name}'), False)
+    return result.content
+
+
+def test_simhash_finds_near_duplicates():
+    text = fixture_text('lethain_post.html')
+    fingerprint = simhash.simhash(text)
+
+    copy = simhash.simhash(
+        "Originally published on another blog.\n" + text + "\nSubscribe for more.")
+    other = simhash.simhash(fixture_text('blog_post.html'))
+
+    assert simhash.distance(fingerprint, copy) <= simhash.MAX_DISTANCE
+    assert simhash.distance(fingerprint, other) > simhash.MAX_DISTANCE
+    # Within MAX_DISTANCE bits means at least one band is identical
+    assert set(enumerate(simhash.bands(fingerprint))) & set(enumerate(simhash.bands(copy)))
+
+
+def test_simhash_round_trips_through_bigint():
+    fingerprint = simhash.simhash(fixture_text('long_essay.html'))
+    signed = simhash.to_signed(fingerprint)
+
+    assert -2 ** 63 <= signed < 2 ** 63
+    assert simhash.from_signed(signed) == fingerprint
+    assert simhash.simhash("too short") is None
@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+from psycopg import DataError, OperationalError
+
+pytest.importorskip('prisma.enums')
+
+from crawler.config import Config
+from crawler.link import Link
+from crawler.parse import CrawlResult
+from crawler.write_buffer import WriteBuffer
+from prisma.enums import TaskStatus
+from prisma.models import CrawlTask
+
+
+def config() -> Config:
+    cfg = Config(empty=True)
+    cfg.max_crawl_depth = 3
+    return cfg
+
+
+class FakeClient:
+    seen_urls = None
+
+    def find_near_duplicate(self, fingerprint, url=None):
+        return None
+
+    def unseen_links(self, links, staged=None):
+        return list(links)
+
+    def mark_seen(self, links):
+        self.seen = [link.url for link in links]
+
+
+def crawled(task_id: int, content: str) -> tuple[CrawlTask, CrawlResult]:
+    link = Link.from_url(f"https://example.com/{task_id}")
+    task = CrawlTask(id=task_id, status=TaskStatus.PROCESSING, url=link.url, depth=0)
+    return task, CrawlResult(link=link, title="Title", date=None, author=None, content=content,
+                             outbound_links=[Link.from_url(f"https://example.org/{task_id}")])
+
+
+def test_flush_drops_only_the_rejected_page(monkeypatch):
+    writes = []
+
+    def write(self, rows):
+        if any('\x00' in result.content for _, result, _ in rows.pages):
+            raise DataError("PostgreSQL text fields cannot contain NUL (0x00) bytes")
+        writes.append(rows)
+        return [result.link.url for _, result, _ in rows.pages]
+
+    monkeypatch.setattr(WriteBuffer, '_write', write)
+    client = FakeClient()
+    buffer = WriteBuffer(prisma=client, config=config())
+
+    async def run():
+        for task_id in range(8):
+            await buffer.store_page(*crawled(task_id, "bad \x00 page" if task_id == 5 else f"page number {task_id}"))
+        await buffer.flush()
+    asyncio.run(run())
+
+    stored = [result.link.url for rows in writes for _, result, _ in rows.pages]
+    assert sorted(stored) == sorted(f"https://example.com/{i}" for i in range(8) if i != 5)
+    statuses = {}
+    for rows in writes:
+        statuses.update(rows.statuses)
+    assert statuses[5] == TaskStatus.FAILED
+    assert all(statuses[i] == TaskStatus.COMPLETED for i in range(8) if i != 5)
+    assert len(client.seen) == 8
+    assert len(buffer) == 0
+
+
+def test_flush_backs_off_while_the_database_is_down(monkeypatch):
+    def write(self, rows):
+        raise OperationalError("connection refused")
+
+    monkeypatch.setattr(WriteBuffer, '_write', write)
+    buffer = WriteBuffer(prisma=FakeClient(), config=config())
+
+    async def run():
+        await buffer.store_page(*crawled(1, "some page"))
+        await buffer.flush()
+    asyncio.run(run())
+
+    # Kept for the next attempt, which must wait
+    assert len(buffer) == 3
+    assert buffer.retry_in() > 0
+    assert not buffer.should_flush()
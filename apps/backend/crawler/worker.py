@@ -1,19 +1,94 @@
 import asyncio
 import random
+import time
 from asyncio import Queue
-from typing import Optional, Tuple
+from typing import NamedTuple, Optional, Tuple
 
 import numpy as np
 from aiohttp import ClientError, ClientSession, ClientTimeout
 from crawler.config import Config
+from prisma.enums import TaskStatus
 from prisma.models import CrawlTask
 
-from . import filters
-from .link import SUPPRESSED_DOMAINS, Link
+from . import http_client, parse_service
+from .http_cache import HttpCache, get_cache, validators_from_headers
+from .link import Link, is_suppressed
 from .parse import CrawlResult, parse_html
+from .parse_service import ParseService
+from .politeness import DeferredTasks, HostScheduler, HostThrottled, parse_retry_after
 from .prismac import PostgresClient
+from .task_buffer import TaskBuffer
+from .write_buffer import WriteBuffer
 from .recommendation.embedding import model
 
+# Users are waiting on interactive crawls, so give up quickly on hosts that don't answer
+INTERACTIVE_TIMEOUT = ClientTimeout(total=20, connect=4)
+
+# A task for a host that keeps throttling us is failed after this many deferrals
+MAX_THROTTLED_ATTEMPTS = 3
+# A deferred task is parked in memory for at most this share of its lease, after that it goes back to the database
+DEFER_HOLD_FRACTION = 0.25
+
+
+class TaskOutcome(NamedTuple):
+    """What the write stage should record for a task once it has been fetched and parsed"""
+    task: CrawlTask
+    status: TaskStatus  # COMPLETED, FILTERED or FAILED
+    result: Optional[CrawlResult] = None
+
+
+class FetchedPage(NamedTuple):
+    body: bytes
+    # ETag / Last-Modified of the response, used to revalidate it next time
+    validators: dict[str, str]
+    # Set when the server answered 304 Not Modified: the page as we parsed it last time
+    cached: Optional[CrawlResult] = None
+
+
+async def fetch_page(session: ClientSession, link: Link, cache: Optional[HttpCache], timeout: Optional[ClientTimeout] = None, max_bytes: int = http_client.DEFAULT_MAX_BODY_BYTES) -> Optional[FetchedPage]:
+    """
+    GET `link`, conditional on the copy in `cache` if there is one. Returns `None` for a non-200 response, or a body
+    that is not HTML or is larger than `max_bytes`. Raises `HostThrottled` if the host answers 429 or 503.
+    """
+    headers = cache.conditional_headers(link.url) if cache else {}
+
+    async with session.get(link.url, headers=headers, timeout=timeout) as response:
+        if response.status in (429, 503):
+            raise HostThrottled(link.raw_domain(), parse_retry_after(
+                response.headers.get('Retry-After')))
+
+        if response.status == 304:
+            entry = await cache.get(link.url) if cache else None
+            if entry is not None:
+                return FetchedPage(entry.body, {}, entry.result)
+        elif response.ok:
+            body = await http_client.read_capped(response, max_bytes)
+            if body is None:
+                return None
+            return FetchedPage(body, validators_from_headers(response.headers))
+        else:
+            print("Encountered non-200 response, skipping", response.status)
+            return None
+
+    # Our cached copy went away between sending the request and getting the 304
+    return await fetch_page(session, link, None, timeout, max_bytes)
+
+
+async def parse_fetched(page: FetchedPage, link: Link, cache: Optional[HttpCache], parser: ParseService) -> Optional[CrawlResult]:
+    """Parse a fetched page on the parse service, or reuse the cached result if the page has not been modified"""
+    if page.cached is not None:
+        return page.cached.copy(update={'link': link})
+
+    result = await parser.parse(page.body, link)
+    if result is not None and cache is not None:
+        await cache.put(link.url, page.body, result, **page.validators)
+    return result
+
+
+def link_from_task(task: CrawlTask) -> Link:
+    return Link(url=task.url, parent_url=task.parent_url,
+                depth=task.depth, text=task.text)
+
 
 class Worker:
     config: Config
@@ -21,14 +96,39 @@ class Worker:
     done: bool
     sentinel_queue: Queue[bool]
     prisma: PostgresClient
+    tasks: TaskBuffer
+    writes: WriteBuffer
+    parser: ParseService
+    scheduler: HostScheduler
+    cache: Optional[HttpCache]
+    deferred: DeferredTasks[CrawlTask]
+    throttled_attempts: dict[int, int]
+    # When each deferred task was first parked, to bound how long we sit on its lease
+    deferred_since: dict[int, float]
+    in_flight: int
     id: int
 
-    def __init__(self, *, id: int, config: Config, done_queue: Queue[bool], sentinel_queue: Queue[bool], prisma: PostgresClient):
+    def __init__(self, *, id: int, config: Config, done_queue: Queue[bool], sentinel_queue: Queue[bool], prisma: PostgresClient, parser: Optional[ParseService] = None, scheduler: Optional[HostScheduler] = None, cache: Optional[HttpCache] = None):
         self.config = config
         self.done_queue = done_queue
         self.done = False
         self.sentinel_queue = sentinel_queue
         self.prisma = prisma
+        self.tasks = TaskBuffer(prisma=prisma, config=config)
+        self.writes = WriteBuffer(prisma=prisma, config=config)
+        # Process pool for parsing and filtering, shared between workers
+        self.parser = parser if parser is not None else parse_service.get_service()
+        # Per-host rate limits and robots.txt, shared between workers when given
+        self.scheduler = scheduler if scheduler is not None else HostScheduler(
+            rate=config.host_rate)
+        # Bodies and validators of pages we have crawled before, to send conditional requests
+        self.cache = cache if cache is not None else get_cache()
+        # Leased tasks waiting for their host to accept requests again
+        self.deferred = DeferredTasks()
+        self.throttled_attempts = {}
+        self.deferred_since = {}
+        # Tasks leased into the pipeline that have not been written back yet
+        self.in_flight = 0
         self.id = id
 
     async def run(self):
@@ -39,8 +139,10 @@ class Worker:
         """
         try:
             print("Worker started")
-            await self.run_sequential()
-            # await self.run_parallel()
+            if self.config.should_debug:
+                await self.run_sequential()
+            else:
+                await self.run_pipeline()
         except Exception as e:
             print(f"Worker encountered exception: {e}")
             self.done = True
@@ -53,56 +155,274 @@ class Worker:
         """Get, crawl, and parse links from the queue one at a time"""
         # Prevents exhausting the queue and exiting all at once
         await asyncio.sleep(random.uniform(0, 1) * 5)
-        async with ClientSession(timeout=ClientTimeout(total=20)) as session:
-            spoof_chrome_user_agent(session)
+        session = await http_client.get_session()
 
-            while not self.done:
-                self.print_status()
+        while not self.done:
+            self.print_status()
 
-                task = await self.prisma.get_task()
+            task = await self.tasks.get()
+
+            if task is None:
+                print("No more tasks in database")
+                self.done = True
+                break
+
+            print(f"Working on task: {task.id}")
+
+            await self.process_task(task, session)
+            await self.writes.maybe_flush()
+
+        await self.writes.close()
+        # Don't sit on leases for tasks we won't get to
+        self.tasks.release()
+        print("Worker exiting...")
+        return
+
+    async def run_pipeline(self):
+        """
+        Crawl with a staged pipeline: a lease stage feeds tasks to `fetch_concurrency` fetchers, fetched pages are
+        parsed and filtered on the process pool, and the results are written to the database in batches.
+        The stages are joined by bounded queues, so a slow stage applies backpressure to the ones before it.
+        """
+        # Prevents exhausting the queue and exiting all at once
+        await asyncio.sleep(random.uniform(0, 1) * 5)
+
+        tasks: Queue[Optional[CrawlTask]] = Queue(
+            maxsize=self.config.fetch_concurrency)
+        pages: Queue[Optional[Tuple[CrawlTask, FetchedPage]]] = Queue(
+            maxsize=self.config.parse_processes)
+        outcomes: Queue[Optional[TaskOutcome]] = Queue(
+            maxsize=self.config.write_batch_size)
+
+        session = await http_client.get_session()
+        # If any stage raises, the task group cancels the others and the exception bubbles up
+        async with asyncio.TaskGroup() as group:
+            fetchers = [group.create_task(self.fetch_stage(session, tasks, pages, outcomes))
+                        for _ in range(self.config.fetch_concurrency)]
+            parsers = [group.create_task(self.parse_stage(pages, outcomes))
+                       for _ in range(self.config.parse_processes)]
+            writer = group.create_task(self.write_stage(outcomes))
+
+            await self.lease_stage(tasks)
+
+            # Drain the pipeline one stage at a time
+            for _ in fetchers:
+                await tasks.put(None)
+            await asyncio.gather(*fetchers)
+            for _ in parsers:
+                await pages.put(None)
+            await asyncio.gather(*parsers)
+            await outcomes.put(None)
+            await writer
+
+        # Don't sit on leases for tasks we won't get to
+        self.tasks.release()
+        self.prisma.release_tasks(self.deferred.drain())
+        print("Worker exiting...")
+
+    async def lease_stage(self, tasks: Queue[Optional[CrawlTask]]):
+        while not self.done:
+            self.print_status()
+
+            # Tasks whose host is ready again go first, they have been holding their lease the longest
+            task = self.deferred.pop_ready()
+            if task is None:
+                if len(self.deferred) >= self.config.max_deferred_tasks:
+                    # Mostly waiting on throttled hosts, leasing more would only grow the backlog
+                    await asyncio.sleep(min(self.deferred.next_ready_in(), 1))
+                    continue
+
+                task = await self.tasks.get()
 
                 if task is None:
+                    if len(self.writes) > 0:
+                        # New tasks may still be waiting in the write buffer. If the last flush failed, give the
+                        # database its backoff before trying again
+                        await asyncio.sleep(self.writes.retry_in())
+                        await self.writes.flush()
+                        continue
+                    if self.in_flight > 0:
+                        # Pages still in the pipeline may add new tasks, and deferred tasks will become ready
+                        await asyncio.sleep(min(self.deferred.next_ready_in(), 1) if len(self.deferred) else 1)
+                        continue
                     print("No more tasks in database")
                     self.done = True
                     break
 
-                print(f"Working on task: {task.id}")
+                self.in_flight += 1
 
-                await self.process_task(task, session)
+            delay = self.scheduler.try_acquire(link_from_task(task))
+            if delay > 0:
+                # Don't hold up a fetcher waiting on a busy host, move on to other tasks
+                await self.defer(task, delay)
+                continue
 
-            print("Worker exiting...")
+            await tasks.put(task)
+
+    async def defer(self, task: CrawlTask, delay: float):
+        """
+        Park a leased task until its host takes requests again. Short waits are kept in memory, but a task is never held
+        for more than DEFER_HOLD_FRACTION of its lease: then it goes back to the database as PENDING, not to be leased
+        again for `delay` seconds
+        """
+        now = time.monotonic()
+        held_since = self.deferred_since.setdefault(task.id, now)
+        if now + delay - held_since <= self.config.task_lease_seconds * DEFER_HOLD_FRACTION:
+            self.deferred.defer(task, delay)
             return
 
+        self.deferred_since.pop(task.id)
+        self.throttled_attempts.pop(task.id, None)
+        self.in_flight -= 1
+        await asyncio.get_running_loop().run_in_executor(None, self.prisma.defer_tasks, [task], delay)
+
+    async def fetch_stage(self, session: ClientSession, tasks: Queue[Optional[CrawlTask]], pages: Queue[Optional[Tuple[CrawlTask, FetchedPage]]], outcomes: Queue[Optional[TaskOutcome]]):
+        while True:
+            task = await tasks.get()
+            if task is None:
+                return
+
+            link = link_from_task(task)
+            print(
+                f"Working on: {link.url} from parent: {link.parent_url} at depth: {link.depth}")
+            try:
+                page = await self.fetch(link, session)
+            except HostThrottled as e:
+                attempts = self.throttled_attempts.get(task.id, 0) + 1
+                if attempts < MAX_THROTTLED_ATTEMPTS:
+                    print(f"Deferring {link.url}: {e}")
+                    self.throttled_attempts[task.id] = attempts
+                    await self.defer(task, e.retry_after)
+                    continue
+                self.throttled_attempts.pop(task.id, None)
+                page = None
+            except ClientError as e:
+                print(
+                    f"FAILED: Can't connect to `{link.url}`, error: `{e}`")
+                page = None
+            except Exception as e:
+                # Anything else (a bad redirect, a broken cache entry...) fails this task, not the whole worker
+                print(f"FAILED: Error fetching `{link.url}`: {e!r}")
+                self.throttled_attempts.pop(task.id, None)
+                page = None
+            else:
+                self.throttled_attempts.pop(task.id, None)
+
+            if page is None:
+                await outcomes.put(TaskOutcome(task, TaskStatus.FAILED))
+            else:
+                await pages.put((task, page))
+
+    async def parse_stage(self, pages: Queue[Optional[Tuple[CrawlTask, FetchedPage]]], outcomes: Queue[Optional[TaskOutcome]]):
+        while True:
+            item = await pages.get()
+            if item is None:
+                return
+
+            task, page = item
+            link = link_from_task(task)
+            try:
+                if page.cached is not None:
+                    # Not modified since we last parsed it
+                    result = page.cached.copy(update={'link': link})
+                    keep = await self.parser.should_keep(result, link)
+                else:
+                    result, keep = await self.parser.parse_and_filter(page.body, link)
+                    if result is not None:
+                        await self.cache.put(link.url, page.body, result, **page.validators)
+            except Exception as e:
+                print(f"Encountered exception parsing {link.url}: {e}")
+                result, keep = None, None
+
+            if keep is None:
+                print("Encountered parse error, skipping", link.url)
+                await outcomes.put(TaskOutcome(task, TaskStatus.FAILED))
+            elif keep:
+                await outcomes.put(TaskOutcome(task, TaskStatus.COMPLETED, result))
+            else:
+                await outcomes.put(TaskOutcome(task, TaskStatus.FILTERED))
+
+    async def write_stage(self, outcomes: Queue[Optional[TaskOutcome]]):
+        finished = False
+        while not finished:
+            try:
+                outcome = await asyncio.wait_for(outcomes.get(), self.config.write_flush_seconds)
+            except asyncio.TimeoutError:
+                # Nothing new, but what is buffered may have waited long enough
+                await self.writes.maybe_flush()
+                continue
+            if outcome is None:
+                await self.writes.close()
+                return
+
+            # Take whatever else is ready, up to a full batch
+            batch = [outcome]
+            while len(batch) < self.config.write_batch_size and not outcomes.empty():
+                outcome = outcomes.get_nowait()
+                if outcome is None:
+                    finished = True
+                    break
+                batch.append(outcome)
+
+            await self.write_outcomes(batch)
+
+        await self.writes.close()
+
+    async def write_outcomes(self, batch: list[TaskOutcome]):
+        for outcome in batch:
+            task = outcome.task
+            if outcome.status == TaskStatus.COMPLETED:
+                await self.writes.store_page(task, outcome.result)
+            elif outcome.status == TaskStatus.FILTERED:
+                print(f"WARN: Filtered out link: {task.url}")
+                await self.writes.set_task_status(task, TaskStatus.FILTERED)
+            else:
+                print(f"FAILED: Could not crawl {task.url}")
+                await self.writes.set_task_status(task, TaskStatus.FAILED)
+
+            self.in_flight -= 1
+            self.deferred_since.pop(task.id, None)
+            await self.done_queue.put(True)
+        await self.writes.maybe_flush()
+
+        if self.done_queue.qsize() >= self.config.max_links and not self.done:
+            print(f"TARGET LINKS REACHED: {self.config.max_links}")
+            self.done = True
+            await self.sentinel_queue.put(True)
+
     async def process_task(self, task: CrawlTask, session: ClientSession) -> Optional[CrawlResult]:
         """Given `link`, this function crawls and attempts to parse it, then adds any outbound links to `queue`. Returns the number of links added to `queue` if successful, or `None` if not."""
 
-        link = Link(url=task.url, parent_url=task.parent_url,
-                    depth=task.depth, text=task.text)
+        link = link_from_task(task)
         print(
             f"Working on: {link.url} from parent: {link.parent_url} at depth: {link.depth}")
         try:
+            await self.scheduler.wait_for_turn(link)
             response, rss_links = await self.crawl(link, session)
 
             if len(rss_links):
-                self.prisma.add_outgoing_links(rss_links)
+                await self.writes.add_outgoing_links(rss_links)
 
             if not response:
                 await self.done_queue.put(True)
-                page = await self.prisma.fail_page(task)
+                await self.writes.set_task_status(task, TaskStatus.FAILED)
                 print(f"FAILED: Could not crawl {link.url}")
                 return None
 
-            if link.depth == 0 or filters.should_keep(response):
-                page = self.prisma.store_page(task, response)
-                if page is not None:
-                    print(f"SUCCESS: Crawled page: {page.url}")
+            if await self.parser.should_keep(response, link):
+                await self.writes.store_page(task, response)
             else:
                 print(f"WARN: Filtered out link: {link.url}")
-                page = await self.prisma.filter_page(task)
+                await self.writes.set_task_status(task, TaskStatus.FILTERED)
+        except HostThrottled as e:
+            # Put the task back so it is crawled later, once the host has recovered
+            print(f"Deferring {link.url}: {e}")
+            await asyncio.get_running_loop().run_in_executor(None, self.prisma.defer_tasks, [task], e.retry_after)
+            return None
         except ClientError as e:
             print(
                 f"FAILED: Can't connect to `{link.url}`, error: `{e}`")
-            page = await self.prisma.fail_page(task)
+            await self.writes.set_task_status(task, TaskStatus.FAILED)
             await self.done_queue.put(True)
 
             return None
@@ -124,26 +444,40 @@ class Worker:
         # Always false because we manually crawl all RSS links now...
         should_rss = False
 
-        for suppressed in SUPPRESSED_DOMAINS:
-            if suppressed in link.url:
-                print("Encountered suppressed domain, skipping", link.url)
-                return None, []
+        page = await self.fetch(link, session)
+        if page is None:
+            return None, []
 
-        try:
-            async with session.get(link.url) as response:
-                if not response.ok:
-                    print("Encountered non-200 response, skipping", response.status)
-                    return None, []
-                response = await response.read()
+        if should_rss:
+            response, rss = parse_html(page.body, link, should_rss)
+        else:
+            response, rss = await parse_fetched(page, link, self.cache, self.parser), []
+
+        if response is None:
+            print("Encountered parse error, skipping", link.url)
+        return response, rss
+
+    async def fetch(self, link: Link, session: ClientSession) -> Optional[FetchedPage]:
+        """
+        Download `link`, or return `None` if it is suppressed, disallowed by robots.txt, times out or returns a
+        non-200 response. Raises `HostThrottled` if the host asks us to back off.
+        """
+        if is_suppressed(link.url):
+            print("Encountered suppressed domain, skipping", link.url)
+            return None
 
-                response, rss = parse_html(response, link, should_rss)
+        if not await self.scheduler.is_allowed(link, session):
+            print("Disallowed by robots.txt, skipping", link.url)
+            return None
 
-                if response is None:
-                    print("Encountered parse error, skipping", link.url)
-                return response, rss
+        try:
+            return await fetch_page(session, link, self.cache, max_bytes=self.config.max_body_bytes)
+        except HostThrottled as e:
+            self.scheduler.backoff(link, e.retry_after)
+            raise
         except asyncio.TimeoutError:
             print("Encountered timeout, skipping", link.url)
-            return None, []
+            return None
 
 
 async def crawl_interactive(link: Link) -> Tuple[np.ndarray, CrawlResult] | None:
@@ -154,33 +488,31 @@ async def crawl_interactive(link: Link) -> Tuple[np.ndarray, CrawlResult] | None
     For now, don't add it to our database (as users might submit bad links).
     """
 
-    async with ClientSession(timeout=ClientTimeout(connect=4)) as session:
-        spoof_chrome_user_agent(session)
+    response = await _crawl_interactive(link)
 
-        async with session.get(link.url) as response:
-            if not response.ok:
-                return None
-            response, _rss_links = parse_html(await response.read(), link, False)
-
-        if response is None:
-            return None
-        return get_window_avg(response.title + " " + response.content), response
+    if response is None:
+        return None
+    return get_window_avg(response.title + " " + response.content), response
 
 
 # Same as above, but don't calculate embeddings
 async def crawl_only(link: Link) -> CrawlResult | None:
-    async with ClientSession(timeout=ClientTimeout(connect=4)) as session:
-        spoof_chrome_user_agent(session)
+    return await _crawl_interactive(link)
 
-        async with session.get(link.url) as response:
-            if not response.ok:
-                return None
-            response, _ = parse_html(await response.read(), link, False)
 
-        if response is None:
-            return None
+async def _crawl_interactive(link: Link) -> CrawlResult | None:
+    session = await http_client.get_session()
+    cache = get_cache()
 
-        return response
+    try:
+        page = await fetch_page(session, link, cache, timeout=INTERACTIVE_TIMEOUT)
+    except HostThrottled:
+        return None
+
+    if page is None:
+        return None
+
+    return await parse_fetched(page, link, cache, parse_service.get_service())
 
 
 def get_window_avg(content: str) -> np.ndarray:
@@ -194,9 +526,4 @@ def get_window_avg(content: str) -> np.ndarray:
     return avg_two_windows
 
 
-def spoof_chrome_user_agent(session: ClientSession):
-    # or else we get blocked by cloudflare sites
-    session.headers[
-        'User-Agent'] = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/116.0.0.0 Safari/537.36'
-
 
@@ -0,0 +1,395 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Optional
+
+import mmh3
+from prisma.enums import TaskStatus
+from prisma.models import CrawlTask
+from dotenv import load_dotenv
+from psycopg import Cursor, OperationalError
+
+from . import simhash
+from .config import Config
+from .link import Link, LinkRef
+from .parse import CrawlResult
+from .prismac import PostgresClient
+
+load_dotenv()
+
+# A flush that can't reach the database is retried after FLUSH_BACKOFF_SECONDS, doubling up to MAX_FLUSH_BACKOFF_SECONDS,
+# and given up on after this many attempts. Its tasks are still leased, so once the leases run out they are crawled
+# again. The new tasks it discovered are spilled to SPILL_DIR instead, and added by a later flush that succeeds (in
+# this process or another one)
+MAX_FLUSH_ATTEMPTS = 5
+FLUSH_BACKOFF_SECONDS = 2
+MAX_FLUSH_BACKOFF_SECONDS = 60
+SPILL_DIR = os.environ.get('WRITE_SPILL_DIR', '.write_spill')
+
+
+class Rows:
+    """
+    Rows of one flush. A page goes with the status of its task: if the page can't be stored, the task mustn't be marked
+    COMPLETED either
+    """
+    pages: list[tuple[CrawlTask, CrawlResult, Optional[int]]]
+    statuses: dict[int, TaskStatus]
+    tasks: list[Link | LinkRef]
+
+    def __init__(self, pages: list[tuple[CrawlTask, CrawlResult, Optional[int]]], statuses: dict[int, TaskStatus],
+                 tasks: list[Link | LinkRef]):
+        self.pages = pages
+        self.statuses = statuses
+        self.tasks = tasks
+
+    def units(self) -> int:
+        """Number of rows that can be written on their own"""
+        return len(self._units())
+
+    def halves(self) -> tuple['Rows', 'Rows']:
+        units = self._units()
+        return Rows._from_units(units[:len(units) // 2]), Rows._from_units(units[len(units) // 2:])
+
+    def _units(self) -> list[tuple]:
+        page_tasks = {task.id for task, _, _ in self.pages}
+        return ([(page, self.statuses.get(page[0].id), None) for page in self.pages] +
+                [(None, status, None) for status in self.statuses.items() if status[0] not in page_tasks] +
+                [(None, None, link) for link in self.tasks])
+
+    @staticmethod
+    def _from_units(units: list[tuple]) -> 'Rows':
+        rows = Rows([], {}, [])
+        for page, status, link in units:
+            if page is not None:
+                rows.pages.append(page)
+                if status is not None:
+                    rows.statuses[page[0].id] = status
+            elif status is not None:
+                rows.statuses[status[0]] = status[1]
+            else:
+                rows.tasks.append(link)
+        return rows
+
+    def extend(self, other: 'Rows'):
+        self.pages += other.pages
+        self.statuses.update(other.statuses)
+        self.tasks += other.tasks
+
+
+class WriteBuffer:
+    """
+    Worker-local write-behind buffer for crawl results.
+
+    Pages, task status changes and newly discovered tasks are staged in memory and written in a single transaction once
+    `write_flush_rows` rows are waiting or the oldest has waited `write_flush_seconds`. Each kind of row is COPYed into
+    a temp table and merged with one statement, instead of a statement and a commit per page.
+
+    Every merge is idempotent (pages and tasks skip conflicts, statuses are plain assignments), so retrying a flush is
+    safe. If the database rejects a row (a NUL byte, a value too long...), each half of the rows is written on its own,
+    down to the single rows that fail: those are dropped, and the task of a rejected page is marked FAILED, so one bad
+    page doesn't take the rest of the batch with it. If the database can't be reached, the whole flush is retried with
+    a backoff (`retry_in`).
+
+    If the worker dies with rows still buffered, their tasks are still leased and are handed out again once the lease
+    runs out. Discovered tasks are never dropped for a lost connection: urls only count as seen once their flush
+    commits, and the tasks of a flush that is given up on are spilled to disk.
+
+    The database and spill files are only touched in the default executor, so a flush doesn't hold up the other stages
+    of the pipeline on the event loop. Rows added while a flush is running wait for it on `_lock`.
+    """
+    prisma: PostgresClient
+    config: Config
+    _pages: list[tuple[CrawlTask, CrawlResult, Optional[int]]]
+    _statuses: dict[int, TaskStatus]
+    _tasks: list[Link | LinkRef]
+    # Canonical keys of `_tasks`, they only go into the Bloom filter once the flush that inserts them commits
+    _task_keys: set[str]
+    _oldest: Optional[float]
+    _failed_attempts: int
+    # Monotonic time before which a failed flush isn't tried again
+    _retry_at: float
+    _lock: asyncio.Lock
+
+    def __init__(self, *, prisma: PostgresClient, config: Config):
+        self.prisma = prisma
+        self.config = config
+        self._pages = []
+        self._statuses = {}
+        self._tasks = []
+        self._task_keys = set()
+        self._oldest = None
+        self._failed_attempts = 0
+        self._retry_at = 0
+        self._lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._pages) + len(self._statuses) + len(self._tasks)
+
+    async def store_page(self, task: CrawlTask, crawl_result: CrawlResult):
+        """Buffered version of `PostgresClient.store_page`"""
+        fingerprint = simhash.simhash(crawl_result.content)
+        async with self._lock:
+            if fingerprint is not None:
+                duplicate = await self._find_near_duplicate(fingerprint, crawl_result.link.url)
+                if duplicate is not None:
+                    # Syndicated copy or the same page with different boilerplate. Don't store, embed or rank it twice
+                    print(f"WARN: Near duplicate of {duplicate}: {crawl_result.link.url}")
+                    self._set_task_status(task, TaskStatus.FILTERED)
+                    return
+
+            self._pages.append((task, crawl_result, fingerprint))
+            self._set_task_status(task, TaskStatus.COMPLETED)
+            self._add_outgoing_links(crawl_result.outbound_links)
+
+    async def set_task_status(self, task: CrawlTask, status: TaskStatus):
+        async with self._lock:
+            self._set_task_status(task, status)
+
+    async def add_outgoing_links(self, links: list[Link | LinkRef]):
+        async with self._lock:
+            self._add_outgoing_links(links)
+
+    def _set_task_status(self, task: CrawlTask, status: TaskStatus):
+        self._statuses[task.id] = status
+        self._touch()
+
+    def _add_outgoing_links(self, links: list[Link | LinkRef]):
+        # Same dedup as `PostgresClient.add_tasks`, plus the links already waiting in the buffer. Only looks at the
+        # in-memory Bloom filter, no query
+        self._tasks.extend(self.prisma.unseen_links(
+            [link for link in links if link.depth <= self.config.max_crawl_depth], self._task_keys))
+        self._touch()
+
+    def _touch(self):
+        if self._oldest is None and len(self) > 0:
+            self._oldest = time.monotonic()
+
+    async def _find_near_duplicate(self, fingerprint: int, url: str) -> Optional[str]:
+        """Url of another stored or buffered page within `simhash.MAX_DISTANCE` bits of `fingerprint`"""
+        for _, result, other in self._pages:
+            if other is not None and result.link.url != url and simhash.distance(fingerprint, other) <= simhash.MAX_DISTANCE:
+                return result.link.url
+        page_id = await asyncio.get_running_loop().run_in_executor(
+            None, self.prisma.find_near_duplicate, fingerprint, url)
+        return f"page {page_id}" if page_id is not None else None
+
+    def retry_in(self) -> float:
+        """Seconds until the database should be tried again after a failed flush, 0 if it can be now"""
+        return max(self._retry_at - time.monotonic(), 0)
+
+    def should_flush(self) -> bool:
+        if self._oldest is None or self.retry_in() > 0:
+            return False
+        return len(self) >= self.config.write_flush_rows or time.monotonic() - self._oldest >= self.config.write_flush_seconds
+
+    async def maybe_flush(self):
+        if self.should_flush():
+            await self.flush()
+
+    async def flush(self):
+        """Write everything buffered now, even if a failed flush is still backing off"""
+        async with self._lock:
+            await self._flush()
+
+    async def close(self):
+        """Flush until everything is written or given up on, waiting out the backoff between attempts"""
+        for _ in range(MAX_FLUSH_ATTEMPTS):
+            if len(self) == 0:
+                return
+            await asyncio.sleep(self.retry_in())
+            await self.flush()
+        if len(self) > 0:
+            print(f"Write buffer: leaving {len(self._tasks)} new tasks unwritten")
+
+    async def _flush(self):
+        if len(self) == 0:
+            self._oldest = None
+            return
+
+        loop = asyncio.get_running_loop()
+        try:
+            stored, rejected = await loop.run_in_executor(
+                None, self._write_rows, Rows(self._pages, self._statuses, self._tasks))
+        except Exception as e:
+            # The transaction was rolled back when the connection went back to the pool
+            self._failed_attempts += 1
+            backoff = min(FLUSH_BACKOFF_SECONDS * 2 ** (self._failed_attempts - 1), MAX_FLUSH_BACKOFF_SECONDS)
+            print(f"Write buffer flush failed ({self._failed_attempts}/{MAX_FLUSH_ATTEMPTS}), retrying in {backoff}s: {e}")
+            if self._failed_attempts >= MAX_FLUSH_ATTEMPTS:
+                print(f"Dropping {len(self._pages)} pages and {len(self._statuses)} task updates, their tasks will be "
+                      f"crawled again")
+                tasks, task_keys = self._tasks, self._task_keys
+                self._clear()
+                if not await loop.run_in_executor(None, self._spill_tasks, tasks):
+                    # Keep them for the next flush rather than lose them
+                    self._tasks, self._task_keys = tasks, task_keys
+                    self._touch()
+            self._retry_at = time.monotonic() + backoff
+            return
+
+        print(f"PSYCOPG: Stored {len(stored)} pages, updated {len(self._statuses) - len(rejected.statuses)} tasks, "
+              f"added {len(self._tasks) - len(rejected.tasks)} tasks")
+        for url in stored:
+            print(f"SUCCESS: Crawled page: {url}")
+        if rejected.units() > 0:
+            print(f"Write buffer: rejected {len(rejected.pages)} pages, {len(rejected.statuses)} task updates and "
+                  f"{len(rejected.tasks)} new tasks")
+        rejected_tasks = {id(link) for link in rejected.tasks}
+        self.prisma.mark_seen([link for link in self._tasks if id(link) not in rejected_tasks])
+        self._clear()
+        await loop.run_in_executor(None, self._restore_spilled)
+
+    def _spill_tasks(self, tasks: list[Link | LinkRef]) -> bool:
+        """Write new tasks to a file of their own in SPILL_DIR, returns whether they are safely on disk"""
+        if len(tasks) == 0:
+            return True
+        path = os.path.join(SPILL_DIR, f'tasks-{time.time():.0f}-{uuid.uuid4().hex}.jsonl')
+        try:
+            os.makedirs(SPILL_DIR, exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                for link in tasks:
+                    f.write(json.dumps(LinkRef.validate(link).dict()) + '\n')
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            print(f"Could not spill {len(tasks)} new tasks to {SPILL_DIR}: {e}")
+            return False
+        print(f"Spilled {len(tasks)} new tasks to {path}")
+        return True
+
+    def _restore_spilled(self):
+        """Add the tasks of spilled files, oldest first. Each file is claimed by renaming it, so only one worker adds it"""
+        if not os.path.isdir(SPILL_DIR):
+            return
+        for name in sorted(n for n in os.listdir(SPILL_DIR) if n.endswith('.jsonl')):
+            path = os.path.join(SPILL_DIR, name)
+            claimed = f'{path}.{uuid.uuid4().hex}.claimed'
+            try:
+                os.replace(path, claimed)
+            except FileNotFoundError:
+                continue  # Claimed by another worker
+
+            try:
+                with open(claimed) as f:
+                    links = [LinkRef.validate(json.loads(line)) for line in f]
+                added = self.prisma.add_tasks(links)
+            except Exception as e:
+                print(f"Could not add spilled tasks from {name}, will try again: {e}")
+                os.replace(claimed, path)
+                return
+            os.remove(claimed)
+            print(f"Added {added} spilled tasks from {name}")
+
+    def _clear(self):
+        self._pages = []
+        self._statuses = {}
+        self._tasks = []
+        self._task_keys = set()
+        self._oldest = None
+        self._failed_attempts = 0
+        self._retry_at = 0
+
+    def _write_rows(self, rows: Rows) -> tuple[list[str], Rows]:
+        """
+        Write `rows`, halving them around the rows the database rejects. Returns the urls of the pages stored and the
+        rows that were rejected. Raises if the database can't be reached
+        """
+        stored, rejected = self._write_bisecting(rows)
+        if rejected.pages:
+            # Not crawled again only to be rejected again
+            self._write(Rows([], {task.id: TaskStatus.FAILED for task, _, _ in rejected.pages}, []))
+        return stored, rejected
+
+    def _write_bisecting(self, rows: Rows) -> tuple[list[str], Rows]:
+        try:
+            return self._write(rows), Rows([], {}, [])
+        except OperationalError:
+            raise
+        except Exception as e:
+            if rows.units() <= 1:
+                row = rows.pages[0][1].link.url if rows.pages else rows.tasks[0].url if rows.tasks else rows.statuses
+                print(f"Write buffer: dropping a row the database rejects ({row}): {e}")
+                return [], rows
+
+        stored, rejected = [], Rows([], {}, [])
+        for half in rows.halves():
+            if half.units() > 0:
+                half_stored, half_rejected = self._write_bisecting(half)
+                stored += half_stored
+                rejected.extend(half_rejected)
+        return stored, rejected
+
+    def _write(self, rows: Rows) -> list[str]:
+        with self.prisma.cursor() as cursor:
+            return self._merge(cursor, rows)
+
+    def _merge(self, cursor: Cursor, rows: Rows) -> list[str]:
+        cursor.execute("""
+            CREATE TEMP TABLE staged_page (
+              content_hash TEXT, url TEXT, parent_url TEXT, title TEXT, date TEXT, author TEXT, content TEXT,
+              outbound_urls TEXT[], depth INT, simhash BIGINT, band0 INT, band1 INT, band2 INT, band3 INT
+            ) ON COMMIT DROP;
+        """)
+        cursor.execute("""
+            CREATE TEMP TABLE staged_status (
+              id INT PRIMARY KEY,
+              status "TaskStatus"
+            ) ON COMMIT DROP;
+        """)
+        cursor.execute("""
+            CREATE TEMP TABLE staged_task (
+              status "TaskStatus", url TEXT, depth INT, parent_url TEXT, text TEXT
+            ) ON COMMIT DROP;
+        """)
+
+        with cursor.copy("COPY staged_page FROM STDIN") as copy:
+            for task, result, fingerprint in rows.pages:
+                if fingerprint is not None:
+                    fingerprint_row = (simhash.to_signed(fingerprint), *simhash.bands(fingerprint))
+                else:
+                    fingerprint_row = (None,) * (simhash.NUM_BANDS + 1)
+                copy.write_row((str(mmh3.hash128(result.content, signed=False)), result.link.url, result.link.parent_url,
+                                result.title, result.date, result.author, result.content,
+                                [link.url for link in result.outbound_links], task.depth, *fingerprint_row))
+
+        with cursor.copy("COPY staged_status (id, status) FROM STDIN") as copy:
+            for task_id, status in rows.statuses.items():
+                copy.write_row((task_id, status.value))
+
+        with cursor.copy("COPY staged_task (status, url, depth, parent_url, text) FROM STDIN") as copy:
+            for link in rows.tasks:
+                copy.write_row((TaskStatus.PENDING.value, link.url, link.depth, link.parent_url, link.text))
+
+        # New pages are queued for `generate_embeddings` in the same statement
+        cursor.execute("""
+            WITH stored AS (
+              INSERT INTO "Page" (content_hash, url, parent_url, title, date, author, content, outbound_urls, depth)
+              SELECT content_hash, url, parent_url, title, date, author, content, outbound_urls, depth FROM staged_page
+              ON CONFLICT DO NOTHING
+              RETURNING id, url, depth
+            ), queued AS (
+              INSERT INTO "EmbeddingTask" (page_id, depth) SELECT id, depth FROM stored
+            )
+            SELECT url FROM stored;
+        """)
+        stored = [row['url'] for row in cursor.fetchall()]
+
+        cursor.execute("""
+            INSERT INTO "PageSimhash" (page_id, simhash, band0, band1, band2, band3)
+            SELECT DISTINCT ON (p.id) p.id, s.simhash, s.band0, s.band1, s.band2, s.band3
+            FROM staged_page s JOIN "Page" p ON p.url = s.url
+            WHERE s.simhash IS NOT NULL
+            ON CONFLICT (page_id) DO UPDATE SET simhash = EXCLUDED.simhash, band0 = EXCLUDED.band0,
+              band1 = EXCLUDED.band1, band2 = EXCLUDED.band2, band3 = EXCLUDED.band3;
+        """)
+        cursor.execute("""
+            UPDATE "CrawlTask" t SET status = s.status FROM staged_status s WHERE t.id = s.id;
+        """)
+        cursor.execute("""
+            INSERT INTO "CrawlTask" (status, url, depth, parent_url, text)
+            SELECT status, url, depth, parent_url, text FROM staged_task
+            ON CONFLICT DO NOTHING;
+        """)
+
+        return stored
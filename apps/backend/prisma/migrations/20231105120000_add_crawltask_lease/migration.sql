@@ -0,0 +1,5 @@
+-- AlterTable
+ALTER TABLE "public"."CrawlTask" ADD COLUMN     "leased_until" TIMESTAMPTZ;
+
+-- CreateIndex
+CREATE INDEX "CrawlTask_status_leased_until_idx" ON "public"."CrawlTask"("status", "leased_until");
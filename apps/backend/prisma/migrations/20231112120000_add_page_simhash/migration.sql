@@ -0,0 +1,26 @@
+-- CreateTable
+CREATE TABLE "public"."PageSimhash" (
+    "page_id" INTEGER NOT NULL,
+    "simhash" BIGINT NOT NULL,
+    "band0" INTEGER NOT NULL,
+    "band1" INTEGER NOT NULL,
+    "band2" INTEGER NOT NULL,
+    "band3" INTEGER NOT NULL,
+
+    CONSTRAINT "PageSimhash_pkey" PRIMARY KEY ("page_id")
+);
+
+-- CreateIndex
+CREATE INDEX "PageSimhash_band0_idx" ON "public"."PageSimhash"("band0");
+
+-- CreateIndex
+CREATE INDEX "PageSimhash_band1_idx" ON "public"."PageSimhash"("band1");
+
+-- CreateIndex
+CREATE INDEX "PageSimhash_band2_idx" ON "public"."PageSimhash"("band2");
+
+-- CreateIndex
+CREATE INDEX "PageSimhash_band3_idx" ON "public"."PageSimhash"("band3");
+
+-- AddForeignKey
+ALTER TABLE "public"."PageSimhash" ADD CONSTRAINT "PageSimhash_page_id_fkey" FOREIGN KEY ("page_id") REFERENCES "public"."Page"("id") ON DELETE CASCADE ON UPDATE CASCADE;
@@ -0,0 +1,21 @@
+-- CreateTable
+CREATE TABLE "public"."EmbeddingTask" (
+    "page_id" INTEGER NOT NULL,
+    "depth" INTEGER NOT NULL DEFAULT 0,
+    "created_at" TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    "leased_until" TIMESTAMPTZ,
+    "attempts" INTEGER NOT NULL DEFAULT 0,
+
+    CONSTRAINT "EmbeddingTask_pkey" PRIMARY KEY ("page_id")
+);
+
+-- CreateIndex
+CREATE INDEX "EmbeddingTask_leased_until_depth_idx" ON "public"."EmbeddingTask"("leased_until", "depth");
+
+-- AddForeignKey
+ALTER TABLE "public"."EmbeddingTask" ADD CONSTRAINT "EmbeddingTask_page_id_fkey" FOREIGN KEY ("page_id") REFERENCES "public"."Page"("id") ON DELETE CASCADE ON UPDATE CASCADE;
+
+-- Queue every page that has no embeddings yet
+INSERT INTO "public"."EmbeddingTask" ("page_id", "depth")
+SELECT p."id", p."depth" FROM "public"."Page" p
+WHERE NOT EXISTS (SELECT 1 FROM "vecs"."Embeddings" e WHERE e."url" = p."url");
@@ -0,0 +1,17 @@
+-- CreateTable
+CREATE TABLE "public"."PageCentroid" (
+    "page_id" INTEGER NOT NULL,
+    "vec" vector(768) NOT NULL,
+
+    CONSTRAINT "PageCentroid_pkey" PRIMARY KEY ("page_id")
+);
+
+-- AddForeignKey
+ALTER TABLE "public"."PageCentroid" ADD CONSTRAINT "PageCentroid_page_id_fkey" FOREIGN KEY ("page_id") REFERENCES "public"."Page"("id") ON DELETE CASCADE ON UPDATE CASCADE;
+
+-- Centroids of the pages embedded so far
+INSERT INTO "public"."PageCentroid" ("page_id", "vec")
+SELECT p."id", avg(e."vec") FROM "public"."Page" p JOIN "vecs"."Embeddings" e ON e."url" = p."url" GROUP BY p."id";
+
+-- CreateIndex
+CREATE INDEX ON "public"."PageCentroid" USING ivfflat (vec vector_cosine_ops) WITH (lists = 100);
@@ -0,0 +1,9 @@
+-- AlterTable
+-- The full-text search column of the baseline, dropped by 20231001011612_abc because the schema didn't list it
+ALTER TABLE "public"."Page" ADD COLUMN IF NOT EXISTS ts tsvector
+    GENERATED ALWAYS AS
+     (setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+     setweight(to_tsvector('english', coalesce(content, '')), 'B')) STORED;
+
+-- CreateIndex
+CREATE INDEX IF NOT EXISTS ts_idx ON "public"."Page" USING GIN (ts);
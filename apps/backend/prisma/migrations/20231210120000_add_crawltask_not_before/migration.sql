@@ -0,0 +1,2 @@
+-- AlterTable
+ALTER TABLE "public"."CrawlTask" ADD COLUMN     "not_before" TIMESTAMPTZ;